@@ -0,0 +1,300 @@
+"""
+Benchmark for rebalance planners. Builds synthetic cluster layouts, runs rebalance changes against in-memory copy
+of cluster and reports time, memory, amount of data movement and quality of resulting distribution.
+
+Usage:
+    python -m benchmarks.rebalance --scenario all
+    python -m benchmarks.rebalance --brokers 60 --racks 3 --topics 2000 --partitions 16 --new-brokers 3
+"""
+import gc
+import random
+import time
+import tracemalloc
+
+import click
+
+from bubuku.features.migrate import MigrationChange
+from bubuku.features.rebalance.change import OptimizedRebalanceChange
+from bubuku.features.rebalance.change_simple import SimpleRebalanceChange
+from bubuku.features.rebalance.change_size import SizeRebalanceChange
+
+
+class SyntheticCluster(object):
+    """
+    Description of synthetic cluster. Brokers are numbered from 1, the last new_brokers + dead_brokers ids are used
+    for new (alive, but without any partitions) and dead (hold partitions, but are not registered) brokers. Brokers
+    from the beginning of the list are marked as to be emptied.
+    """
+
+    def __init__(self, brokers: int, racks: int, topics: int, partitions: int, replication_factor: int = 3,
+                 skew: float = 0.0, new_brokers: int = 0, empty_brokers: int = 0, dead_brokers: int = 0,
+                 seed: int = 0):
+        self.brokers = brokers
+        self.racks = racks
+        self.topics = topics
+        self.partitions = partitions
+        self.replication_factor = replication_factor
+        self.skew = skew
+        self.new_brokers = new_brokers
+        self.empty_brokers = empty_brokers
+        self.dead_brokers = dead_brokers
+        self.seed = seed
+
+    def __str__(self):
+        return 'brokers={}, racks={}, topics={}, partitions={}, rf={}, skew={}, new={}, empty={}, dead={}'.format(
+            self.brokers, self.racks, self.topics, self.partitions, self.replication_factor, self.skew,
+            self.new_brokers, self.empty_brokers, self.dead_brokers)
+
+    def get_alive_ids(self) -> list:
+        return list(range(1, self.brokers - self.dead_brokers + 1))
+
+    def get_new_ids(self) -> list:
+        last_alive = self.brokers - self.dead_brokers
+        return list(range(last_alive - self.new_brokers + 1, last_alive + 1))
+
+    def get_dead_ids(self) -> list:
+        return list(range(self.brokers - self.dead_brokers + 1, self.brokers + 1))
+
+    def get_empty_ids(self) -> list:
+        return list(range(1, self.empty_brokers + 1))
+
+    def get_racks(self) -> dict:
+        return {broker_id: 'rack{}'.format(broker_id % self.racks) if self.racks else None
+                for broker_id in range(1, self.brokers + 1)}
+
+    def generate(self) -> 'FakeExhibitor':
+        """
+        Generates partition assignment and partition sizes. Replicas are never placed on new brokers. With skew > 0
+        that share of partitions is placed only on the first half of brokers, so the layout starts unbalanced. Sizes
+        follow log-normal distribution, so there are few big partitions and a lot of small ones.
+        """
+        rnd = random.Random(self.seed)
+        new_ids = self.get_new_ids()
+        holders = [b for b in range(1, self.brokers + 1) if b not in new_ids]
+        hot = holders[:max(self.replication_factor, len(holders) // 2)]
+        racks = self.get_racks()
+        assignment = {}
+        sizes = {}
+        for topic_idx in range(0, self.topics):
+            topic = 'topic{}'.format(topic_idx)
+            for partition in range(0, self.partitions):
+                pool = hot if rnd.random() < self.skew else holders
+                assignment[(topic, partition)] = rnd.sample(pool, min(self.replication_factor, len(pool)))
+                sizes[(topic, partition)] = int(rnd.lognormvariate(10, 2))
+        alive = self.get_alive_ids()
+        return FakeExhibitor(alive, {b: racks[b] for b in alive}, assignment, sizes)
+
+
+class FakeExhibitor(object):
+    """
+    In-memory replacement of BukuExhibitor, that implements methods used by rebalance changes. Reassignments are
+    applied immediately and are counted.
+    """
+
+    def __init__(self, broker_ids: list, broker_racks: dict, assignment: dict, sizes: dict):
+        self.broker_ids = broker_ids
+        self.broker_racks = broker_racks
+        self.assignment = assignment
+        self.sizes = sizes
+        self.initial_assignment = {k: list(v) for k, v in assignment.items()}
+        self.reassignments = 0
+
+    def get_broker_ids(self) -> list:
+        return sorted(str(b) for b in self.broker_ids)
+
+    def get_broker_racks(self) -> dict:
+        return dict(self.broker_racks)
+
+    def load_partition_assignment(self, topics=None) -> list:
+        return [(topic, partition, list(replicas)) for (topic, partition), replicas in self.assignment.items()
+                if topics is None or topic in topics]
+
+    def get_disk_stats(self) -> dict:
+        topics = {}
+        for (topic, partition), size_kb in self.sizes.items():
+            topics.setdefault(topic, {})[str(partition)] = size_kb
+        return {str(self.broker_ids[0]): {'disk': {}, 'topics': topics}}
+
+    def is_rebalancing(self) -> bool:
+        return False
+
+    def reallocate_partition(self, topic: str, partition: object, replicas: list) -> bool:
+        return self.reallocate_partitions([(topic, partition, replicas)])
+
+    def reallocate_partitions(self, partitions_data: list) -> bool:
+        for topic, partition, replicas in partitions_data:
+            self.assignment[(topic, int(partition))] = [int(r) for r in replicas]
+            self.reassignments += 1
+        return True
+
+
+class BenchmarkResult(object):
+    def __init__(self, name: str, wall_time: float, peak_memory: int, zk: FakeExhibitor, cluster: SyntheticCluster):
+        self.name = name
+        self.wall_time = wall_time
+        self.peak_memory = peak_memory
+        self.reassignments = zk.reassignments
+        self.replicas_moved = 0
+        self.data_moved_kb = 0
+        self.leaders_changed = 0
+        for key, replicas in zk.assignment.items():
+            initial = zk.initial_assignment[key]
+            moved = len([r for r in replicas if r not in initial])
+            self.replicas_moved += moved
+            self.data_moved_kb += moved * zk.sizes[key]
+            if replicas[0] != initial[0]:
+                self.leaders_changed += 1
+
+        target = [b for b in cluster.get_alive_ids() if b not in cluster.get_empty_ids()]
+        replica_count = {b: 0 for b in target}
+        leader_count = {b: 0 for b in target}
+        usage_kb = {b: 0 for b in target}
+        self.misplaced_replicas = 0
+        self.rack_violations = 0
+        racks = cluster.get_racks()
+        for key, replicas in zk.assignment.items():
+            for idx, replica in enumerate(replicas):
+                if replica not in replica_count:
+                    self.misplaced_replicas += 1
+                    continue
+                replica_count[replica] += 1
+                usage_kb[replica] += zk.sizes[key]
+                if idx == 0:
+                    leader_count[replica] += 1
+            rack_list = [racks.get(r) for r in replicas]
+            if len(set(rack_list)) < min(len(replicas), cluster.racks):
+                self.rack_violations += 1
+        self.replica_spread = max(replica_count.values()) - min(replica_count.values()) if target else 0
+        self.leader_spread = max(leader_count.values()) - min(leader_count.values()) if target else 0
+        self.usage_spread_kb = max(usage_kb.values()) - min(usage_kb.values()) if target else 0
+
+    _COLUMNS = ('name', 'wall_time', 'peak_memory', 'reassignments', 'replicas_moved', 'data_moved_kb',
+                'leaders_changed', 'replica_spread', 'leader_spread', 'usage_spread_kb', 'misplaced_replicas',
+                'rack_violations')
+
+    def as_row(self) -> list:
+        return [self.name, '{:.3f}s'.format(self.wall_time), '{:.1f}MB'.format(self.peak_memory / 1024. / 1024.)] + \
+               [str(getattr(self, c)) for c in self._COLUMNS[3:]]
+
+
+def _create_migration(zk, cluster: SyntheticCluster, parallelism: int):
+    if not cluster.empty_brokers or cluster.empty_brokers != cluster.new_brokers:
+        return None
+    return MigrationChange(zk, cluster.get_empty_ids(), cluster.get_new_ids(), True, parallelism)
+
+
+CHANGES = {
+    'optimized': lambda zk, cluster, parallelism: OptimizedRebalanceChange(
+        zk, zk.get_broker_ids(), [str(b) for b in cluster.get_empty_ids()], [], parallelism),
+    'simple': lambda zk, cluster, parallelism: SimpleRebalanceChange(
+        zk, zk.get_broker_ids(), [str(b) for b in cluster.get_empty_ids()], [], parallelism),
+    'size': lambda zk, cluster, parallelism: SizeRebalanceChange(
+        zk, zk.get_broker_ids(), [str(b) for b in cluster.get_empty_ids()], [], parallelism),
+    'migration': _create_migration,
+}
+
+SCENARIOS = {
+    'balanced': dict(brokers=30, racks=3, topics=500, partitions=8),
+    'skewed': dict(brokers=30, racks=3, topics=500, partitions=8, skew=0.7),
+    'new_brokers': dict(brokers=33, racks=3, topics=500, partitions=8, new_brokers=3),
+    'empty_brokers': dict(brokers=30, racks=3, topics=500, partitions=8, empty_brokers=3),
+    'dead_brokers': dict(brokers=30, racks=3, topics=500, partitions=8, dead_brokers=2),
+    'replace_brokers': dict(brokers=33, racks=3, topics=500, partitions=8, new_brokers=3, empty_brokers=3),
+    'large': dict(brokers=60, racks=3, topics=3000, partitions=12, skew=0.5, new_brokers=3),
+}
+
+
+def _run_change(name: str, cluster: SyntheticCluster, parallelism: int, trace_memory: bool):
+    zk = cluster.generate()
+    change = CHANGES[name](zk, cluster, parallelism)
+    if change is None:
+        return None
+    gc.collect()
+    if trace_memory:
+        tracemalloc.start()
+    try:
+        start = time.time()
+        while change.run([]):
+            pass
+        wall_time = time.time() - start
+        peak_memory = tracemalloc.get_traced_memory()[1] if trace_memory else 0
+    finally:
+        if trace_memory:
+            tracemalloc.stop()
+    return wall_time, peak_memory, zk
+
+
+def run_benchmark(name: str, cluster: SyntheticCluster, parallelism: int = 10, measure_memory: bool = True):
+    """
+    Runs change against synthetic cluster. Memory is measured in separate run, as tracing allocations slows
+    execution down.
+    :param name: Name of change, key of CHANGES
+    :param cluster: Cluster layout to run on
+    :param parallelism: Number of partitions to reassign at once
+    :param measure_memory: Whether to make additional run to measure peak memory
+    :return: BenchmarkResult or None, if the change is not applicable to the cluster
+    """
+    timed = _run_change(name, cluster, parallelism, False)
+    if timed is None:
+        return None
+    wall_time, _, zk = timed
+    peak_memory = _run_change(name, cluster, parallelism, True)[1] if measure_memory else 0
+    return BenchmarkResult(name, wall_time, peak_memory, zk, cluster)
+
+
+def _print_results(results: list):
+    rows = [list(BenchmarkResult._COLUMNS)] + [r.as_row() for r in results]
+    lengths = [max(len(row[i]) for row in rows) for i in range(0, len(rows[0]))]
+    for row in rows:
+        print('  '.join(v.ljust(lengths[i]) for i, v in enumerate(row)))
+
+
+@click.command()
+@click.option('--scenario', type=click.Choice(sorted(SCENARIOS.keys()) + ['all']),
+              help='Predefined cluster layout. Other layout options override scenario values')
+@click.option('--brokers', type=int)
+@click.option('--racks', type=int)
+@click.option('--topics', type=int)
+@click.option('--partitions', type=int, help='Number of partitions per topic')
+@click.option('--replication-factor', type=int)
+@click.option('--skew', type=float, help='Share of partitions placed on the first half of brokers')
+@click.option('--new-brokers', type=int, help='Number of brokers without partitions')
+@click.option('--empty-brokers', type=int, help='Number of brokers to remove partitions from')
+@click.option('--dead-brokers', type=int, help='Number of brokers that hold partitions, but are not registered')
+@click.option('--seed', type=int, default=0)
+@click.option('--change', 'changes', type=click.Choice(sorted(CHANGES.keys())), multiple=True,
+              help='Change to benchmark, all changes by default')
+@click.option('--parallelism', type=int, default=10)
+@click.option('--no-memory', is_flag=True, help='Do not measure peak memory (saves one run per change)')
+def main(scenario, brokers, racks, topics, partitions, replication_factor, skew, new_brokers, empty_brokers,
+         dead_brokers, seed, changes, parallelism, no_memory):
+    overrides = {k: v for k, v in dict(
+        brokers=brokers, racks=racks, topics=topics, partitions=partitions, replication_factor=replication_factor,
+        skew=skew, new_brokers=new_brokers, empty_brokers=empty_brokers, dead_brokers=dead_brokers).items()
+                 if v is not None}
+    if scenario == 'all':
+        scenarios = sorted(SCENARIOS.keys())
+    elif scenario:
+        scenarios = [scenario]
+    else:
+        scenarios = ['balanced']
+    for scenario_name in scenarios:
+        params = dict(SCENARIOS[scenario_name])
+        params.update(overrides)
+        cluster = SyntheticCluster(seed=seed, **params)
+        print('Scenario {}: {}'.format(scenario_name, cluster))
+        results = []
+        for name in changes or sorted(CHANGES):
+            try:
+                result = run_benchmark(name, cluster, parallelism, not no_memory)
+            except Exception as e:
+                print('{} failed: {!r}'.format(name, e))
+                continue
+            if result is not None:
+                results.append(result)
+        _print_results(results)
+        print()
+
+
+if __name__ == '__main__':
+    main()
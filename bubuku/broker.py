@@ -82,6 +82,7 @@ class BrokerManager(object):
         self.kafka_properties = kafka_properties
         self.process = process
         self.timeout = timeout
+        self.partition_state_index = None
 
     def is_running_and_registered(self):
         if not self.process.is_running():
@@ -148,11 +149,24 @@ class BrokerManager(object):
                 _LOG.error(
                     'Failed to wait for broker to start up, probably will kill, next timeout is'.format(self.timeout))
 
+    def _list_partition_states(self, active_broker_ids, dead_broker_ids):
+        """
+        Lists partition states that are interesting for leadership check. Without partition state index all the
+        states in cluster are loaded, with index - only states of partitions that are led by dead brokers or brokers
+        that are not in active list.
+        """
+        if self.partition_state_index is None:
+            return self.exhibitor.load_partition_states()
+        leaders = [leader for leader in self.partition_state_index.get_leaders()
+                   if (active_broker_ids and leader not in active_broker_ids) or
+                   (dead_broker_ids and leader in dead_broker_ids)]
+        return self.partition_state_index.list_states(leaders)
+
     def _is_leadership_transferred(self, active_broker_ids=None, dead_broker_ids=None):
         _LOG.info('Checking if leadership is transferred: active_broker_ids={}, dead_broker_ids={}'.format(
             active_broker_ids, dead_broker_ids))
         if self._is_clean_election():
-            for topic, partition, state in self.exhibitor.load_partition_states():
+            for topic, partition, state in self._list_partition_states(active_broker_ids, dead_broker_ids):
                 leader = str(state['leader'])
                 if active_broker_ids and leader not in active_broker_ids:
                     if any(str(x) in active_broker_ids for x in state.get('isr', [])):
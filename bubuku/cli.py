@@ -1,4 +1,6 @@
+import json
 import logging
+from functools import partial
 
 import click
 import requests
@@ -6,7 +8,14 @@ from requests import Response
 
 from bubuku.config import load_config, KafkaProperties, Config
 from bubuku.env_provider import EnvProvider
+from bubuku.features.migrate import MigrationChange
+from bubuku.features.rebalance.change import OptimizedRebalanceChange
+from bubuku.features.rebalance.change_simple import SimpleRebalanceChange
+from bubuku.features.rebalance.change_size import SizeRebalanceChange
+from bubuku.features.rebalance.plan import export_plan, import_plan
+from bubuku.features.rebalance.planning import ClusterSnapshot, compute_plan
 from bubuku.features.remote_exec import RemoteCommandExecutorCheck
+from bubuku.features.swap_partitions import SwapPartitionsChange, load_swap_data
 from bubuku.zookeeper import load_exhibitor_proxy, BukuExhibitor
 
 _LOG = logging.getLogger('bubuku.cli')
@@ -45,6 +54,12 @@ def __get_opt_broker_id(broker_id: str, config: Config, zk: BukuExhibitor, env_p
     return broker_id
 
 
+def __get_adaptive_parallelism(max_parallelism: int, target_batch_duration: int) -> dict:
+    if max_parallelism is None:
+        return None
+    return {'max_parallelism': max_parallelism, 'target_batch_s': target_batch_duration}
+
+
 def __check_all_broker_ids_exist(broker_ids: list, zk: BukuExhibitor):
     registered_brokers = zk.get_broker_ids()
     unknown_brokers = [broker_id for broker_id in broker_ids if broker_id not in registered_brokers]
@@ -87,17 +102,28 @@ def restart_broker(broker: str):
               help="Comma-separated list of brokers to empty. All partitions will be moved to other brokers")
 @click.option('--exclude_topics', type=click.STRING, help="Comma-separated list of topics to exclude from rebalance")
 @click.option('--bin-packing', is_flag=True, help="Use bean packing approach instead of one way processing")
+@click.option('--size-aware', is_flag=True,
+              help="Balance disk usage using partition size statistics, moving as little data as possible. "
+                   "Estimated amount of data to move is logged by broker performing rebalance")
 @click.option('--parallelism', type=click.INT, default=1, show_default=True,
               help="Amount of partitions to move in a single rebalance step")
-def rebalance_partitions(broker: str, empty_brokers: str, exclude_topics: str, parallelism: int, bin_packing: bool):
+@click.option('--max-parallelism', type=click.INT,
+              help="Enables adaptive parallelism: amount of partitions in a single step is changed from --parallelism "
+                   "up to this value, depending on time needed to complete the step")
+@click.option('--target-batch-duration', type=click.INT, default=300, show_default=True,
+              help="Target time in seconds for a single step of adaptive parallelism")
+def rebalance_partitions(broker: str, empty_brokers: str, exclude_topics: str, parallelism: int, bin_packing: bool,
+                         size_aware: bool, max_parallelism: int, target_batch_duration: int):
     config, env_provider = __prepare_configs()
     with load_exhibitor_proxy(env_provider.get_address_provider(), config.zk_prefix) as zookeeper:
         empty_brokers_list = [] if empty_brokers is None else empty_brokers.split(',')
         exclude_topics_list = [] if exclude_topics is None else exclude_topics.split(',')
         __check_all_broker_ids_exist(empty_brokers_list, zookeeper)
         broker_id = __get_opt_broker_id(broker, config, zookeeper, env_provider) if broker else None
+        adaptive = __get_adaptive_parallelism(max_parallelism, target_batch_duration)
         RemoteCommandExecutorCheck.register_rebalance(zookeeper, broker_id, empty_brokers_list,
-                                                      exclude_topics_list, parallelism, bin_packing)
+                                                      exclude_topics_list, parallelism, bin_packing, size_aware,
+                                                      adaptive)
 
 
 @cli.command('migrate', help='Replace one broker with another for all partitions')
@@ -110,12 +136,19 @@ def rebalance_partitions(broker: str, empty_brokers: str, exclude_topics: str, p
 @click.option('--broker', type=click.STRING, help='Optional broker id to execute check on')
 @click.option('--parallelism', type=click.INT, show_default=True, default=1,
               help="Amount of partitions to move in a single migration step")
-def migrate_broker(from_: str, to: str, shrink: bool, broker: str, parallelism: int):
+@click.option('--max-parallelism', type=click.INT,
+              help="Enables adaptive parallelism: amount of partitions in a single step is changed from --parallelism "
+                   "up to this value, depending on time needed to complete the step")
+@click.option('--target-batch-duration', type=click.INT, default=300, show_default=True,
+              help="Target time in seconds for a single step of adaptive parallelism")
+def migrate_broker(from_: str, to: str, shrink: bool, broker: str, parallelism: int, max_parallelism: int,
+                   target_batch_duration: int):
     config, env_provider = __prepare_configs()
     with load_exhibitor_proxy(env_provider.get_address_provider(), config.zk_prefix) as zookeeper:
         broker_id = __get_opt_broker_id(broker, config, zookeeper, env_provider) if broker else None
+        adaptive = __get_adaptive_parallelism(max_parallelism, target_batch_duration)
         RemoteCommandExecutorCheck.register_migration(zookeeper, from_.split(','), to.split(','), shrink, broker_id,
-                                                      parallelism)
+                                                      parallelism, adaptive)
 
 
 @cli.command('swap_fat_slim', help='Move one partition from fat broker to slim one')
@@ -126,6 +159,97 @@ def swap_partitions(threshold: int):
         RemoteCommandExecutorCheck.register_fatboy_slim(zookeeper, threshold_kb=threshold)
 
 
+@cli.group(name='plan', help='Compute reassignment plan locally, without changing the cluster. Plan cost is printed '
+                              'and plan can be exported to be submitted later')
+def plan():
+    pass
+
+
+def __compute_plan(change_factory, description: str, output):
+    config, env_provider = __prepare_configs()
+    with load_exhibitor_proxy(env_provider.get_address_provider(), config.zk_prefix) as zookeeper:
+        snapshot = ClusterSnapshot.load(zookeeper, with_disk_stats=True)
+    _LOG.info('Computing plan for {}'.format(snapshot))
+    data = export_plan(snapshot, compute_plan(change_factory, snapshot), description)
+    summary = data['summary']
+    _print_table([{
+        'Partitions': summary['partitions'],
+        'Replica moves': summary['replica_moves'],
+        'Leader changes': summary['leader_changes'],
+        'Estimated kb': summary['estimated_kb'],
+    }])
+    if output:
+        json.dump(data, output, indent=2)
+        _LOG.info('Plan is written to {}'.format(output.name))
+
+
+@plan.command('rebalance', help='Compute rebalance plan')
+@click.option('--empty_brokers', type=click.STRING,
+              help="Comma-separated list of brokers to empty. All partitions will be moved to other brokers")
+@click.option('--exclude_topics', type=click.STRING, help="Comma-separated list of topics to exclude from rebalance")
+@click.option('--bin-packing', is_flag=True, help="Use bean packing approach instead of one way processing")
+@click.option('--size-aware', is_flag=True, help="Balance disk usage using partition size statistics")
+@click.option('--output', type=click.File('w'), help="File to export plan to")
+def plan_rebalance(empty_brokers: str, exclude_topics: str, bin_packing: bool, size_aware: bool, output):
+    if bin_packing and size_aware:
+        raise Exception('Bin packing and size aware rebalance can not be used together')
+    empty_brokers_list = [] if empty_brokers is None else empty_brokers.split(',')
+    exclude_topics_list = [] if exclude_topics is None else exclude_topics.split(',')
+    change_type = SizeRebalanceChange if size_aware else (
+        OptimizedRebalanceChange if bin_packing else SimpleRebalanceChange)
+
+    def _create_change(zk):
+        return change_type(zk, zk.get_broker_ids(), empty_brokers_list, exclude_topics_list, 1)
+
+    __compute_plan(_create_change, 'rebalance (empty_brokers: {}, exclude_topics: {}, type: {})'.format(
+        empty_brokers_list, exclude_topics_list, change_type.__name__), output)
+
+
+@plan.command('migrate', help='Compute plan to replace one broker with another for all partitions')
+@click.option('--from', 'from_', type=click.STRING, callback=__validate_not_empty,
+              help='List of brokers to migrate from (separated with ",")')
+@click.option('--to', type=click.STRING, callback=__validate_not_empty,
+              help='List of brokers to migrate to (separated with ",")')
+@click.option('--shrink', is_flag=True, default=False, show_default=True,
+              help='Whether or not to shrink replaced broker ids form partition assignment')
+@click.option('--output', type=click.File('w'), help="File to export plan to")
+def plan_migrate(from_: str, to: str, shrink: bool, output):
+    __compute_plan(partial(MigrationChange, from_=from_.split(','), to=to.split(','), shrink=shrink),
+                   'migrate (from: {}, to: {}, shrink: {})'.format(from_, to, shrink), output)
+
+
+@plan.command('swap_fat_slim', help='Compute plan to move one partition from fat broker to slim one')
+@click.option('--threshold', type=click.INT, default="100000", show_default=True, help="Threshold in kb to run swap")
+@click.option('--output', type=click.File('w'), help="File to export plan to")
+def plan_swap_partitions(threshold: int, output):
+    # Disk stats published to zookeeper are used instead of asking brokers
+    __compute_plan(partial(SwapPartitionsChange, swap_data_provider=lambda zk: load_swap_data(zk, -1, threshold)),
+                   'swap_fat_slim (threshold: {})'.format(threshold), output)
+
+
+@plan.command('submit', help='Submit exported plan for execution. Plan is refused if partition assignment was '
+                             'changed since plan was computed')
+@click.argument('plan_file', type=click.File('r'))
+@click.option('--broker', type=click.STRING,
+              help="Broker instance on which to execute plan. By default, any free broker will start it")
+@click.option('--parallelism', type=click.INT, default=1, show_default=True,
+              help="Amount of partitions to move in a single step")
+@click.option('--max-parallelism', type=click.INT,
+              help="Enables adaptive parallelism: amount of partitions in a single step is changed from --parallelism "
+                   "up to this value, depending on time needed to complete the step")
+@click.option('--target-batch-duration', type=click.INT, default=300, show_default=True,
+              help="Target time in seconds for a single step of adaptive parallelism")
+def plan_submit(plan_file, broker: str, parallelism: int, max_parallelism: int, target_batch_duration: int):
+    reassignment = import_plan(json.load(plan_file))
+    config, env_provider = __prepare_configs()
+    with load_exhibitor_proxy(env_provider.get_address_provider(), config.zk_prefix) as zookeeper:
+        broker_id = __get_opt_broker_id(broker, config, zookeeper, env_provider) if broker else None
+        adaptive = __get_adaptive_parallelism(max_parallelism, target_batch_duration)
+        count = RemoteCommandExecutorCheck.register_reassignment(zookeeper, reassignment, broker_id, parallelism,
+                                                                 adaptive)
+        print('Submitted plan with {} partitions to move'.format(count))
+
+
 @cli.group(name='actions', help='Work with running actions')
 def actions():
     pass
@@ -206,10 +330,10 @@ def _extract_error(response: Response):
 
 def _list_broker_addresses(config, env_provider, broker):
     with load_exhibitor_proxy(env_provider.get_address_provider(), config.zk_prefix) as zookeeper:
-        for broker_id in zookeeper.get_broker_ids():
-            if broker and broker != broker_id:
+        for broker_id, metadata in sorted(zookeeper.get_broker_metadata().items()):
+            if broker and broker != str(broker_id):
                 continue
-            yield broker_id, zookeeper.get_broker_address(broker_id)
+            yield str(broker_id), metadata.get('host')
 
 
 @cli.command('stats', help='Display statistics about brokers')
@@ -218,11 +342,11 @@ def show_stats():
     with load_exhibitor_proxy(env_provider.get_address_provider(), config.zk_prefix) as zookeeper:
         disk_stats = zookeeper.get_disk_stats()
         table = []
-        for broker_id in zookeeper.get_broker_ids():
-            disk = disk_stats.get(broker_id, {}).get('disk') if disk_stats else {}
+        for broker_id, metadata in sorted(zookeeper.get_broker_metadata().items()):
+            disk = disk_stats.get(str(broker_id), {}).get('disk', {})
             table.append({
-                'Broker Id': broker_id,
-                'Address': zookeeper.get_broker_address(broker_id),
+                'Broker Id': str(broker_id),
+                'Address': metadata.get('host'),
                 'Free kb': disk.get('free_kb'),
                 'Used kb': disk.get('used_kb')
             })
@@ -8,12 +8,18 @@ __COMMAND_QUEUE = Queue()
 _LOG = logging.getLogger('bubuku.communicate')
 
 
+def _wake_up(controller):
+    pass
+
+
 def sleep_and_operate(controller, timeout: float):
     cur_time = time.time()
     finish = cur_time + (0.1 if timeout <= 0 else timeout)
     while cur_time < finish:
         try:
             command = __COMMAND_QUEUE.get(block=True, timeout=finish - cur_time)
+            if command is _wake_up:
+                return
             try:
                 command(controller)
             except Exception as e:
@@ -23,6 +29,13 @@ def sleep_and_operate(controller, timeout: float):
         cur_time = time.time()
 
 
+def wake_up_controller():
+    """
+    Interrupts controller sleep, so next loop step is executed right away. Can be called from any thread.
+    """
+    __COMMAND_QUEUE.put(_wake_up)
+
+
 def execute_on_controller_thread(function, timeout):
     condition = threading.Condition()
     result = [None, True]
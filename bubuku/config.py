@@ -5,7 +5,7 @@ from collections import namedtuple
 _LOG = logging.getLogger('bubuku.properties')
 
 Config = namedtuple('Config', ('kafka_dir', 'kafka_settings_template', 'zk_stack_name',
-                               'zk_prefix', 'features', 'health_port', 'mode', 'timeout'))
+                               'zk_prefix', 'features', 'health_port', 'mode', 'timeout', 'slow_step_threshold_s'))
 
 
 class KafkaProperties(object):
@@ -62,6 +62,8 @@ def load_config() -> Config:
     features = {key: {} for key in features_str.split(',')} if features_str else {}
     if "balance_data_size" in features:
         features["balance_data_size"]["diff_threshold_mb"] = int(os.getenv('FREE_SPACE_DIFF_THRESHOLD_MB', '50000'))
+    if "throttle_reassignment" in features:
+        features["throttle_reassignment"]["rate_mb"] = int(os.getenv('REASSIGNMENT_THROTTLE_MB', '50'))
     return Config(
         kafka_dir=os.getenv('KAFKA_DIR'),
         kafka_settings_template=os.getenv('KAFKA_SETTINGS'),
@@ -70,7 +72,8 @@ def load_config() -> Config:
         features=features,
         health_port=int(os.getenv('HEALTH_PORT', '8888')),
         mode=str(os.getenv('BUBUKU_MODE', 'amazon')).lower(),
-        timeout=_load_timeout_dict(os.getenv)
+        timeout=_load_timeout_dict(os.getenv),
+        slow_step_threshold_s=float(os.getenv('SLOW_STEP_THRESHOLD_S', '10'))
     )
 
 
@@ -1,9 +1,11 @@
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from time import time
 
 from bubuku.broker import BrokerManager
-from bubuku.communicate import sleep_and_operate
+from bubuku.communicate import sleep_and_operate, wake_up_controller
 from bubuku.env_provider import EnvProvider
+from bubuku.metrics import Timings, get_timings, register_gauge
 from bubuku.zookeeper import BukuExhibitor
 
 _LOG = logging.getLogger('bubuku.controller')
@@ -25,22 +27,71 @@ class Change(object):
     def on_remove(self):
         pass
 
+    def on_cancel(self):
+        """
+        Called before on_remove, when change is cancelled or failed. It is not called for changes stopped on shutdown,
+        so state, that is needed to resume the change after restart, should be removed here.
+        """
+        pass
+
+    def get_remaining_actions(self):
+        """
+        :return: amount of actions (for example partition reassignments) left to complete the change, or None if it is
+        not known
+        """
+        return None
+
 
 class Check(object):
-    def __init__(self, check_interval_s=5):
+    def __init__(self, check_interval_s=5, background=False, timeout_s=None):
+        """
+        :param check_interval_s: interval between check executions
+        :param background: execute check in background thread instead of controller thread. Should be used for slow
+        checks, so they are not delaying changes execution
+        :param timeout_s: time for background check to complete, change produced later than that is discarded
+        """
         self.check_interval_s = check_interval_s
+        self.background = background
+        self.timeout_s = timeout_s
         self.__last_check_timestamp_s = 0
+        self.__triggered = False
 
-    def check_if_time(self) -> Change:
+    def is_time(self) -> bool:
+        """
+        Verifies if it's time to execute check, restarting interval countdown if it is.
+        """
         if self.time_till_check() <= 0:
             self.__last_check_timestamp_s = time()
+            self.__triggered = False
             _LOG.info('Executing check {}'.format(self))
+            return True
+        return False
+
+    def check_if_time(self) -> Change:
+        if self.is_time():
             return self.check()
         return None
 
     def time_till_check(self):
+        if self.__triggered:
+            return 0
         return self.__last_check_timestamp_s + self.check_interval_s - time()
 
+    def trigger(self):
+        """
+        Requests check execution on the next controller loop step. Can be called from any thread.
+        """
+        self.__triggered = True
+
+    def get_watched_paths(self) -> list:
+        """
+        Lists zookeeper nodes, children list change of which should trigger the check. If check watches zookeeper,
+        interval check is used only as a safety net. List is requested on each controller step, so paths, that are not
+        known yet, can be added later.
+        :return: list of zookeeper paths
+        """
+        return []
+
     def check(self) -> Change:
         raise NotImplementedError('Not implemented')
 
@@ -50,7 +101,13 @@ def _exclude_self(provider_id, name, running_actions):
 
 
 class Controller(object):
-    def __init__(self, broker_manager: BrokerManager, zk: BukuExhibitor, env_provider: EnvProvider):
+    # Interval for checks triggered by zookeeper watches, just in case if event was missed
+    _WATCHED_CHECK_INTERVAL_S = 300
+    # Amount of threads executing background checks
+    _BACKGROUND_WORKERS = 2
+
+    def __init__(self, broker_manager: BrokerManager, zk: BukuExhibitor, env_provider: EnvProvider,
+                 timings: Timings = None):
         self.broker_manager = broker_manager
         self.zk = zk
         self.env_provider = env_provider
@@ -58,10 +115,14 @@ class Controller(object):
         self.changes = {}  # Holds mapping from change name to array of pending changes
         self.running = True
         self.provider_id = None  # provider id must not be requested on initialization
+        self.watches_enabled = False
+        self.watched_paths = {}  # Holds mapping from check to set of paths it is subscribed to
+        self.background_executor = None
+        self.background_checks = {}  # Holds mapping from background check to tuple (future, deadline, timed_out)
+        self.timings = timings if timings is not None else get_timings()
 
     def enumerate_changes(self):
-        with self.zk.lock(self.provider_id):
-            running_changes = self.zk.get_running_changes()
+        running_changes = self.zk.get_running_changes()
 
         result = []
         for name, change_list in self.changes.items():
@@ -79,36 +140,82 @@ class Controller(object):
     def cancel_changes(self, name):
         result = len(self.changes.get(name, {}))
         if result:
-            with self.zk.lock(self.provider_id):
-                self.zk.unregister_change(name)
-
-            del self.changes[name]
+            self.zk.unregister_change(name, self.provider_id)
+            for change in self.changes.pop(name):
+                _LOG.info('Cancelling change {}'.format(change))
+                change.on_cancel()
+                change.on_remove()
         return result
 
     def add_check(self, check):
         _LOG.info('Adding check {}'.format(str(check)))
         self.checks.append(check)
+        if self.watches_enabled:
+            self._subscribe_check(check)
+
+    def enable_watches(self):
+        """
+        Switches checks from polling to zookeeper watches: check is executed as soon as one of its watched paths is
+        changed. Controller loop is also woken up when partition reassignment is started or finished, so changes
+        waiting for it proceed without delay.
+        """
+        if self.watches_enabled:
+            return
+        self.watches_enabled = True
+        for check in self.checks:
+            self._subscribe_check(check)
+        self.zk.subscribe_node('/admin/reassign_partitions', wake_up_controller)
+
+    def _subscribe_check(self, check: Check):
+        subscribed = self.watched_paths.setdefault(check, set())
+        paths = [path for path in check.get_watched_paths() if path not in subscribed]
+        if not paths:
+            return
+        _LOG.info('Check {} will be triggered by changes of {}'.format(check, paths))
+        check.check_interval_s = max(check.check_interval_s, self._WATCHED_CHECK_INTERVAL_S)
+
+        def _on_change():
+            check.trigger()
+            wake_up_controller()
+
+        for path in paths:
+            self.zk.subscribe_children(path, _on_change)
+            subscribed.add(path)
 
     def _register_running_changes(self) -> dict:
         if not self.changes:
             return {}  # Do not take lock if there are no changes to register
+        running_changes = self.zk.get_running_changes()
+        if all(running_changes.get(name) == self.provider_id for name in self.changes.keys()):
+            # Registration nodes are ephemeral, so they serve as leases, that are held while zookeeper session is
+            # alive. All the pending changes are registered already, there is no need to take the lock.
+            return running_changes
         _LOG.debug('Taking lock for processing')
+        lock_start = time()
         with self.zk.lock(self.provider_id):
             _LOG.debug('Lock is taken')
+            self.timings.update('lock', 'register_changes', time() - lock_start)
             # Get list of current running changes
-            running_changes = self.zk.get_running_changes()
+            running_changes, version = self.zk.load_running_changes()
             if running_changes:
                 _LOG.info("Running changes: {}".format(running_changes))
             # Register changes to run
+            to_register = []
             for name, change_list in self.changes.items():
                 # Only first change is able to run
                 first_change = change_list[0]
                 if first_change.can_run(_exclude_self(self.provider_id, name, running_changes)):
                     if name not in running_changes:
-                        self.zk.register_change(name, self.provider_id)
+                        to_register.append(name)
                         running_changes[name] = self.provider_id
                 else:
                     _LOG.info('Change {} is waiting for others: {}'.format(name, running_changes))
+            # Registration is atomic and fails if registry was changed since it was read (for example by instance,
+            # that doesn't respect global lock)
+            if to_register and not self.zk.register_changes(to_register, self.provider_id, version):
+                _LOG.info('Failed to register changes {}, will retry on next step'.format(to_register))
+                for name in to_register:
+                    del running_changes[name]
             return running_changes
 
     def _run_changes(self, running_changes: dict) -> list:
@@ -119,7 +226,10 @@ class Controller(object):
                 _LOG.info('Executing action {} step'.format(change))
                 if self.running or change.can_run_at_exit():
                     try:
-                        if not change.run(_exclude_self(self.provider_id, change.get_name(), running_changes)):
+                        with self.timings.measure('change', change.get_name()):
+                            in_progress = change.run(
+                                _exclude_self(self.provider_id, change.get_name(), running_changes))
+                        if not in_progress:
                             _LOG.info('Action {} completed'.format(change))
                             changes_to_remove.append(change.get_name())
                         else:
@@ -127,6 +237,7 @@ class Controller(object):
                     except Exception as e:
                         _LOG.error('Failed to execute change {} because of exception, removing'.format(change),
                                    exc_info=e)
+                        change.on_cancel()
                         changes_to_remove.append(change.get_name())
                 else:
                     _LOG.info(
@@ -142,12 +253,22 @@ class Controller(object):
                 if not self.changes[change_name]:
                     del self.changes[change_name]
                 removed_change.on_remove()
-            with self.zk.lock():
-                for name in changes_to_remove:
-                    self.zk.unregister_change(name)
+            # Only registration nodes of this instance are removed, so no need to take the lock
+            for name in changes_to_remove:
+                self.zk.unregister_change(name, self.provider_id)
+
+    def _get_queue_sizes(self) -> dict:
+        return {name: len(change_list) for name, change_list in list(self.changes.items())}
+
+    def _get_remaining_actions(self) -> dict:
+        return {name: change_list[0].get_remaining_actions()
+                for name, change_list in list(self.changes.items()) if change_list}
 
     def loop(self, change_on_init=None):
         self.provider_id = self.env_provider.get_id()
+        register_gauge('bubuku_controller_queue_size', 'Amount of pending changes', self._get_queue_sizes, 'change')
+        register_gauge('bubuku_change_remaining_actions', 'Amount of actions (partition reassignments) left for the '
+                       'running change', self._get_remaining_actions, 'change')
         if change_on_init:
             self._add_change_to_queue(change_on_init)
         while self.running or self.changes:
@@ -158,6 +279,8 @@ class Controller(object):
             else:
                 timeout = min([check.time_till_check() for check in self.checks])
             sleep_and_operate(self, timeout)
+        if self.background_executor:
+            self.background_executor.shutdown(wait=False)
 
     def make_step(self):
         # register running changes
@@ -165,10 +288,56 @@ class Controller(object):
         # apply changes without holding lock
         changes_to_remove = self._run_changes(running_changes)
         # remove processed actions
-        self._release_changes_lock(changes_to_remove)
+        if changes_to_remove:
+            with self.timings.measure('step', 'release_changes'):
+                self._release_changes_lock(changes_to_remove)
         if self.running:
             for check in self.checks:
-                self._add_change_to_queue(check.check_if_time())
+                if self.watches_enabled:
+                    self._subscribe_check(check)
+                if check.background:
+                    self._add_change_to_queue(self._check_in_background(check))
+                elif check.is_time():
+                    self._add_change_to_queue(self._run_check(check))
+
+    def _run_check(self, check: Check) -> Change:
+        with self.timings.measure('check', type(check).__name__):
+            return check.check()
+
+    def _check_in_background(self, check: Check) -> Change:
+        """
+        Starts background check if it's time to, or collects the result of the one that is already running. Only one
+        instance of check is executed at a time.
+        :return: Change produced by completed background check or None
+        """
+        if check in self.background_checks:
+            future, deadline, timed_out = self.background_checks[check]
+            if not future.done():
+                if not timed_out and deadline is not None and time() > deadline:
+                    _LOG.warning('Background check {} is running longer than {}s, its result will be ignored'.format(
+                        check, check.timeout_s))
+                    self.background_checks[check] = (future, deadline, True)
+                return None
+            del self.background_checks[check]
+            try:
+                change = future.result()
+            except Exception as e:
+                _LOG.error('Background check {} failed'.format(check), exc_info=e)
+                return None
+            if timed_out:
+                _LOG.warning('Discarding change {} from timed out check {}'.format(change, check))
+                return None
+            return change
+        if not check.is_time():
+            return None
+        if not self.background_executor:
+            self.background_executor = ThreadPoolExecutor(max_workers=self._BACKGROUND_WORKERS)
+        future = self.background_executor.submit(self._run_check, check)
+        # Wake up controller to pick up the result as soon as check is completed
+        future.add_done_callback(lambda f: wake_up_controller())
+        deadline = time() + check.timeout_s if check.timeout_s is not None else None
+        self.background_checks[check] = (future, deadline, False)
+        return None
 
     def _add_change_to_queue(self, change):
         if not change:
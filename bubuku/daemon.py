@@ -11,11 +11,13 @@ from bubuku.controller import Controller
 from bubuku.env_provider import EnvProvider
 from bubuku.features.data_size_stats import GenerateDataSizeStatistics
 from bubuku.features.rebalance.check import RebalanceOnStartCheck, RebalanceOnBrokerListCheck
+from bubuku.features.rebalance.planning import start_planning_process
 from bubuku.features.remote_exec import RemoteCommandExecutorCheck
 from bubuku.features.restart_if_dead import CheckBrokerStopped
 from bubuku.features.restart_on_zk_change import CheckExhibitorAddressChanged, RestartBrokerChange
 from bubuku.features.swap_partitions import CheckBrokersDiskImbalance
 from bubuku.features.terminate import register_terminate_on_interrupt
+from bubuku.metrics import get_timings
 from bubuku.utils import CmdHelper
 from bubuku.zookeeper import BukuExhibitor, load_exhibitor_proxy
 
@@ -38,6 +40,16 @@ def apply_features(api_port, features: dict, controller: Controller, buku_proxy:
             register_terminate_on_interrupt(controller, broker)
         elif feature == 'use_ip_address':
             kafka_properties.set_property('advertised.host.name', env_provider.get_id())
+        elif feature == 'cache_partition_assignment':
+            buku_proxy.enable_assignment_cache()
+        elif feature == 'index_partition_states':
+            broker.partition_state_index = buku_proxy.enable_partition_state_index()
+        elif feature == 'rebalance_planning_process':
+            pass  # Worker process is started on daemon startup, before any threads are created
+        elif feature == 'event_driven_checks':
+            controller.enable_watches()
+        elif feature == 'throttle_reassignment':
+            buku_proxy.enable_reassignment_throttle(config['rate_mb'] * 1024 * 1024)
         else:
             _LOG.error('Using of unsupported feature "{}", skipping it'.format(feature))
 
@@ -63,6 +75,8 @@ def run_daemon_loop(config: Config, process_holder: KafkaProcess, cmd_helper: Cm
         broker = BrokerManager(process_holder, zookeeper, broker_id_manager, kafka_props,
                                startup_timeout)
 
+        cmd_helper.set_log_dirs(kafka_props.get_property("log.dirs").split(","))
+
         _LOG.info("Creating controller")
         controller = Controller(broker, zookeeper, env_provider)
 
@@ -81,7 +95,10 @@ def main():
 
     config = load_config()
     _LOG.info("Using configuration: {}".format(config))
+    get_timings().slow_threshold_s = config.slow_step_threshold_s
     process = KafkaProcess(config.kafka_dir)
+    if 'rebalance_planning_process' in config.features:
+        start_planning_process()
     _LOG.info('Starting health server')
     cmd_helper = CmdHelper()
     health.start_server(config.health_port, cmd_helper)
@@ -1,26 +1,108 @@
 import logging
+import os
 
 from bubuku.broker import BrokerManager
 from bubuku.controller import Check
+from bubuku.metrics import get_timings
 from bubuku.utils import CmdHelper
 from bubuku.zookeeper import BukuExhibitor
 
 _LOG = logging.getLogger('bubuku.features.data_size_stats')
 
 
+def _get_segment_offset(file_name: str):
+    # Segment files are named by base offset: 00000000000000000042.log, 00000000000000000042.index, ...
+    offset = file_name.split('.', 1)[0]
+    return int(offset) if offset.isdigit() else None
+
+
+class _PartitionSizes(object):
+    def __init__(self, dir_mtime: float, files: dict):
+        self.dir_mtime = dir_mtime
+        self.files = files  # Holds mapping from file name to tuple (size in bytes, immutable, mtime, file size)
+
+
+class LogDirSizeScanner(object):
+    """
+    Calculates size of partitions in kafka log directories. Segments, except the active one, are not changed by kafka,
+    so their sizes are cached by file name, modification time and size. Directory listing is reused as long as
+    modification time of partition directory is the same, in this case only active segment is checked. Otherwise
+    cached size is used only if file stat is the same, as log cleaner replaces segments with the same names.
+    Size is calculated from allocated blocks, the same way as du does, as index files are preallocated sparse files.
+    """
+
+    def __init__(self):
+        self.cache = {}  # Holds mapping from log dir to mapping from partition directory name to _PartitionSizes
+
+    def scan(self, log_dir: str) -> list:
+        """
+        Scans log directory
+        :param log_dir: kafka log directory
+        :return: list of tuples (topic, partition, size_kb)
+        """
+        result = []
+        cached = self.cache.get(log_dir, {})
+        scanned = {}
+        for entry in os.scandir(log_dir):
+            if not entry.is_dir(follow_symlinks=False):
+                continue
+            tp_parts = entry.name.rsplit('-', 1)
+            if len(tp_parts) != 2 or not tp_parts[1].isdigit():
+                continue
+            try:
+                sizes = self._scan_partition(
+                    entry.path, entry.stat(follow_symlinks=False).st_mtime, cached.get(entry.name))
+            except FileNotFoundError:
+                continue  # Partition was removed while scanning
+            scanned[entry.name] = sizes
+            result.append((tp_parts[0], tp_parts[1], sum(f[0] for f in sizes.files.values()) // 1024))
+        self.cache[log_dir] = scanned
+        return result
+
+    @staticmethod
+    def _scan_partition(path: str, dir_mtime: float, cached: _PartitionSizes) -> _PartitionSizes:
+        if cached is not None and cached.dir_mtime == dir_mtime:
+            # No files were created, removed or renamed since the last scan
+            entries = {name: None for name in cached.files.keys()}
+        else:
+            entries = {entry.name: entry for entry in os.scandir(path)}
+        offsets = [_get_segment_offset(name) for name in entries.keys() if name.endswith('.log')]
+        active_offset = max([o for o in offsets if o is not None], default=None)
+        files = {}
+        for name, entry in entries.items():
+            offset = _get_segment_offset(name)
+            immutable = offset is not None and active_offset is not None and offset < active_offset
+            cached_file = cached.files.get(name) if immutable and cached is not None else None
+            if cached_file is not None and cached_file[1] and entry is None:
+                files[name] = cached_file
+                continue
+            try:
+                stat = entry.stat(follow_symlinks=False) if entry is not None else os.stat(
+                    os.path.join(path, name), follow_symlinks=False)
+            except FileNotFoundError:
+                continue  # Segment was removed by retention
+            if cached_file is not None and cached_file[1] and cached_file[2:] == (stat.st_mtime, stat.st_size):
+                files[name] = cached_file
+            else:
+                files[name] = (stat.st_blocks * 512, immutable, stat.st_mtime, stat.st_size)
+        return _PartitionSizes(dir_mtime, files)
+
+
 class GenerateDataSizeStatistics(Check):
     def __init__(self, zk: BukuExhibitor, broker: BrokerManager, cmd_helper: CmdHelper, kafka_log_dirs: list):
-        super().__init__(check_interval_s=600)
+        super().__init__(check_interval_s=600, background=True, timeout_s=300)
         self.zk = zk
         self.broker = broker
         self.cmd_helper = cmd_helper
         self.kafka_log_dirs = kafka_log_dirs
+        self.scanner = LogDirSizeScanner()
 
     def check(self):
         if self.broker.is_running_and_registered():
             _LOG.info("Generating data size statistics")
             try:
-                self.__generate_stats()
+                with get_timings().measure('size_stats', 'collect'):
+                    self.__generate_stats()
                 _LOG.info("Data size statistics successfully written to zk")
             except Exception:
                 _LOG.warn("Error occurred when collecting size statistics", exc_info=True)
@@ -39,30 +121,8 @@ class GenerateDataSizeStatistics(Check):
         topics_stats = {}
         for log_dir in self.kafka_log_dirs:
             _LOG.info("Processing log dir: {}".format(log_dir))
-            topic_dirs = self.cmd_helper.cmd_run("du -k -d 1 {}".format(log_dir)).split("\n")
-            for topic_dir in topic_dirs:
-                dir_stats = self.__parse_dir_stats(topic_dir, log_dir)
-                if dir_stats:
-                    topic, partition, size_kb = dir_stats
-                    if topic not in topics_stats:
-                        topics_stats[topic] = {}
-                    topics_stats[topic][partition] = int(size_kb)
+            for topic, partition, size_kb in self.scanner.scan(log_dir):
+                if topic not in topics_stats:
+                    topics_stats[topic] = {}
+                topics_stats[topic][partition] = size_kb
         return topics_stats
-
-    @staticmethod
-    def __parse_dir_stats(topic_dir, log_dir):
-        """
-        Parses topic-partition size stats from "du" tool single line output
-        :param topic_dir: the string to be parsed; example: "45983\t/tmp/kafka-logs/my-kafka-topic-0"
-        :param log_dir: the kafka log directory name itself
-        :return: tuple (topic, partition, size) or None if the topic_dir has incorrect format
-        """
-        dir_data = topic_dir.split("\t")
-        if len(dir_data) == 2 and dir_data[1] != log_dir:
-            size_kb, dir_name = tuple(dir_data)
-            tp_name = dir_name.split("/")[-1]
-            tp_parts = tp_name.rsplit("-", 1)
-            if len(tp_parts) == 2:
-                topic, partition = tuple(tp_parts)
-                return topic, partition, size_kb
-        return None
@@ -1,24 +1,32 @@
 import logging
 
 from bubuku.features.rebalance import BaseRebalanceChange
+from bubuku.features.rebalance.checkpoint import PlanCheckpoint
+from bubuku.features.rebalance.parallelism import create_parallelism
 from bubuku.zookeeper import BukuExhibitor
 
 _LOG = logging.getLogger('bubuku.features.migrate')
 
 
 class MigrationChange(BaseRebalanceChange):
-    def __init__(self, zk: BukuExhibitor, from_: list, to: list, shrink: bool, parallelism: int = 1):
+    def __init__(self, zk: BukuExhibitor, from_: list, to: list, shrink: bool, parallelism: int = 1,
+                 checkpoint: PlanCheckpoint = None):
+        """
+        :param checkpoint: storage for partitions to migrate, so migration can be resumed after restart
+        """
         self.zk = zk
         self.migration = {int(from_[i]): int(to[i]) for i in range(0, len(from_))}
         self.shrink = shrink
         self.data_to_migrate = None
-        self.parallelism = parallelism
+        self.parallelism = create_parallelism(parallelism)
+        self.checkpoint = checkpoint
 
     def run(self, current_actions) -> bool:
         if self.should_be_paused(current_actions):
             return True
         if self.zk.is_rebalancing():
             return True
+        self.parallelism.batch_finished()
         active_ids = [int(k) for k in self.zk.get_broker_ids()]
         if any(b not in active_ids for b in self.migration.keys()):
             _LOG.error('Source brokers {} are not in active list {}. Stopping.'.format(
@@ -29,25 +37,42 @@ class MigrationChange(BaseRebalanceChange):
                 self.migration.values(), active_ids))
             return False
         if self.data_to_migrate is None:
+            plan = self.checkpoint.load(sorted(active_ids)) if self.checkpoint is not None else None
+            if plan is not None:
+                self.data_to_migrate = [(topic, partition, replicas) for topic, partition, replicas, _ in plan]
+                return True
             _LOG.info('Loading partition assignment')
             self.data_to_migrate = [data for data in self.zk.load_partition_assignment()]
             _LOG.info('Load {} partitions'.format(len(self.data_to_migrate)))
+            if self.checkpoint is not None:
+                plan = [(topic, partition, replicas, self._replace_replicas(replicas))
+                        for topic, partition, replicas in self.data_to_migrate]
+                self.checkpoint.save(sorted(active_ids), [item for item in plan if item[2] != item[3]])
             return True
 
         items_to_migrate = []
-        while self.data_to_migrate and len(items_to_migrate) < self.parallelism:
+        batch_size = self.parallelism.get()
+        while self.data_to_migrate and len(items_to_migrate) < batch_size:
             topic, partition, replicas = self.data_to_migrate.pop()
             replaced_replicas = self._replace_replicas(replicas)
             if replaced_replicas == replicas:
                 continue
             items_to_migrate.append((topic, partition, replicas, replaced_replicas))
         if not items_to_migrate:
+            if self.checkpoint is not None:
+                self.checkpoint.remove()
             return False
-        if not self.zk.reallocate_partitions([(t, p, rr) for t, p, _, rr in items_to_migrate]):
+        if self.zk.reallocate_partitions([(t, p, rr) for t, p, _, rr in items_to_migrate]):
+            self.parallelism.batch_started(len(items_to_migrate))
+        else:
             for topic, partition, replicas, _ in items_to_migrate:
                 self.data_to_migrate.append((topic, partition, replicas))
         return True
 
+    def on_cancel(self):
+        if self.checkpoint is not None:
+            self.checkpoint.remove()
+
     def __str__(self):
         return 'Migration links {}, shrink: {}, data_to_move: {}, parallelism: {}'.format(
             self.migration,
@@ -56,6 +81,21 @@ class MigrationChange(BaseRebalanceChange):
             self.parallelism,
         )
 
+    def get_remaining_actions(self):
+        return len(self.data_to_migrate) if self.data_to_migrate is not None else None
+
+    def compute_plan(self) -> dict:
+        """
+        Computes the whole migration plan.
+        :return: dictionary (topic, partition) -> new replica list
+        """
+        result = {}
+        for topic, partition, replicas in self.zk.load_partition_assignment():
+            replaced_replicas = self._replace_replicas(replicas)
+            if replaced_replicas != replicas:
+                result[(topic, partition)] = replaced_replicas
+        return result
+
     def _replace_replicas(self, replicas):
         replacement = [self.migration[k] for k in replicas if k in self.migration]
         if self.shrink:
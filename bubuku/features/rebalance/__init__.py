@@ -8,6 +8,10 @@ class BaseRebalanceChange(Change):
     def can_run(self, current_actions):
         return all([a not in current_actions for a in ['start', 'restart', 'rebalance', 'stop']])
 
+    def on_remove(self):
+        # Throttles are kept between reassignment batches and removed once the change is finished
+        self.zk.clear_reassignment_throttle()
+
     @staticmethod
     def should_be_paused(current_actions):
         return any([a in current_actions for a in ['restart', 'start', 'stop']])
\ No newline at end of file
@@ -132,7 +132,8 @@ class BrokerDescription(object):
         # Already a replica for this partition
         if self._replicas.contains(topic_partition):
             return False
-        if self._rack_id != source_broker._rack_id:
+        # Rack of dead broker is not known, so its replicas can be moved to any rack
+        if source_broker._rack_id is not None and self._rack_id != source_broker._rack_id:
             return False
         self._replicas.add(topic_partition)
         source_broker._replicas.remove(topic_partition)
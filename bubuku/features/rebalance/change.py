@@ -1,7 +1,14 @@
+import heapq
+import itertools
 import logging
+from functools import partial
+from time import time
 
 from bubuku.features.rebalance import BaseRebalanceChange
 from bubuku.features.rebalance.broker import BrokerDescription
+from bubuku.features.rebalance.checkpoint import PlanCheckpoint
+from bubuku.features.rebalance.parallelism import create_parallelism
+from bubuku.features.rebalance.planning import ClusterSnapshot, get_planning_executor, submit_plan, get_plan
 from bubuku.zookeeper import BukuExhibitor
 
 _LOG = logging.getLogger('bubuku.features.rebalance')
@@ -18,18 +25,83 @@ def distribute(amount: int, items: list, weight_key):
     return amounts
 
 
+class _TopicWeights(object):
+    """
+    Topics with weights for a single pair of brokers. Topics are ordered by weight (descending), topics with the same
+    weight are ordered by the moment they got this weight. Stored as a heap with lazy invalidation - outdated entries
+    are dropped when they appear on top.
+    """
+    __slots__ = [
+        '_heap',
+        '_current'
+    ]
+
+    def __init__(self, weight_list: list, sequence):
+        self._current = {}
+        self._heap = []
+        for topic, weight in weight_list:
+            seq = next(sequence)
+            self._current[topic] = (weight, seq)
+            self._heap.append((-weight, seq, topic))
+        heapq.heapify(self._heap)
+
+    def top(self):
+        """
+        :return: tuple (topic, weight) with the biggest weight or None if there are no topics left
+        """
+        while self._heap:
+            neg_weight, seq, topic = self._heap[0]
+            current = self._current.get(topic)
+            if current is not None and current[1] == seq:
+                return topic, -neg_weight
+            heapq.heappop(self._heap)
+        return None
+
+    def change_weight(self, topic: str, weight_change, sequence) -> bool:
+        """
+        Changes weight of topic. Topic is placed after all the topics having the same weight.
+        :param topic: Topic to change weight for
+        :param weight_change: delta to apply or None to remove topic
+        :param sequence: source of ordering numbers
+        :return: True if topic was present
+        """
+        current = self._current.pop(topic, None)
+        if current is None:
+            return False
+        if weight_change is not None:
+            seq = next(sequence)
+            self._current[topic] = (current[0] + weight_change, seq)
+            heapq.heappush(self._heap, (-(current[0] + weight_change), seq, topic))
+        if len(self._heap) > 2 * len(self._current) + 16:
+            self._heap = [(-w, seq, t) for t, (w, seq) in self._current.items()]
+            heapq.heapify(self._heap)
+        return True
+
+
 class DistributionMap(object):
     """
     Topic distribution map. Used to correctly balance leadership across brokers. Internal collection of candidates is a
-    dict with reflection of (source_broker, target_broker) -> sorted_list_of_topics_and weights.
+    dict with reflection of (source_broker, target_broker) -> topics and weights ordered by weight. Best pair is
+    selected using heap of pairs with lazy invalidation, so each move costs O(log n) per affected pair instead of full
+    scan over all pairs.
     """
     __slots__ = [
         '_candidates',
-        '_candidates_cardinality'
+        '_candidates_cardinality',
+        '_pair_order',
+        '_pair_heap',
+        '_pairs_by_broker',
+        '_sequence',
+        '_touched'
     ]
 
     def __init__(self, brokers: iter):
         self._candidates = {}
+        self._pair_order = {}
+        self._pair_heap = []
+        self._pairs_by_broker = {}
+        self._sequence = itertools.count()
+        self._touched = ()
         self._candidates_cardinality = {broker: broker.calculate_topic_cardinality() for broker in brokers}
         for source_broker in brokers:
             if not source_broker.have_extra_leaders():
@@ -37,7 +109,8 @@ class DistributionMap(object):
             for target_broker in brokers:
                 if not target_broker.have_less_leaders():
                     continue
-                if not source_broker._rack_id == target_broker._rack_id:
+                # Leadership is kept within the rack, unless rack of source broker is not known (it is dead)
+                if source_broker._rack_id is not None and not source_broker._rack_id == target_broker._rack_id:
                     continue
                 weight_list = []
                 for topic in self._candidates_cardinality[source_broker].keys():
@@ -46,8 +119,29 @@ class DistributionMap(object):
                     weight_list.append((topic, delta))
                 # Now the first element is the first to rebalance.
                 if weight_list:
-                    self._candidates[(source_broker, target_broker)] = sorted(
-                        weight_list, key=lambda x: x[1], reverse=True)
+                    broker_pair = (source_broker, target_broker)
+                    self._candidates[broker_pair] = _TopicWeights(weight_list, self._sequence)
+                    # Pairs with the same weight are selected in order of creation
+                    self._pair_order[broker_pair] = len(self._pair_order)
+                    self._pairs_by_broker.setdefault(source_broker, set()).add(broker_pair)
+                    self._pairs_by_broker.setdefault(target_broker, set()).add(broker_pair)
+                    self._push_pair(broker_pair)
+
+    def _push_pair(self, broker_pair):
+        top = self._candidates[broker_pair].top()
+        if top is not None:
+            heapq.heappush(self._pair_heap, (-top[1], self._pair_order[broker_pair], broker_pair))
+
+    def _take_top_pair(self):
+        while self._pair_heap:
+            neg_weight, _, broker_pair = self._pair_heap[0]
+            weights = self._candidates.get(broker_pair)
+            if weights is not None:
+                top = weights.top()
+                if top is not None and top[1] == -neg_weight:
+                    return broker_pair
+            heapq.heappop(self._pair_heap)
+        raise Exception('No candidates left to move leadership')
 
     def take_move_pair(self) -> tuple:
         """
@@ -55,71 +149,56 @@ class DistributionMap(object):
         already performed
         :return: tuple source_broker, target_broker, topic_name
         """
-        top_candidate = None
-        for broker_pair, weight_list in self._candidates.items():
-            if not top_candidate:
-                top_candidate = broker_pair
-            else:
-                if weight_list[0][1] > self._candidates[top_candidate][0][1]:
-                    top_candidate = broker_pair
-                    # Taking best topic to move
-        topic, _ = self._candidates[top_candidate][0]
+        top_candidate = self._take_top_pair()
+        # Taking best topic to move
+        topic, _ = self._candidates[top_candidate].top()
         self._candidates_cardinality[top_candidate[0]][topic] -= 1
         topic_exhausted = self._candidates_cardinality[top_candidate[0]][topic] == 0
-        if topic_exhausted:
-            for broker_pair, weight_list in self._candidates.items():
-                if top_candidate == broker_pair:
-                    DistributionMap._rearrange_topic_weights(weight_list, topic, None)
-                elif top_candidate[0] == broker_pair[0]:
-                    DistributionMap._rearrange_topic_weights(weight_list, topic, None)
-                elif top_candidate[1] == broker_pair[1]:
-                    DistributionMap._rearrange_topic_weights(weight_list, topic, -1)
-        else:
-            # Updating cardinality map
-            for broker_pair, weight_list in self._candidates.items():
-                if top_candidate == broker_pair:
-                    DistributionMap._rearrange_topic_weights(weight_list, topic, -2)
-                elif top_candidate[0] == broker_pair[0] or top_candidate[1] == broker_pair[1]:  # src or dst matches
-                    DistributionMap._rearrange_topic_weights(weight_list, topic, -1)
+        affected = self._pairs_by_broker[top_candidate[0]] | self._pairs_by_broker[top_candidate[1]]
+        for broker_pair in affected:
+            if top_candidate == broker_pair:
+                change = None if topic_exhausted else -2
+            elif top_candidate[0] == broker_pair[0]:
+                change = None if topic_exhausted else -1
+            elif top_candidate[1] == broker_pair[1]:
+                change = -1
+            else:
+                continue
+            if self._candidates[broker_pair].change_weight(topic, change, self._sequence):
+                self._push_pair(broker_pair)
+        self._touched = top_candidate
         # Get broker objects
         return top_candidate[0], top_candidate[1], topic
 
-    @staticmethod
-    def _rearrange_topic_weights(array: list, topic: str, cardinality_change):
-        old_cardinality = None
-        for item in array:
-            if item[0] == topic:
-                old_cardinality = item[1]
-                array.remove(item)
-                break
-        if old_cardinality is None:
-            return
-        if cardinality_change is None:
-            return
-        new_cardinality = old_cardinality + cardinality_change
-        idx = 0
-        for i in range(len(array) - 1, -1, -1):
-            if array[i][1] >= new_cardinality:
-                idx = i + 1
-                break
-        array.insert(idx, (topic, new_cardinality))
-
     def cleanup(self):
-        for bp in [bp for bp, wl in self._candidates.items()
-                   if not bp[0].have_extra_leaders() or not bp[1].have_less_leaders()]:
-            del self._candidates[bp]
+        # Only brokers from the last move are changing their leadership counts
+        for broker in self._touched:
+            for bp in [bp for bp in self._pairs_by_broker[broker]
+                       if not bp[0].have_extra_leaders() or not bp[1].have_less_leaders()]:
+                del self._candidates[bp]
+                self._pairs_by_broker[bp[0]].discard(bp)
+                self._pairs_by_broker[bp[1]].discard(bp)
+        self._touched = ()
 
 
 class OptimizedRebalanceChange(BaseRebalanceChange):
     _LOAD_STATE = 'load_state'
     _COMPUTE_LEADERS = 'compute_leaders'
     _COMPUTE_REPLICAS = 'compute_replicas'
+    _WAIT_PLAN = 'wait_plan'
     _SORT_ACTIONS = 'sort_actions'
     _BALANCE = 'balance'
+    # Maximum time for planning within one step, so controller thread is not blocked for a long time
+    _PLANNING_TIME_SLICE_S = 0.5
 
     def __init__(self, zk: BukuExhibitor, broker_ids: list, empty_brokers: list, exclude_topics: list,
-                 parallelism: int = 1):
+                 parallelism: int = 1, checkpoint: PlanCheckpoint = None):
+        """
+        :param checkpoint: storage for computed plan, so rebalance can be resumed after restart
+        """
         self.zk = zk
+        self.initial_broker_ids = broker_ids
+        self.empty_brokers = empty_brokers
         self.all_broker_ids = sorted(int(id_) for id_ in broker_ids)
         self.broker_ids = sorted(int(id_) for id_ in broker_ids if id_ not in empty_brokers)
         self.broker_racks = zk.get_broker_racks()
@@ -128,12 +207,20 @@ class OptimizedRebalanceChange(BaseRebalanceChange):
         self.source_distribution = None
         self.action_queue = []
         self.state = OptimizedRebalanceChange._LOAD_STATE
-        self.parallelism = parallelism
+        self.parallelism = create_parallelism(parallelism)
+        self.planner = None
+        self.plan_future = None
+        self.checkpoint = checkpoint
 
     def __str__(self):
         return 'OptimizedRebalance state={}, queue_size={}, parallelism={}'.format(
             self.state, len(self.action_queue) if self.action_queue is not None else None, self.parallelism)
 
+    def get_remaining_actions(self):
+        if self.state != OptimizedRebalanceChange._BALANCE:
+            return None
+        return len(self.action_queue)
+
     def run(self, current_actions) -> bool:
         # Stop rebalance if someone is restarting
         if self.should_be_paused(current_actions):
@@ -141,49 +228,139 @@ class OptimizedRebalanceChange(BaseRebalanceChange):
             return True
         if self.zk.is_rebalancing():
             return True
+        self.parallelism.batch_finished()
         new_broker_ids = sorted(int(id_) for id_ in self.zk.get_broker_ids())
         if new_broker_ids != self.all_broker_ids:
             _LOG.warning("Rebalance stopped because of broker list change from {} to {}".format(
                 self.all_broker_ids, new_broker_ids))
+            self._remove_checkpoint()
             return False
         if self.state == OptimizedRebalanceChange._LOAD_STATE:
-            self._load_data()
-            self.state = OptimizedRebalanceChange._COMPUTE_LEADERS
+            executor = get_planning_executor()
+            if self._resume():
+                self.state = OptimizedRebalanceChange._BALANCE
+            elif executor is None:
+                self._load_data()
+                self.state = OptimizedRebalanceChange._COMPUTE_LEADERS
+            else:
+                snapshot = ClusterSnapshot.load(self.zk)
+                self.source_distribution = {(topic, partition): replicas
+                                            for topic, partition, replicas in snapshot.assignment}
+                _LOG.info('Submitting rebalance planning for {} to worker process'.format(snapshot))
+                self.plan_future = submit_plan(partial(
+                    OptimizedRebalanceChange, broker_ids=self.initial_broker_ids, empty_brokers=self.empty_brokers,
+                    exclude_topics=self.exclude_topics), snapshot)
+                if self.plan_future is not None:
+                    self.state = OptimizedRebalanceChange._WAIT_PLAN
+        elif self.state == OptimizedRebalanceChange._WAIT_PLAN:
+            if not self.plan_future.done():
+                return True
+            plan = get_plan(self.plan_future)
+            self.plan_future = None
+            if plan is None:
+                # Planning process died, plan is computed again on controller thread
+                self.state = OptimizedRebalanceChange._LOAD_STATE
+                return True
+            self.action_queue = plan
+            _LOG.info('Rebalance plan is computed in worker process, {} partitions to move'.format(
+                len(self.action_queue)))
+            self._save_checkpoint()
+            self.state = OptimizedRebalanceChange._BALANCE
         elif self.state == OptimizedRebalanceChange._COMPUTE_LEADERS:
-            self._rebalance_leaders()
-            self.state = OptimizedRebalanceChange._COMPUTE_REPLICAS
+            if self._plan_step(self._rebalance_leaders):
+                self.state = OptimizedRebalanceChange._COMPUTE_REPLICAS
         elif self.state == OptimizedRebalanceChange._COMPUTE_REPLICAS:
-            self._rebalance_replicas()
-            self.state = OptimizedRebalanceChange._SORT_ACTIONS
+            if self._plan_step(self._rebalance_replicas):
+                self.state = OptimizedRebalanceChange._SORT_ACTIONS
         elif self.state == OptimizedRebalanceChange._SORT_ACTIONS:
             self.action_queue = self._sort_actions()
+            self._save_checkpoint()
             self.state = OptimizedRebalanceChange._BALANCE
         elif self.state == OptimizedRebalanceChange._BALANCE:
-            return not self._balance()
+            if self._balance():
+                self._remove_checkpoint()
+                return False
+        return True
+
+    def _resume(self) -> bool:
+        if self.checkpoint is None:
+            return False
+        plan = self.checkpoint.load(self.all_broker_ids)
+        if plan is None:
+            return False
+        # Queue is consumed from the end, order of saved plan is kept
+        self.action_queue = {(topic, partition): target for topic, partition, _, target in plan}
+        return True
+
+    def _save_checkpoint(self):
+        if self.checkpoint is not None:
+            self.checkpoint.save(self.all_broker_ids, [(key[0], key[1], self.source_distribution[key], replicas)
+                                                       for key, replicas in self.action_queue.items()])
+
+    def _remove_checkpoint(self):
+        if self.checkpoint is not None:
+            self.checkpoint.remove()
+
+    def on_remove(self):
+        if self.plan_future is not None:
+            self.plan_future.cancel()
+        super().on_remove()
+
+    def on_cancel(self):
+        self._remove_checkpoint()
+
+    def compute_plan(self) -> dict:
+        """
+        Computes the whole reassignment plan without splitting it into steps.
+        :return: dictionary (topic, partition) -> new replica list
+        """
+        self._load_data()
+        for _ in self._rebalance_leaders():
+            pass
+        for _ in self._rebalance_replicas():
+            pass
+        return self._sort_actions()
+
+    def _plan_step(self, planner_factory) -> bool:
+        """
+        Advances planning generator until it is finished or time slice for the step is over.
+        :param planner_factory: function that creates planning generator if it was not created yet
+        :return: True if planning is finished
+        """
+        if self.planner is None:
+            self.planner = planner_factory()
+        finish = time() + self._PLANNING_TIME_SLICE_S
+        for _ in self.planner:
+            if time() >= finish:
+                return False
+        self.planner = None
         return True
 
     def _balance(self):
         items = []
-        while self.action_queue and len(items) < self.parallelism:
+        batch_size = self.parallelism.get()
+        while self.action_queue and len(items) < batch_size:
             items.append(self.action_queue.popitem())  # key, partition tuple
         if not items:
             return True
         data_to_rebalance = [(key[0], key[1], replicas) for key, replicas in items]
-        if not self.zk.reallocate_partitions(data_to_rebalance):
+        if self.zk.reallocate_partitions(data_to_rebalance):
+            self.parallelism.batch_started(len(items))
+        else:
             for key, replicas in items:
                 self.action_queue[key] = replicas
         return False
 
     def _rebalance_replicas(self):
         """
-        Balances replicas distribution.
+        Balances replicas distribution. Generator, that yields after each replica movement.
         """
         # Remove duplicates
-        self._remove_replica_copies()
-        if not self._rebalance_replicas_template(False):
+        yield from self._remove_replica_copies()
+        if not (yield from self._rebalance_replicas_template(False)):
             # It may happen, that data can not be copied, because there is leader of this topic already there.
-            self._rebalance_replicas_template(True)
-            if not self._rebalance_replicas_template(False):
+            yield from self._rebalance_replicas_template(True)
+            if not (yield from self._rebalance_replicas_template(False)):
                 _LOG.error('Failed to rebalance replicas. Probably because of replication factor problems. '
                            'Will just stop the process')
                 raise Exception('Failed to perform replica rebalance {}, {}, {}'.format(
@@ -227,16 +404,19 @@ class OptimizedRebalanceChange(BaseRebalanceChange):
                 if not moved_to:
                     raise Exception('Failed to move replica ' + str(topic_partition) + ', not enough replicas')
                 self.action_queue.append((topic_partition, broker.broker_id, moved_to.broker_id))
+                yield
 
     def _rebalance_replicas_template(self, force: bool):
         for broker in self.broker_distribution.values():
-            rack = self.broker_racks[broker.broker_id]
+            # Rack of dead broker is not known, so its replicas can be moved to any rack
+            rack = self.broker_racks.get(broker.broker_id)
             to_move = broker.get_replica_overload()
             if to_move <= 0:
                 continue
             targets = self._list_active_brokers_with_skip(broker.broker_id)
             if not force:
-                targets = [t for t in targets if t.has_free_replica_slots() and self.broker_racks[t.broker_id] == rack]
+                targets = [t for t in targets if t.has_free_replica_slots() and
+                           (rack is None or self.broker_racks[t.broker_id] == rack)]
             for _ in range(0, to_move):
                 target = False
                 for topic_partition in broker.list_replicas():
@@ -244,15 +424,17 @@ class OptimizedRebalanceChange(BaseRebalanceChange):
                     if target:
                         self.action_queue.append((topic_partition, broker.broker_id, target.broker_id))
                         break
+                yield
                 if target is None:
                     return False
                 if not force:
-                    targets = [t for t in targets if t.has_free_replica_slots() and self.broker_racks[t.broker_id] == rack]
+                    targets = [t for t in targets if t.has_free_replica_slots() and
+                               (rack is None or self.broker_racks[t.broker_id] == rack)]
         return True
 
     def _rebalance_leaders(self):
         """
-        Balances leadership across active brokers.
+        Balances leadership across active brokers. Generator, that yields after each leadership movement.
         """
         candidates = DistributionMap(self.broker_distribution.values())
         while any([broker.have_extra_leaders() for broker in self.broker_distribution.values()]):
@@ -261,7 +443,7 @@ class OptimizedRebalanceChange(BaseRebalanceChange):
             # Selecting best partition to move (It is better to just swap leadership, instead of copying data)
             selected_partition = None
             source_partitions = source_broker.list_partitions(topic, False)
-            target_partitions = target_broker.list_partitions(topic, True)
+            target_partitions = set(target_broker.list_partitions(topic, True))
             for partition in source_partitions:
                 if partition in target_partitions:
                     selected_partition = partition
@@ -275,6 +457,7 @@ class OptimizedRebalanceChange(BaseRebalanceChange):
             self.action_queue.append((topic_partition, source_broker.broker_id, target_broker.broker_id))
             # Remove empty lists
             candidates.cleanup()
+            yield
 
     def _load_data(self):
         """
@@ -289,13 +472,24 @@ class OptimizedRebalanceChange(BaseRebalanceChange):
             leader = True
             for replica in replicas:
                 if replica not in self.broker_distribution:
-                    self.broker_distribution[replica] = BrokerDescription(replica, self.broker_racks[replica])
+                    self.broker_distribution[replica] = BrokerDescription(replica, self.broker_racks.get(replica))
                 if leader:
                     self.broker_distribution[replica].add_leader(topic_partition)
                     leader = False
                 else:
                     self.broker_distribution[replica].add_replica(topic_partition)
         active_brokers = [broker for id_, broker in self.broker_distribution.items() if id_ in self.broker_ids]
+        # Rack of dead broker is not known, its partitions are spread across all the racks
+        known_brokers = [broker for id_, broker in self.broker_distribution.items() if id_ in self.broker_racks]
+        dead_brokers = [broker for id_, broker in self.broker_distribution.items() if id_ not in self.broker_racks]
+        dead_leaders = distribute(sum(b.get_leader_count() for b in dead_brokers), active_brokers,
+                                  BrokerDescription.get_leader_count)
+        dead_replicas = distribute(sum(b.get_replica_count() for b in dead_brokers), active_brokers,
+                                   BrokerDescription.get_replica_count)
+        extra_leaders = {b.broker_id: count for b, count in zip(sorted(
+            active_brokers, key=BrokerDescription.get_leader_count, reverse=True), dead_leaders)}
+        extra_replicas = {b.broker_id: count for b, count in zip(sorted(
+            active_brokers, key=BrokerDescription.get_replica_count, reverse=True), dead_replicas)}
 
         rack_to_brokers = {}
         for broker, rack in self.broker_racks.items():
@@ -303,12 +497,14 @@ class OptimizedRebalanceChange(BaseRebalanceChange):
 
         for rack in rack_to_brokers.keys():
             active_brokers_in_rack = [active_broker for active_broker in active_brokers if active_broker._rack_id == rack]
-            total_leaders = sum(b.get_leader_count() for b in self.broker_distribution.values()
-                                               if b._rack_id == rack)
+            total_leaders = sum(b.get_leader_count() for b in known_brokers if b._rack_id == rack)
             new_leader_count = distribute(total_leaders, active_brokers_in_rack, BrokerDescription.get_leader_count)
-            total_replicas = sum(b.get_replica_count() for b in self.broker_distribution.values() if b.rack_id == rack) + sum(new_leader_count)
+            total_replicas = sum(b.get_replica_count() for b in known_brokers if b.rack_id == rack) + sum(new_leader_count)
             new_replica_count =  distribute(total_replicas, active_brokers_in_rack, BrokerDescription.get_replica_count)
 
             for i in range(0, len(active_brokers_in_rack)):
-                active_brokers_in_rack[i].set_leader_expectation(new_leader_count[i])
-                active_brokers_in_rack[i].set_replica_expectation(new_replica_count[i] - new_leader_count[i])
+                broker_id = active_brokers_in_rack[i].broker_id
+                leader_count = new_leader_count[i] + extra_leaders.get(broker_id, 0)
+                active_brokers_in_rack[i].set_leader_expectation(leader_count)
+                active_brokers_in_rack[i].set_replica_expectation(
+                    new_replica_count[i] - new_leader_count[i] + extra_replicas.get(broker_id, 0))
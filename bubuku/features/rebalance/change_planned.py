@@ -0,0 +1,87 @@
+import logging
+
+from bubuku.features.rebalance import BaseRebalanceChange
+from bubuku.features.rebalance.checkpoint import PlanCheckpoint, get_remaining_plan
+from bubuku.features.rebalance.parallelism import create_parallelism
+from bubuku.zookeeper import BukuExhibitor
+
+_LOG = logging.getLogger('bubuku.features.rebalance.planned')
+
+
+class PlannedReassignmentChange(BaseRebalanceChange):
+    """
+    Executes reassignment plan computed in advance (with bubuku-cli plan commands). Plan is executed only if
+    partitions still have replicas the plan was computed for, otherwise nothing is moved.
+    """
+
+    def __init__(self, zk: BukuExhibitor, plan_id: str, parallelism: int = 1, checkpoint: PlanCheckpoint = None):
+        """
+        :param plan_id: id of plan, stored with BukuExhibitor.save_reassignment_plan
+        :param checkpoint: storage for plan, so execution can be resumed after restart
+        """
+        self.zk = zk
+        self.plan_id = plan_id
+        self.parallelism = create_parallelism(parallelism)
+        self.checkpoint = checkpoint
+        self.queue = None
+
+    def __str__(self):
+        return 'PlannedReassignment plan={}, queue_size={}, parallelism={}'.format(
+            self.plan_id, len(self.queue) if self.queue is not None else None, self.parallelism)
+
+    def get_remaining_actions(self):
+        return len(self.queue) if self.queue is not None else None
+
+    def on_cancel(self):
+        if self.checkpoint is not None:
+            self.checkpoint.remove()
+
+    def run(self, current_actions) -> bool:
+        if self.should_be_paused(current_actions):
+            return True
+        if self.zk.is_rebalancing():
+            return True
+        self.parallelism.batch_finished()
+        if self.queue is None:
+            return self._load_plan(sorted(int(id_) for id_ in self.zk.get_broker_ids()))
+        items = []
+        batch_size = self.parallelism.get()
+        while self.queue and len(items) < batch_size:
+            items.append(self.queue.pop())
+        if not items:
+            if self.checkpoint is not None:
+                self.checkpoint.remove()
+            return False
+        if self.zk.reallocate_partitions([(topic, partition, target) for topic, partition, _, target in items]):
+            self.parallelism.batch_started(len(items))
+        else:
+            self.queue.extend(reversed(items))
+        return True
+
+    def _load_plan(self, broker_ids: list) -> bool:
+        plan = self.checkpoint.load(broker_ids) if self.checkpoint is not None else None
+        if plan is None:
+            data = self.zk.load_reassignment_plan(self.plan_id)
+            if data is None:
+                _LOG.error('Reassignment plan {} is not found, stopping'.format(self.plan_id))
+                return False
+            plan = get_remaining_plan(self.zk, [tuple(item) for item in data])
+            if plan is None:
+                _LOG.error('Partition assignment was changed since plan {} was computed, stopping'.format(
+                    self.plan_id))
+                self.zk.remove_reassignment_plan(self.plan_id)
+                return False
+            if self.checkpoint is not None:
+                self.checkpoint.save(broker_ids, plan)
+            # Plan is owned by this change from now on, it is removed only when the checkpoint is saved
+            self.zk.remove_reassignment_plan(self.plan_id)
+        missing = sorted(set(b for _, _, _, target in plan for b in target if b not in broker_ids))
+        if missing:
+            _LOG.error('Brokers {} from plan {} are not active, stopping'.format(missing, self.plan_id))
+            if self.checkpoint is not None:
+                self.checkpoint.remove()
+            return False
+        _LOG.info('Executing plan {}, {} partitions to move'.format(self.plan_id, len(plan)))
+        # Queue is consumed from the end
+        self.queue = list(reversed(plan))
+        return True
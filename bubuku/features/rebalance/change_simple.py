@@ -1,7 +1,11 @@
 import logging
+from functools import partial
 from typing import List
 
 from bubuku.features.rebalance import BaseRebalanceChange
+from bubuku.features.rebalance.load_model import create_load_model
+from bubuku.features.rebalance.parallelism import create_parallelism
+from bubuku.features.rebalance.planning import ClusterSnapshot, get_planning_executor, submit_plan, get_plan
 from bubuku.zookeeper import BukuExhibitor
 
 FAKE_ZONE = 'fake_zone'
@@ -209,15 +213,19 @@ class FakeBroker(Broker):
 
 
 def transfer_partition(partition, from_: Broker, target_brokers_sorted: List[Broker],
-                       zone_checker: ZoneChecker, polite=False):
+                       zone_checker: ZoneChecker, polite=False) -> Broker:
+    """
+    Moves partition from broker from_ to first suitable broker from target_brokers_sorted
+    :return: Broker, to which partition was moved, or None
+    """
     for target in target_brokers_sorted:
         if not zone_checker.is_allowed_move(from_, target, partition):
             continue
         if polite and target.is_replicas_overloaded(1):
             continue
         if partition.change_assignment(from_, target):
-            return True
-    return False
+            return target
+    return None
 
 
 def get_division_result_min_max(nom, denom):
@@ -235,6 +243,7 @@ class SimpleRebalanceChange(BaseRebalanceChange):
     _STATE_EMPTY_FAKE = 'empty_fake'
     _STATE_OPTIMIZE_REPLICAS = 'optimize_replicas'
     _STATE_OPTIMIZE_LEADERS = 'optimize_leaders'
+    _STATE_WAIT_PLAN = 'wait_plan'
     _STATE_BALANCE = 'balance'
 
     def __init__(self, zk: BukuExhibitor, broker_ids: list, empty_brokers: list, exclude_topics: list,
@@ -245,11 +254,12 @@ class SimpleRebalanceChange(BaseRebalanceChange):
         self.active_brokers = {}
         self.partitions = {}
         self.rebalance_queue = {}
-        self.parallelism = parallelism
+        self.parallelism = create_parallelism(parallelism)
         self.exclude_topics = exclude_topics if exclude_topics else []
         self.empty_brokers = [str(e) for e in empty_brokers] if empty_brokers else []
         self.initial_broker_ids = sorted([str(broker_id) for broker_id in broker_ids])
         self.zone_checker = None
+        self.plan_future = None
 
     def register_partition_change(self, partition: Partition):
         self.rebalance_queue[(partition.topic, partition.partition)] = partition
@@ -313,38 +323,41 @@ class SimpleRebalanceChange(BaseRebalanceChange):
                     )
 
     def empty_fake(self):
-        leaders_load = sorted(self.active_brokers.values(), key=lambda x: x.get_load_factor(True))
-        replica_load = sorted(self.active_brokers.values(), key=lambda x: x.get_load_factor(False))
+        load = create_load_model(self.active_brokers.values())
+        load.resort(True)
+        load.resort(False)
 
         for pkey, is_leader in self.fake.list_partition_keys():
-            load = leaders_load if is_leader else replica_load
             partition = self.partitions[pkey]
-            if not transfer_partition(partition, self.fake, load, self.zone_checker, polite=False):
+            target = transfer_partition(partition, self.fake, load.iterate(is_leader), self.zone_checker, polite=False)
+            if not target:
                 raise Exception('Nowhere to transfer partition {}'.format(pkey))
             self.register_partition_change(partition)
-            if is_leader:
-                leaders_load = sorted(leaders_load, key=lambda x: x.get_load_factor(True))
-            else:
-                replica_load = sorted(replica_load, key=lambda x: x.get_load_factor(False))
+            load.update(target)
+            load.resort(is_leader)
 
     def optimize_replicas(self):
-        current_load = sorted(self.active_brokers.values(), key=lambda x: x.get_load_factor(False))
+        load = create_load_model(self.active_brokers.values())
+        load.resort(False)
         moved = True
         while moved:
-            to_empty = current_load[-1]
+            to_empty = load.most_loaded(False)
             if not to_empty.is_replicas_overloaded():
                 return
             moved = False
             for pkey in to_empty.copy_partition_keys():
                 partition = self.partitions[pkey]
-                if not transfer_partition(partition, to_empty, current_load, self.zone_checker, polite=True):
+                target = transfer_partition(partition, to_empty, load.iterate(False), self.zone_checker, polite=True)
+                if not target:
                     continue
                 moved = True
                 self.register_partition_change(partition)
+                load.update(target)
+                load.update(to_empty)
                 if not to_empty.is_replicas_overloaded():
                     break
             if moved:
-                current_load = sorted(current_load, key=lambda x: x.get_load_factor(False))
+                load.resort(False)
 
     def optimize_leaders(self):
         # First step, try to balance leaders for partitions that we are already moving
@@ -371,20 +384,41 @@ class SimpleRebalanceChange(BaseRebalanceChange):
                     self.register_partition_change(p)
                     has_modifications = True
 
+    def export_plan(self) -> dict:
+        """
+        Converts queue of changed partitions to plain reassignment plan.
+        :return: dictionary (topic, partition) -> new replica list
+        """
+        return {key: [b.id_ for b in p.brokers] for key, p in self.rebalance_queue.items()}
+
+    def compute_plan(self) -> dict:
+        """
+        Computes the whole reassignment plan without splitting it into steps.
+        :return: dictionary (topic, partition) -> new replica list
+        """
+        self.load_data_from_zk()
+        if not self.active_brokers:
+            return {}
+        self.createInitialDistribution()
+        self.empty_fake()
+        self.optimize_replicas()
+        self.optimize_leaders()
+        return self.export_plan()
+
     def perform_rebalance(self):
         to_rebalance = [k for k in self.rebalance_queue.keys()]
-        if len(to_rebalance) > self.parallelism:
-            to_rebalance = to_rebalance[:self.parallelism]
-        to_rebalance = [self.rebalance_queue.pop(k) for k in to_rebalance]
+        batch_size = self.parallelism.get()
+        if len(to_rebalance) > batch_size:
+            to_rebalance = to_rebalance[:batch_size]
+        to_rebalance = [(k, self.rebalance_queue.pop(k)) for k in to_rebalance]
         if not to_rebalance:
             return True
-        to_rebalance_data = [
-            (p.topic, int(p.partition), [b.id_ for b in p.brokers])
-            for p in to_rebalance
-        ]
-        if not self.zk.reallocate_partitions(to_rebalance_data):
-            for partition in to_rebalance:
-                self.register_partition_change(partition)
+        to_rebalance_data = [(topic, int(partition), replicas) for (topic, partition), replicas in to_rebalance]
+        if self.zk.reallocate_partitions(to_rebalance_data):
+            self.parallelism.batch_started(len(to_rebalance))
+        else:
+            for key, replicas in to_rebalance:
+                self.rebalance_queue[key] = replicas
         return False
 
     def run(self, current_actions) -> bool:
@@ -394,6 +428,7 @@ class SimpleRebalanceChange(BaseRebalanceChange):
             return True
         if self.zk.is_rebalancing():
             return True
+        self.parallelism.batch_finished()
 
         new_broker_ids = sorted([str(id_) for id_ in self.zk.get_broker_ids()])
         if new_broker_ids != self.initial_broker_ids:
@@ -401,7 +436,28 @@ class SimpleRebalanceChange(BaseRebalanceChange):
                 self.initial_broker_ids, new_broker_ids))
             return False
 
-        if self.state == SimpleRebalanceChange._STATE_INIT:
+        if self.state == SimpleRebalanceChange._STATE_INIT and get_planning_executor() is not None:
+            snapshot = ClusterSnapshot.load(self.zk)
+            _LOG.info('Submitting rebalance planning for {} to worker process'.format(snapshot))
+            self.plan_future = submit_plan(partial(
+                SimpleRebalanceChange, broker_ids=self.initial_broker_ids, empty_brokers=self.empty_brokers,
+                exclude_topics=self.exclude_topics, parallelism=self.parallelism), snapshot)
+            if self.plan_future is not None:
+                self.state = SimpleRebalanceChange._STATE_WAIT_PLAN
+        elif self.state == SimpleRebalanceChange._STATE_WAIT_PLAN:
+            if not self.plan_future.done():
+                return True
+            plan = get_plan(self.plan_future)
+            self.plan_future = None
+            if plan is None:
+                # Planning process died, plan is computed again on controller thread
+                self.state = SimpleRebalanceChange._STATE_INIT
+                return True
+            self.rebalance_queue = plan
+            _LOG.info('Rebalance plan is computed in worker process, {} partitions to move'.format(
+                len(self.rebalance_queue)))
+            self.state = SimpleRebalanceChange._STATE_BALANCE
+        elif self.state == SimpleRebalanceChange._STATE_INIT:
             # Load data from zk
             self.load_data_from_zk()
             if not self.active_brokers:
@@ -423,6 +479,7 @@ class SimpleRebalanceChange(BaseRebalanceChange):
         elif self.state == SimpleRebalanceChange._STATE_OPTIMIZE_LEADERS:
             # Now try to evenly distribute partitions/leaders among brokers
             self.optimize_leaders()
+            self.rebalance_queue = self.export_plan()
             self.state = SimpleRebalanceChange._STATE_BALANCE
         elif self.state == SimpleRebalanceChange._STATE_BALANCE:
             rebalance_finished = self.perform_rebalance()
@@ -432,6 +489,16 @@ class SimpleRebalanceChange(BaseRebalanceChange):
             return False
         return True
 
+    def on_remove(self):
+        if self.plan_future is not None:
+            self.plan_future.cancel()
+        super().on_remove()
+
+    def get_remaining_actions(self):
+        if self.state != SimpleRebalanceChange._STATE_BALANCE:
+            return None
+        return len(self.rebalance_queue)
+
     def __str__(self):
         return 'SimpleRebalance state={}, queue_size={}, parallelism={}'.format(
             self.state, len(self.rebalance_queue), self.parallelism)
@@ -0,0 +1,287 @@
+import bisect
+import logging
+from functools import partial
+
+from bubuku.features.rebalance import BaseRebalanceChange
+from bubuku.features.rebalance.parallelism import create_parallelism
+from bubuku.features.rebalance.planning import ClusterSnapshot, get_planning_executor, submit_plan, get_plan
+from bubuku.zookeeper import BukuExhibitor
+
+_LOG = logging.getLogger('bubuku.features.rebalance.size')
+
+
+def load_partition_sizes(disk_stats: dict) -> dict:
+    """
+    Merges per-broker size statistics (as published by GenerateDataSizeStatistics) to partition sizes. If several
+    brokers report size of the same partition, the biggest one is taken, as lagging replicas are smaller.
+    :param disk_stats: dictionary broker_id -> {'disk': {...}, 'topics': {topic: {partition: size_kb}}}
+    :return: dictionary (topic, partition: int) -> size_kb
+    """
+    sizes = {}
+    for broker_stats in disk_stats.values():
+        for topic, partitions in broker_stats.get('topics', {}).items():
+            for partition, size_kb in partitions.items():
+                key = (topic, int(partition))
+                sizes[key] = max(sizes.get(key, 0), int(size_kb))
+    return sizes
+
+
+def estimate_transfer_kb(source: dict, plan: dict, sizes: dict) -> int:
+    """
+    Estimates amount of data that is copied while executing reassignment plan
+    :param source: dictionary (topic, partition) -> current replica list
+    :param plan: dictionary (topic, partition) -> new replica list
+    :param sizes: dictionary (topic, partition) -> size_kb
+    :return: estimated size of data to copy in kb
+    """
+    result = 0
+    for key, replicas in plan.items():
+        current = source.get(key, [])
+        result += sizes.get(key, 0) * len([r for r in replicas if r not in current])
+    return result
+
+
+class SizeRebalanceChange(BaseRebalanceChange):
+    """
+    Rebalance that balances disk usage instead of partition count. Partition sizes are taken from size statistics
+    published by brokers and are used both to find target usage of each broker and as a cost of replica movement.
+    Replicas are moved from the most loaded broker to the least loaded ones, preferring the biggest partitions that
+    do not overshoot the target, so the amount of copied data stays close to the minimum needed.
+    """
+    _LOAD_STATE = 'load_state'
+    _WAIT_PLAN = 'wait_plan'
+    _BALANCE = 'balance'
+    # Broker is treated as balanced when its usage exceeds the average by not more than this share
+    _BALANCE_THRESHOLD = 0.05
+
+    def __init__(self, zk: BukuExhibitor, broker_ids: list, empty_brokers: list, exclude_topics: list,
+                 parallelism: int = 1):
+        self.zk = zk
+        self.initial_broker_ids = broker_ids
+        self.empty_brokers = empty_brokers
+        self.all_broker_ids = sorted(int(id_) for id_ in broker_ids)
+        self.broker_ids = sorted(int(id_) for id_ in broker_ids if id_ not in empty_brokers)
+        self.exclude_topics = exclude_topics
+        self.parallelism = create_parallelism(parallelism)
+        self.state = SizeRebalanceChange._LOAD_STATE
+        self.action_queue = None
+        self.plan_future = None
+        self.plan_snapshot = None
+        self.estimated_kb = None
+        # Planning data
+        self.broker_racks = None
+        self.sizes = None
+        self.source_distribution = None
+        self.distribution = None
+        self.broker_load = None
+        self.broker_partitions = None
+
+    def __str__(self):
+        return 'SizeRebalance state={}, queue_size={}, estimated_kb={}, parallelism={}'.format(
+            self.state, len(self.action_queue) if self.action_queue is not None else None, self.estimated_kb,
+            self.parallelism)
+
+    def get_remaining_actions(self):
+        if self.state != SizeRebalanceChange._BALANCE:
+            return None
+        return len(self.action_queue)
+
+    def run(self, current_actions) -> bool:
+        if self.should_be_paused(current_actions):
+            _LOG.warning("Rebalance paused, because other blocking events running: {}".format(current_actions))
+            return True
+        if self.zk.is_rebalancing():
+            return True
+        self.parallelism.batch_finished()
+        new_broker_ids = sorted(int(id_) for id_ in self.zk.get_broker_ids())
+        if new_broker_ids != self.all_broker_ids:
+            _LOG.warning("Rebalance stopped because of broker list change from {} to {}".format(
+                self.all_broker_ids, new_broker_ids))
+            return False
+        if self.state == SizeRebalanceChange._LOAD_STATE:
+            executor = get_planning_executor()
+            if executor is None:
+                self._set_plan(self.compute_plan())
+                self.state = SizeRebalanceChange._BALANCE
+            else:
+                self.plan_snapshot = ClusterSnapshot.load(self.zk, with_disk_stats=True)
+                _LOG.info('Submitting rebalance planning for {} to worker process'.format(self.plan_snapshot))
+                self.plan_future = submit_plan(partial(
+                    SizeRebalanceChange, broker_ids=self.initial_broker_ids, empty_brokers=self.empty_brokers,
+                    exclude_topics=self.exclude_topics), self.plan_snapshot)
+                if self.plan_future is not None:
+                    self.state = SizeRebalanceChange._WAIT_PLAN
+        elif self.state == SizeRebalanceChange._WAIT_PLAN:
+            if not self.plan_future.done():
+                return True
+            plan = get_plan(self.plan_future)
+            self.plan_future = None
+            if plan is None:
+                # Planning process died, plan is computed again on controller thread
+                self.state = SizeRebalanceChange._LOAD_STATE
+                return True
+            # Plan is estimated against the same data it was computed from, not against current state of zookeeper
+            self._load_source(self.plan_snapshot)
+            self.plan_snapshot = None
+            self._set_plan(plan)
+            self.state = SizeRebalanceChange._BALANCE
+        elif self.state == SizeRebalanceChange._BALANCE:
+            return not self._balance()
+        return True
+
+    def on_remove(self):
+        if self.plan_future is not None:
+            self.plan_future.cancel()
+        super().on_remove()
+
+    def compute_plan(self) -> dict:
+        """
+        Computes the whole reassignment plan.
+        :return: dictionary (topic, partition) -> new replica list
+        """
+        self._load_data()
+        self._move_from_inactive()
+        self._balance_sizes()
+        return {key: replicas for key, replicas in self.distribution.items()
+                if replicas != self.source_distribution[key]}
+
+    def _set_plan(self, plan: dict):
+        self.action_queue = plan
+        self.estimated_kb = estimate_transfer_kb(self.source_distribution, plan, self.sizes)
+        _LOG.info('Size rebalance plan: {} partitions to move, estimated data transfer is {} kb'.format(
+            len(plan), self.estimated_kb))
+
+    def _balance(self):
+        items = []
+        batch_size = self.parallelism.get()
+        while self.action_queue and len(items) < batch_size:
+            items.append(self.action_queue.popitem())
+        if not items:
+            return True
+        if self.zk.reallocate_partitions([(key[0], key[1], replicas) for key, replicas in items]):
+            self.parallelism.batch_started(len(items), estimate_transfer_kb(self.source_distribution, dict(items),
+                                                                            self.sizes))
+        else:
+            for key, replicas in items:
+                self.action_queue[key] = replicas
+        return False
+
+    def _load_source(self, source):
+        """
+        Loads current assignment and partition sizes
+        :param source: BukuExhibitor or ClusterSnapshot to load data from
+        """
+        self.broker_racks = source.get_broker_racks()
+        self.sizes = load_partition_sizes(source.get_disk_stats())
+        self.source_distribution = {(topic, partition): replicas for topic, partition, replicas in
+                                    source.load_partition_assignment() if topic not in self.exclude_topics}
+
+    def _load_data(self):
+        self._load_source(self.zk)
+        self.distribution = {key: list(replicas) for key, replicas in self.source_distribution.items()}
+        self.broker_load = {id_: 0 for id_ in self.broker_ids}
+        self.broker_partitions = {id_: [] for id_ in self.broker_ids}
+        missing = 0
+        for key, replicas in self.distribution.items():
+            if key not in self.sizes:
+                missing += 1
+            for replica in replicas:
+                if replica in self.broker_load:
+                    self._add(replica, key)
+        if missing:
+            _LOG.warning('No size statistics for {} partitions, they are treated as empty'.format(missing))
+
+    def _add(self, broker_id: int, key: tuple):
+        size = self.sizes.get(key, 0)
+        self.broker_load[broker_id] += size
+        bisect.insort(self.broker_partitions[broker_id], (size, key))
+
+    def _move(self, key: tuple, source: int, target: int):
+        replicas = self.distribution[key]
+        replicas[replicas.index(source)] = target
+        if source in self.broker_load:
+            size = self.sizes.get(key, 0)
+            self.broker_load[source] -= size
+            partitions = self.broker_partitions[source]
+            del partitions[bisect.bisect_left(partitions, (size, key))]
+        self._add(target, key)
+
+    def _rack_allowed(self, key: tuple, source: int, target: int) -> bool:
+        """
+        Checks that moving replica from source to target does not reduce rack diversity of partition
+        """
+        target_rack = self.broker_racks.get(target)
+        if target_rack == self.broker_racks.get(source):
+            return True
+        return all(self.broker_racks.get(r) != target_rack for r in self.distribution[key] if r != source)
+
+    def _move_from_inactive(self):
+        """
+        Moves replicas from emptied and dead brokers. The biggest partitions are placed first, each one to the least
+        loaded broker that keeps rack diversity.
+        """
+        to_move = [(self.sizes.get(key, 0), key) for key, replicas in self.distribution.items()
+                   if any(r not in self.broker_load for r in replicas)]
+        for _, key in sorted(to_move, reverse=True):
+            for source in [r for r in self.distribution[key] if r not in self.broker_load]:
+                candidates = [b for b in self.broker_ids if b not in self.distribution[key]]
+                if not candidates:
+                    raise Exception('Nowhere to move partition {} from broker {}'.format(key, source))
+                allowed = [b for b in candidates if self._rack_allowed(key, source, b)]
+                target = min(allowed or candidates, key=lambda b: (self.broker_load[b], b))
+                self._move(key, source, target)
+
+    def _balance_sizes(self):
+        """
+        Moves replicas from overloaded brokers until all of them are within threshold from average usage. Each move
+        strictly reduces the difference between source and target brokers, so the process always stops.
+        """
+        if not self.broker_ids:
+            return
+        average = sum(self.broker_load.values()) / len(self.broker_ids)
+        threshold = average * self._BALANCE_THRESHOLD
+        stuck = set()
+        while True:
+            sources = [b for b in self.broker_ids if b not in stuck and self.broker_load[b] - average > threshold]
+            if not sources:
+                return
+            source = max(sources, key=lambda b: (self.broker_load[b], b))
+            move = self._find_move(source, average)
+            if move is None:
+                stuck.add(source)
+                continue
+            key, target = move
+            self._move(key, source, target)
+            stuck.discard(target)
+
+    def _find_move(self, source: int, average: float):
+        """
+        Finds replica to move from source broker. Targets are checked starting from the least loaded one. For each
+        target the biggest partition that fits into the amount of data target is missing is preferred, otherwise the
+        smallest partition that still reduces the gap between brokers is taken.
+        :return: tuple (key, target) or None if there is no move that improves balance
+        """
+        partitions = self.broker_partitions[source]
+        for target in sorted(self.broker_ids, key=lambda b: (self.broker_load[b], b)):
+            if self.broker_load[target] >= average:
+                break
+            gap = self.broker_load[source] - self.broker_load[target]
+            need = min(self.broker_load[source] - average, average - self.broker_load[target])
+            # Sizes are integer, so it is the position of the first partition that is bigger than needed
+            fit = bisect.bisect_left(partitions, (int(need) + 1,))
+            for idx in range(fit - 1, -1, -1):
+                size, key = partitions[idx]
+                if size == 0:
+                    break
+                if self._can_move(key, source, target):
+                    return key, target
+            for idx in range(fit, len(partitions)):
+                size, key = partitions[idx]
+                if size >= gap:
+                    break
+                if self._can_move(key, source, target):
+                    return key, target
+        return None
+
+    def _can_move(self, key: tuple, source: int, target: int) -> bool:
+        return target not in self.distribution[key] and self._rack_allowed(key, source, target)
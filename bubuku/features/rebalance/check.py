@@ -44,5 +44,8 @@ class RebalanceOnBrokerListCheck(Check):
             return OptimizedRebalanceChange(self.zk, new_list, [], [])
         return None
 
+    def get_watched_paths(self) -> list:
+        return ['/brokers/ids']
+
     def __str__(self):
         return 'RebalanceOnBrokerListChange, cached list: {}'.format(self.old_broker_list)
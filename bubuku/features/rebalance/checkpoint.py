@@ -0,0 +1,107 @@
+import logging
+
+from kazoo.exceptions import NoNodeError
+
+from bubuku.zookeeper import BukuExhibitor
+
+_LOG = logging.getLogger('bubuku.features.rebalance.checkpoint')
+
+
+class PlanCheckpoint(object):
+    """
+    Persisted reassignment plan of a change, created from action. Plan is saved once it is computed, together with
+    its input: action, owning broker, broker list and replicas of each partition the plan was computed for. Plan is
+    resumed only if the input still matches the cluster, so resuming gives the same result as planning from scratch.
+    """
+
+    def __init__(self, zk: BukuExhibitor, action: dict, owner: str):
+        """
+        :param action: action data, that change was created from
+        :param owner: id of broker, that executes the change
+        """
+        self.zk = zk
+        self.action = action
+        self.owner = owner
+
+    def save(self, broker_ids: list, plan: list):
+        """
+        :param broker_ids: broker list, plan was computed for
+        :param plan: list of tuples (topic, partition, source replicas, target replicas), order is kept on load
+        """
+        topics = sorted(set(item[0] for item in plan))
+        topic_idx = {topic: idx for idx, topic in enumerate(topics)}
+        self.zk.save_plan_checkpoint({
+            'action': self.action,
+            'owner': self.owner,
+            'broker_ids': broker_ids,
+            'topics': topics,
+            'plan': [[topic_idx[topic], partition, source, target] for topic, partition, source, target in plan],
+        })
+        _LOG.info('Checkpoint with {} partitions to move saved for {}'.format(len(plan), self.action))
+
+    def load(self, broker_ids: list):
+        """
+        Loads remaining part of the plan. Partitions, that already have target replicas, are skipped.
+        :param broker_ids: current broker list
+        :return: list of tuples (topic, partition, source replicas, target replicas) or None if there is no checkpoint
+        or cluster doesn't match it anymore
+        """
+        data = self.zk.load_plan_checkpoint()
+        if data is None or data['action'] != self.action or data['owner'] != self.owner:
+            return None
+        if data['broker_ids'] != broker_ids:
+            _LOG.info('Checkpoint was saved for brokers {}, but current list is {}, ignoring it'.format(
+                data['broker_ids'], broker_ids))
+            return None
+        topics = data['topics']
+        result = get_remaining_plan(
+            self.zk, [(topics[idx], partition, source, target) for idx, partition, source, target in data['plan']])
+        if result is None:
+            _LOG.info('Cluster was changed since checkpoint was saved, ignoring it')
+            return None
+        _LOG.info('Resuming {} from checkpoint, {} of {} partitions left to move'.format(
+            self.action, len(result), len(data['plan'])))
+        return result
+
+    def remove(self):
+        self.zk.remove_plan_checkpoint()
+
+
+def get_remaining_plan(zk: BukuExhibitor, plan: list):
+    """
+    Checks that plan can be applied to current partition assignment. Partitions, that are being moved to target
+    replicas, are kept in the plan, so they are moved again if reassignment was interrupted.
+    :param plan: list of tuples (topic, partition, source replicas, target replicas)
+    :return: part of the plan, that is not applied yet, or None if assignment of some partition is neither source nor
+    target one
+    """
+    try:
+        current = {(topic, partition): replicas for topic, partition, replicas in
+                   zk.load_partition_assignment(sorted(set(item[0] for item in plan)))}
+    except NoNodeError:
+        _LOG.info('Some of topics from plan were removed')
+        return None
+    reassigning = zk.get_reassigning_partitions()
+    result = []
+    for topic, partition, source, target in plan:
+        replicas = current.get((topic, partition))
+        in_flight = reassigning.get((topic, partition))
+        if in_flight is not None and in_flight != target:
+            _LOG.info('{}:{} is being moved to {} instead of {}'.format(topic, partition, in_flight, target))
+            return None
+        if replicas == target and in_flight is None:
+            continue
+        # While partition is reassigned kafka keeps both old and new replicas in assignment
+        if replicas != source and in_flight is None and set(replicas or []) != set(source) | set(target):
+            _LOG.info('Assignment of {}:{} was changed from {} to {}'.format(topic, partition, source, replicas))
+            return None
+        result.append((topic, partition, source, target))
+    return result
+
+
+def load_owned_action(zk: BukuExhibitor, owner: str):
+    """
+    :return: action data of checkpoint owned by broker or None
+    """
+    data = zk.load_plan_checkpoint()
+    return data['action'] if data is not None and data['owner'] == owner else None
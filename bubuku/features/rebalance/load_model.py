@@ -0,0 +1,97 @@
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class LoadModel(object):
+    """
+    Keeps brokers ordered by load factor (leaders or replicas). Order is updated only on resort call, ties are
+    resolved using previous order (the same way as stable sort of previous order does).
+    Brokers are expected to have leader_count, replica_count, expected_leader_count and expected_replica_count.
+    """
+
+    def update(self, broker):
+        """
+        Notifies model that broker's leader or replica count has changed
+        """
+        raise NotImplementedError('Not implemented')
+
+    def resort(self, for_leader: bool):
+        raise NotImplementedError('Not implemented')
+
+    def iterate(self, for_leader: bool):
+        """
+        :return: iterable over brokers, sorted by load factor at the moment of last resort
+        """
+        raise NotImplementedError('Not implemented')
+
+    def most_loaded(self, for_leader: bool):
+        raise NotImplementedError('Not implemented')
+
+
+class ObjectLoadModel(LoadModel):
+    def __init__(self, brokers):
+        self.orders = {True: list(brokers), False: list(brokers)}
+
+    def update(self, broker):
+        pass
+
+    def resort(self, for_leader: bool):
+        self.orders[for_leader] = sorted(self.orders[for_leader], key=lambda x: x.get_load_factor(for_leader))
+
+    def iterate(self, for_leader: bool):
+        return self.orders[for_leader]
+
+    def most_loaded(self, for_leader: bool):
+        return self.orders[for_leader][-1]
+
+
+class ArrayLoadModel(LoadModel):
+    """
+    Load model with leader and replica counts and expectations kept in numpy arrays, so load factors are calculated
+    and sorted in vectorized manner.
+    """
+
+    def __init__(self, brokers):
+        self.brokers = list(brokers)
+        self.index = {id(b): idx for idx, b in enumerate(self.brokers)}
+        self.counts = {
+            True: numpy.array([b.leader_count for b in self.brokers], dtype=numpy.float64),
+            False: numpy.array([b.replica_count for b in self.brokers], dtype=numpy.float64),
+        }
+        self.expectations = {
+            True: numpy.array([b.expected_leader_count[1] for b in self.brokers], dtype=numpy.float64),
+            False: numpy.array([b.expected_replica_count[1] for b in self.brokers], dtype=numpy.float64),
+        }
+        self.orders = {True: numpy.arange(len(self.brokers)), False: numpy.arange(len(self.brokers))}
+
+    def update(self, broker):
+        idx = self.index.get(id(broker))
+        if idx is None:
+            return
+        self.counts[True][idx] = broker.leader_count
+        self.counts[False][idx] = broker.replica_count
+
+    def resort(self, for_leader: bool):
+        order = self.orders[for_leader]
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            load_factors = self.counts[for_leader][order] / self.expectations[for_leader][order]
+        # mergesort is stable, so brokers with the same load keep previous order
+        self.orders[for_leader] = order[numpy.argsort(load_factors, kind='mergesort')]
+
+    def iterate(self, for_leader: bool):
+        for idx in self.orders[for_leader]:
+            yield self.brokers[idx]
+
+    def most_loaded(self, for_leader: bool):
+        return self.brokers[self.orders[for_leader][-1]]
+
+
+def create_load_model(brokers) -> LoadModel:
+    """
+    Creates load model for brokers. Array based model is used if numpy is available.
+    """
+    if numpy is not None:
+        return ArrayLoadModel(brokers)
+    return ObjectLoadModel(brokers)
@@ -0,0 +1,102 @@
+import logging
+import time
+
+from bubuku.metrics import get_timings
+
+_LOG = logging.getLogger('bubuku.features.rebalance.parallelism')
+
+
+class Parallelism(object):
+    """
+    Fixed amount of partitions to reassign in a single step. Changes report batch start and finish, so subclasses
+    can adjust batch size.
+    """
+
+    def __init__(self, value: int):
+        self.value = value
+        self.batch_start = None
+        self.batch_size = None
+        self.batch_kb = None
+
+    def __str__(self):
+        return str(self.value)
+
+    def get(self) -> int:
+        return self.value
+
+    def batch_started(self, size: int, size_kb: int = None):
+        """
+        Called when reassignment of the batch was written to zookeeper
+        :param size: number of partitions in batch
+        :param size_kb: amount of data to copy, if known
+        """
+        self.batch_start = time.time()
+        self.batch_size = size
+        self.batch_kb = size_kb
+
+    def batch_finished(self):
+        """
+        Called each time when there is no reassignment in progress. Call without started batch is ignored.
+        """
+        if self.batch_start is None:
+            return
+        duration = max(time.time() - self.batch_start, 0.001)
+        self.batch_start = None
+        get_timings().update('reassignment', 'batch', duration)
+        self.adjust(duration)
+
+    def adjust(self, duration: float):
+        """
+        Called when started batch is completed
+        :param duration: time spent on batch reassignment in seconds
+        """
+        pass
+
+
+class AdaptiveParallelism(Parallelism):
+    """
+    Batch size that is changed depending on time needed to complete reassignment of the batch. Works the same way as
+    TCP congestion control: batch size is doubled while batches complete within target duration, after the first slow
+    batch it is halved and then grows by one partition per batch (AIMD).
+    """
+
+    def __init__(self, min_value: int, max_value: int, target_batch_s: float, initial: int = None):
+        super().__init__(max(min_value, min(max_value, initial if initial else min_value)))
+        self.min_value = min_value
+        self.max_value = max_value
+        self.target_batch_s = target_batch_s
+        self.threshold = max_value
+        self.throughput_kb_s = None
+
+    def __str__(self):
+        return 'adaptive({}, min={}, max={}, target={}s, throughput_kb_s={})'.format(
+            self.value, self.min_value, self.max_value, self.target_batch_s,
+            int(self.throughput_kb_s) if self.throughput_kb_s is not None else None)
+
+    def adjust(self, duration: float):
+        if self.batch_kb is not None:
+            self.throughput_kb_s = self.batch_kb / duration
+        old_value = self.value
+        if duration > self.target_batch_s:
+            self.value = max(self.min_value, self.value // 2)
+            self.threshold = self.value
+        elif self.batch_size >= self.value:
+            # Grow only if the whole batch was used, otherwise duration says nothing about bigger batches
+            if self.value < self.threshold:
+                self.value = min(self.threshold, self.value * 2)
+            else:
+                self.value += 1
+            self.value = min(self.max_value, self.value)
+        _LOG.info('Batch of {} partitions{} completed in {:.1f}s, parallelism changed from {} to {}'.format(
+            self.batch_size, ' ({} kb)'.format(self.batch_kb) if self.batch_kb is not None else '', duration,
+            old_value, self.value))
+
+
+def create_parallelism(value) -> Parallelism:
+    """
+    :param value: int or Parallelism instance
+    :return: Parallelism instance
+    """
+    if isinstance(value, Parallelism):
+        return value
+    return Parallelism(int(value))
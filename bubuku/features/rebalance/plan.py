@@ -0,0 +1,61 @@
+from bubuku.features.rebalance.change_size import estimate_transfer_kb, load_partition_sizes
+from bubuku.features.rebalance.planning import ClusterSnapshot
+
+_VERSION = 1
+
+
+def get_plan_summary(source: dict, plan: dict, sizes: dict) -> dict:
+    """
+    Calculates cost of reassignment plan
+    :param source: dictionary (topic, partition) -> current replica list
+    :param plan: dictionary (topic, partition) -> new replica list
+    :param sizes: dictionary (topic, partition) -> size_kb
+    :return: dictionary with amount of partitions to reassign, replicas to copy, leadership changes and estimated
+    size of data to copy
+    """
+    replica_moves = 0
+    leader_changes = 0
+    for key, replicas in plan.items():
+        current = source.get(key, [])
+        replica_moves += len([r for r in replicas if r not in current])
+        if current and replicas and current[0] != replicas[0]:
+            leader_changes += 1
+    return {
+        'partitions': len(plan),
+        'replica_moves': replica_moves,
+        'leader_changes': leader_changes,
+        'estimated_kb': estimate_transfer_kb(source, plan, sizes),
+    }
+
+
+def export_plan(snapshot: ClusterSnapshot, plan: dict, description: str) -> dict:
+    """
+    Converts plan computed on cluster snapshot to json, that can be submitted for execution later.
+    :param snapshot: cluster data plan was computed on
+    :param plan: dictionary (topic, partition) -> new replica list, as returned by compute_plan of changes
+    :param description: human readable description of the plan
+    :return: json-serializable dictionary
+    """
+    source = {(topic, partition): replicas for topic, partition, replicas in snapshot.assignment}
+    # Planners differ in types of partitions and broker ids
+    plan = {(topic, int(partition)): [int(r) for r in replicas] for (topic, partition), replicas in plan.items()}
+    plan = {key: replicas for key, replicas in plan.items() if replicas != source.get(key)}
+    return {
+        'version': _VERSION,
+        'description': description,
+        'brokers': sorted(int(id_) for id_ in snapshot.broker_ids),
+        'summary': get_plan_summary(source, plan, load_partition_sizes(snapshot.get_disk_stats())),
+        'partitions': [{'topic': topic, 'partition': partition, 'source': source[(topic, partition)],
+                        'replicas': replicas} for (topic, partition), replicas in sorted(plan.items())],
+    }
+
+
+def import_plan(data: dict) -> list:
+    """
+    Restores plan exported with export_plan
+    :return: list of tuples (topic, partition, source replicas, target replicas)
+    """
+    if data.get('version') != _VERSION:
+        raise ValueError('Plan version {} is not supported'.format(data.get('version')))
+    return [(item['topic'], int(item['partition']), [int(r) for r in item['source']],
+             [int(r) for r in item['replicas']]) for item in data['partitions']]
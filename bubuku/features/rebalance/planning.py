@@ -0,0 +1,125 @@
+import logging
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+_LOG = logging.getLogger('bubuku.features.rebalance.planning')
+
+_PLANNING_EXECUTOR = None
+
+
+class ClusterSnapshot(object):
+    """
+    Read-only copy of cluster data that is needed for rebalance planning. Implements subset of BukuExhibitor
+    interface, so planners can work on it instead of zookeeper (for example in separate process).
+    """
+
+    def __init__(self, broker_ids: list, broker_racks: dict, assignment: list, disk_stats: dict = None):
+        self.broker_ids = broker_ids
+        self.broker_racks = broker_racks
+        self.assignment = assignment
+        self.disk_stats = disk_stats
+
+    @staticmethod
+    def load(zk, with_disk_stats: bool = False) -> 'ClusterSnapshot':
+        return ClusterSnapshot(
+            list(zk.get_broker_ids()),
+            dict(zk.get_broker_racks()),
+            [(topic, partition, list(replicas)) for topic, partition, replicas in zk.load_partition_assignment()],
+            zk.get_disk_stats() if with_disk_stats else None)
+
+    def __str__(self):
+        return 'ClusterSnapshot(brokers={}, partitions={})'.format(len(self.broker_ids), len(self.assignment))
+
+    def get_broker_ids(self) -> list:
+        return list(self.broker_ids)
+
+    def get_broker_racks(self) -> dict:
+        return dict(self.broker_racks)
+
+    def load_partition_assignment(self, topics=None) -> list:
+        return [(topic, partition, list(replicas)) for topic, partition, replicas in self.assignment
+                if topics is None or topic in topics]
+
+    def get_disk_stats(self) -> dict:
+        return dict(self.disk_stats) if self.disk_stats else {}
+
+    def is_rebalancing(self) -> bool:
+        return False
+
+
+def start_planning_process():
+    """
+    Starts worker process for rebalance planning. Worker process is forked right away, so it must be called before
+    any other threads are started in daemon.
+    """
+    global _PLANNING_EXECUTOR
+    if _PLANNING_EXECUTOR is None:
+        _LOG.info('Starting rebalance planning process')
+        executor = ProcessPoolExecutor(max_workers=1)
+        executor.submit(int).result()
+        set_planning_executor(executor)
+
+
+def set_planning_executor(executor: Executor):
+    global _PLANNING_EXECUTOR
+    _PLANNING_EXECUTOR = executor
+
+
+def get_planning_executor() -> Executor:
+    """
+    :return: Executor to run rebalance planning on, or None if planning should be done on controller thread
+    """
+    return _PLANNING_EXECUTOR
+
+
+def compute_plan(change_factory, snapshot: ClusterSnapshot):
+    """
+    Creates change on top of cluster snapshot and computes its reassignment plan. Executed in worker process.
+    :param change_factory: picklable function that creates change from zk-like object
+    :param snapshot: cluster data to plan on
+    :return: reassignment queue computed by change
+    """
+    return change_factory(snapshot).compute_plan()
+
+
+def _drop_broken_executor(executor: Executor):
+    # Worker process can't be safely forked again once daemon threads are running, so planning falls back to
+    # controller thread
+    _LOG.error('Rebalance planning process is broken, planning will be done on controller thread')
+    if get_planning_executor() is executor:
+        set_planning_executor(None)
+    executor.shutdown(wait=False)
+
+
+def submit_plan(change_factory, snapshot: ClusterSnapshot) -> Future:
+    """
+    Submits computation of reassignment plan to worker process
+    :param change_factory: picklable function that creates change from zk-like object
+    :param snapshot: cluster data to plan on
+    :return: future with result of compute_plan, or None if there is no working planning process and plan should be
+    computed on controller thread
+    """
+    executor = get_planning_executor()
+    if executor is None:
+        return None
+    try:
+        return executor.submit(compute_plan, change_factory, snapshot)
+    except BrokenProcessPool:
+        _drop_broken_executor(executor)
+        return None
+
+
+def get_plan(future: Future):
+    """
+    Takes result of planning submitted with submit_plan
+    :param future: completed future returned by submit_plan
+    :return: reassignment queue computed by change, or None if planning process died and plan should be computed on
+    controller thread
+    """
+    try:
+        return future.result()
+    except BrokenProcessPool:
+        executor = get_planning_executor()
+        if executor is not None:
+            _drop_broken_executor(executor)
+        return None
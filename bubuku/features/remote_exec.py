@@ -4,13 +4,27 @@ from bubuku.broker import BrokerManager
 from bubuku.controller import Check, Change
 from bubuku.features.migrate import MigrationChange
 from bubuku.features.rebalance.change import OptimizedRebalanceChange
+from bubuku.features.rebalance.change_planned import PlannedReassignmentChange
 from bubuku.features.rebalance.change_simple import SimpleRebalanceChange
+from bubuku.features.rebalance.change_size import SizeRebalanceChange
+from bubuku.features.rebalance.checkpoint import PlanCheckpoint, get_remaining_plan, load_owned_action
+from bubuku.features.rebalance.parallelism import AdaptiveParallelism, Parallelism
 from bubuku.features.restart_on_zk_change import RestartBrokerChange
 from bubuku.features.swap_partitions import SwapPartitionsChange, load_swap_data
 from bubuku.zookeeper import BukuExhibitor
+from bubuku.zookeeper.action_queue import get_action_hash
 
 _LOG = logging.getLogger('bubuku.features.remote_exec')
 
+# Priority classes of actions, short actions are not waiting behind long ones
+_PRIORITIES = {
+    'restart': 0,
+    'migrate': 1,
+    'rebalance': 2,
+    'reassign': 2,
+    'fatboyslim': 3,
+}
+
 
 class RemoteCommandExecutorCheck(Check):
     def __init__(self, zk: BukuExhibitor, broker_manager: BrokerManager, api_port):
@@ -18,12 +32,23 @@ class RemoteCommandExecutorCheck(Check):
         self.zk = zk
         self.broker_manager = broker_manager
         self.api_port = api_port
+        self.resume_checked = False
 
     def check(self) -> Change:
-        with self.zk.lock():
-            data = self.zk.take_action(self.broker_manager.id_manager.get_broker_id())
+        broker_id = self.broker_manager.id_manager.get_broker_id()
+        if not self.resume_checked:
+            self.resume_checked = True
+            # Action, that was interrupted by restart, is continued from its checkpoint
+            data = load_owned_action(self.zk, broker_id)
+            if data:
+                _LOG.info('Found checkpoint of action {}, restoring it'.format(data))
+                return self._create_change(data, broker_id)
+        data = self.zk.take_action(broker_id)
         if not data:
             return None
+        return self._create_change(data, broker_id)
+
+    def _create_change(self, data: dict, broker_id: str) -> Change:
         if 'name' not in data:
             _LOG.error('Action name can not be restored from {}, skipping'.format(data))
             return None
@@ -31,21 +56,31 @@ class RemoteCommandExecutorCheck(Check):
             if data['name'] == 'restart':
                 return RestartBrokerChange(self.zk, self.broker_manager, lambda: False)
             elif data['name'] == 'rebalance':
-                if data.get('bin_packing', False):
+                if data.get('size_aware', False):
+                    return SizeRebalanceChange(self.zk,
+                                               self.zk.get_broker_ids(),
+                                               data['empty_brokers'],
+                                               data['exclude_topics'],
+                                               _create_parallelism(data))
+                elif data.get('bin_packing', False):
                     return OptimizedRebalanceChange(self.zk,
                                                     self.zk.get_broker_ids(),
                                                     data['empty_brokers'],
                                                     data['exclude_topics'],
-                                                    int(data.get('parallelism', 1)))
+                                                    _create_parallelism(data),
+                                                    PlanCheckpoint(self.zk, data, broker_id))
                 else:
                     return SimpleRebalanceChange(self.zk,
                                                  self.zk.get_broker_ids(),
                                                  data['empty_brokers'],
                                                  data['exclude_topics'],
-                                                 int(data.get('parallelism', 1)))
+                                                 _create_parallelism(data))
             elif data['name'] == 'migrate':
-                return MigrationChange(self.zk, data['from'], data['to'], data['shrink'],
-                                       int(data.get('parallelism', '1')))
+                return MigrationChange(self.zk, data['from'], data['to'], data['shrink'], _create_parallelism(data),
+                                       PlanCheckpoint(self.zk, data, broker_id))
+            elif data['name'] == 'reassign':
+                return PlannedReassignmentChange(self.zk, data['plan_id'], _create_parallelism(data),
+                                                 PlanCheckpoint(self.zk, data, broker_id))
             elif data['name'] == 'fatboyslim':
                 return SwapPartitionsChange(self.zk,
                                             lambda x: load_swap_data(x, self.api_port, int(data['threshold_kb'])))
@@ -55,35 +90,42 @@ class RemoteCommandExecutorCheck(Check):
             _LOG.error('Failed to create action from {}'.format(data), exc_info=e)
         return None
 
+    def get_watched_paths(self) -> list:
+        broker_id = self.broker_manager.id_manager.get_broker_id()
+        # Broker id is not known until kafka is started for the first time, its actions are watched after that
+        if broker_id is None:
+            return ['/bubuku/actions/global']
+        return ['/bubuku/actions/global', '/bubuku/actions/{}'.format(broker_id)]
+
     def __str__(self):
         return 'RemoteCommandExecutorCheck'
 
     @staticmethod
     def register_restart(zk: BukuExhibitor, broker_id: str):
-        with zk.lock():
-            zk.register_action(
-                {'name': 'restart'},
-                broker_id=broker_id)
+        _register_action(zk, {'name': 'restart'}, broker_id)
 
     @staticmethod
     def register_rebalance(zk: BukuExhibitor, broker_id: str, empty_brokers: list, exclude_topics: list,
-                           parallelism: int, bin_packing: bool):
+                           parallelism: int, bin_packing: bool, size_aware: bool = False, adaptive: dict = None):
         if parallelism <= 0:
             raise Exception('Parallelism for rebalance should be greater than 0')
+        _validate_adaptive(parallelism, adaptive)
+        if bin_packing and size_aware:
+            raise Exception('Bin packing and size aware rebalance can not be used together')
         action = {'name': 'rebalance',
                   'empty_brokers': empty_brokers,
                   'exclude_topics': exclude_topics,
                   'parallelism': int(parallelism),
                   'bin_packing': bool(bin_packing)}
-        with zk.lock():
-            if broker_id:
-                zk.register_action(action, broker_id=broker_id)
-            else:
-                zk.register_action(action)
+        if size_aware:
+            action['size_aware'] = True
+        if adaptive:
+            action['adaptive_parallelism'] = adaptive
+        _register_action(zk, action, broker_id)
 
     @staticmethod
     def register_migration(zk: BukuExhibitor, brokers_from: list, brokers_to: list, shrink: bool, broker_id: str,
-                           parallelism: int):
+                           parallelism: int, adaptive: dict = None):
         if len(brokers_from) != len(brokers_to):
             raise Exception('Brokers list {} and {} must have the same size'.format(brokers_from, brokers_to))
         if any(b in brokers_from for b in brokers_to) or any(b in brokers_to for b in brokers_from):
@@ -103,19 +145,77 @@ class RemoteCommandExecutorCheck(Check):
                 broker_id, active_ids))
         if parallelism <= 0:
             raise Exception('Parallelism for migration should be greater than 0')
+        _validate_adaptive(parallelism, adaptive)
 
-        with zk.lock():
-            action = {'name': 'migrate', 'from': brokers_from, 'to': brokers_to, 'shrink': bool(shrink),
-                      'parallelism': int(parallelism)}
-            if broker_id:
-                zk.register_action(action, str(broker_id))
-            else:
-                zk.register_action(action)
+        action = {'name': 'migrate', 'from': brokers_from, 'to': brokers_to, 'shrink': bool(shrink),
+                  'parallelism': int(parallelism)}
+        if adaptive:
+            action['adaptive_parallelism'] = adaptive
+        _register_action(zk, action, str(broker_id) if broker_id else None)
+
+    @staticmethod
+    def register_reassignment(zk: BukuExhibitor, plan: list, broker_id: str, parallelism: int,
+                              adaptive: dict = None) -> int:
+        """
+        Submits reassignment plan computed in advance for execution.
+        :param plan: list of tuples (topic, partition, source replicas, target replicas)
+        :return: amount of partitions to move
+        """
+        if parallelism <= 0:
+            raise Exception('Parallelism for reassignment should be greater than 0')
+        _validate_adaptive(parallelism, adaptive)
+        active_ids = zk.get_broker_ids()
+        missing = sorted(set(b for _, _, _, target in plan for b in target if str(b) not in active_ids))
+        if missing:
+            raise Exception('Brokers {} from plan are not in active list {}'.format(missing, active_ids))
+        if broker_id and str(broker_id) not in active_ids:
+            raise Exception('Broker id to run change on ({}) is not in active list {}'.format(broker_id, active_ids))
+        remaining = get_remaining_plan(zk, plan)
+        if remaining is None:
+            raise Exception('Partition assignment was changed since plan was computed, please compute it again')
+        if not remaining:
+            _LOG.info('Plan is already applied, nothing to submit')
+            return 0
+        plan_id = get_action_hash({'plan': remaining})
+        zk.save_reassignment_plan(plan_id, remaining)
+        action = {'name': 'reassign', 'plan_id': plan_id, 'parallelism': int(parallelism)}
+        if adaptive:
+            action['adaptive_parallelism'] = adaptive
+        _register_action(zk, action, str(broker_id) if broker_id else None)
+        return len(remaining)
 
     @staticmethod
     def register_fatboy_slim(zk: BukuExhibitor, threshold_kb: int):
         if zk.is_rebalancing():
             _LOG.warning('Rebalance is already in progress, may be it will take time for this command to start '
                          'processing')
-        with zk.lock():
-            zk.register_action({'name': 'fatboyslim', 'threshold_kb': threshold_kb})
+        _register_action(zk, {'name': 'fatboyslim', 'threshold_kb': threshold_kb}, None)
+
+
+def _register_action(zk: BukuExhibitor, action: dict, broker_id):
+    # Identical pending actions would repeat the same work, so they are registered once
+    if not zk.register_action(action, broker_id=broker_id or 'global', priority=_PRIORITIES[action['name']],
+                              deduplicate=True):
+        _LOG.warning('Identical action {} is already waiting to be executed'.format(action))
+
+
+def _validate_adaptive(parallelism: int, adaptive: dict):
+    if not adaptive:
+        return
+    if adaptive['max_parallelism'] < parallelism:
+        raise Exception('Maximum parallelism {} should not be less than parallelism {}'.format(
+            adaptive['max_parallelism'], parallelism))
+    if adaptive['target_batch_s'] <= 0:
+        raise Exception('Target batch duration should be greater than 0')
+
+
+def _create_parallelism(data: dict) -> Parallelism:
+    """
+    Creates batch size control for action. Parallelism from action is used as fixed value or, if adaptive
+    parallelism is requested, as minimal and initial value.
+    """
+    parallelism = int(data.get('parallelism', 1))
+    adaptive = data.get('adaptive_parallelism')
+    if not adaptive:
+        return Parallelism(parallelism)
+    return AdaptiveParallelism(parallelism, int(adaptive['max_parallelism']), float(adaptive['target_batch_s']))
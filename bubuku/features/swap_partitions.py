@@ -30,48 +30,64 @@ class SwapPartitionsChange(BaseRebalanceChange):
             return True
 
         if self.to_move is None:
-            slim_broker_id, fat_broker_id, gap, size_stats = self.swap_data_provider(self.zk)
-            if slim_broker_id is None:
-                _LOG.info('Can not find slim broker and fat broker during reassignment. Probably gap changed')
+            self.to_move = self.__find_swap()
+            if self.to_move is None:
                 return False
-            # merge topics size stats to a single dict
-            topics_stats = {}
-            for broker_stats in size_stats.values():
-                for topic in broker_stats["topics"].keys():
-                    if topic not in topics_stats:
-                        topics_stats[topic] = {}
-                    topics_stats[topic].update(broker_stats["topics"][topic])
-
-            # find partitions that are candidates to be swapped between "fat" and "slim" brokers
-            swap_partition_candidates = self.__find_all_swap_candidates(fat_broker_id, slim_broker_id, topics_stats)
-
-            # smallest partition from slim broker is the one we move to fat broker
-            slim_broker_smallest_partition = min(swap_partition_candidates[slim_broker_id], key=attrgetter("size"))
-            if not slim_broker_smallest_partition:
-                _LOG.info("No partitions on slim broker(id: {}) found to swap".format(slim_broker_id))
-                return False
-            _LOG.info("Slim broker(id: {}) partition to swap: {}".format(
-                slim_broker_id, slim_broker_smallest_partition))
-
-            # find the best fitting fat broker partition to move to slim broker
-            # (should be as much as possible closing the gap between brokers)
-            fat_broker_swap_candidates = swap_partition_candidates[fat_broker_id]
-            matching_swap_partition = self.__find_best_swap_candidate(fat_broker_swap_candidates, gap,
-                                                                      slim_broker_smallest_partition.size)
-
-            # if there is no possible swap that will decrease the gap - just do nothing
-            if not matching_swap_partition:
-                _LOG.info("No candidate from fat broker(id:{}) found to swap".format(fat_broker_id))
-                return False
-            _LOG.info("Fat broker(id: {}) partition to swap: {}".format(fat_broker_id, matching_swap_partition))
-            # write rebalance-json to ZK; Kafka will read it and perform the partitions swap
-            self.to_move = self.__create_rebalance_list(slim_broker_smallest_partition, slim_broker_id,
-                                                        matching_swap_partition, fat_broker_id)
 
         # if there is already a swap which was postponed - just execute it
         return not self.__perform_swap(self.to_move)
 
+    def compute_plan(self) -> dict:
+        """
+        Finds partitions to swap without performing the swap.
+        :return: dictionary (topic, partition) -> new replica list
+        """
+        to_move = self.__find_swap()
+        return {(topic, partition): replicas for topic, partition, replicas in to_move} if to_move else {}
+
+    def __find_swap(self):
+        """
+        :return: list of tuples (topic, partition, new replica list) to swap or None, if swap is not needed
+        """
+        slim_broker_id, fat_broker_id, gap, size_stats = self.swap_data_provider(self.zk)
+        if slim_broker_id is None:
+            _LOG.info('Can not find slim broker and fat broker during reassignment. Probably gap changed')
+            return None
+        # merge topics size stats to a single dict
+        topics_stats = {}
+        for broker_stats in size_stats.values():
+            for topic in broker_stats["topics"].keys():
+                if topic not in topics_stats:
+                    topics_stats[topic] = {}
+                topics_stats[topic].update(broker_stats["topics"][topic])
+
+        # find partitions that are candidates to be swapped between "fat" and "slim" brokers
+        swap_partition_candidates = self.__find_all_swap_candidates(fat_broker_id, slim_broker_id, topics_stats)
+
+        # smallest partition from slim broker is the one we move to fat broker
+        slim_broker_smallest_partition = min(swap_partition_candidates[slim_broker_id], key=attrgetter("size"))
+        if not slim_broker_smallest_partition:
+            _LOG.info("No partitions on slim broker(id: {}) found to swap".format(slim_broker_id))
+            return None
+        _LOG.info("Slim broker(id: {}) partition to swap: {}".format(
+            slim_broker_id, slim_broker_smallest_partition))
+
+        # find the best fitting fat broker partition to move to slim broker
+        # (should be as much as possible closing the gap between brokers)
+        fat_broker_swap_candidates = swap_partition_candidates[fat_broker_id]
+        matching_swap_partition = self.__find_best_swap_candidate(fat_broker_swap_candidates, gap,
+                                                                  slim_broker_smallest_partition.size)
+
+        # if there is no possible swap that will decrease the gap - just do nothing
+        if not matching_swap_partition:
+            _LOG.info("No candidate from fat broker(id:{}) found to swap".format(fat_broker_id))
+            return None
+        _LOG.info("Fat broker(id: {}) partition to swap: {}".format(fat_broker_id, matching_swap_partition))
+        return self.__create_rebalance_list(slim_broker_smallest_partition, slim_broker_id,
+                                            matching_swap_partition, fat_broker_id)
+
     def __perform_swap(self, rebalance_list):
+        # write rebalance-json to ZK; Kafka will read it and perform the partitions swap
         _LOG.info("Writing rebalance-json to ZK for partitions swap: {}".format(rebalance_list))
         return self.zk.reallocate_partitions(rebalance_list)
 
@@ -130,7 +146,7 @@ def _load_disk_stats(zk: BukuExhibitor, api_port: int):
     result = {}
     for broker_id, value in size_stats.items():
         try:
-            if api_port != -1:  # For unit tests only
+            if api_port != -1:  # Disk stats from zookeeper are used otherwise (unit tests and offline planning)
                 host = zk.get_broker_address(broker_id)
                 tmp = requests.get(
                     'http://{}:{}/api/disk_stats'.format(host, api_port),
@@ -189,7 +205,7 @@ def select_fat_slim_brokers(zk: BukuExhibitor, sorted_stats: list):
 
 class CheckBrokersDiskImbalance(Check):
     def __init__(self, zk: BukuExhibitor, broker: BrokerManager, diff_threshold_kb: int, api_port: int):
-        super().__init__(check_interval_s=900)
+        super().__init__(check_interval_s=900, background=True, timeout_s=120)
         self.zk = zk
         self.api_port = api_port
         self.broker = broker
@@ -3,9 +3,11 @@ import logging
 import threading
 from functools import partial
 from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
 
 from bubuku.communicate import execute_on_controller_thread
 from bubuku.controller import Controller
+from bubuku.metrics import get_timings, format_prometheus
 from bubuku.utils import CmdHelper
 
 _CONTROLLER_TIMEOUT = 5
@@ -32,6 +34,8 @@ class _Handler(BaseHTTPRequestHandler):
         if self.path in ('/api/disk_stats', '/api/disk_stats/'):
             used_kb, free_kb = self.cmd_helper.get_disk_stats()
             self._send_response({'free_kb': free_kb, 'used_kb': used_kb})
+        elif self.path == '/metrics':
+            self._send_text(format_prometheus(), 'text/plain; version=0.0.4')
         elif self.path.startswith(_API_CONTROLLER):
             self.wrap_controller_execution(lambda: self._run_controller_action(self.path[len(_API_CONTROLLER):]))
         else:
@@ -58,11 +62,20 @@ class _Handler(BaseHTTPRequestHandler):
             return self._send_response({'message': 'Action {} is not supported'.format(action[0])}, 404)
 
     def _run_controller_action(self, action):
-        if action.split('/')[0] == 'queue':
+        if action.split('/')[0] == 'metrics':
+            # Timings are thread-safe, so they are available even when controller thread is busy
+            return self._send_response(get_timings().snapshot(), 200)
+        elif action.split('/')[0] == 'queue':
             return self._send_response(execute_on_controller_thread(load_controller_queue, _CONTROLLER_TIMEOUT), 200)
         else:
             return self._send_response({'message': 'Action {} is not supported'.format(action)}, 404)
 
+    def _send_text(self, text, content_type, status_code=200):
+        self.send_response(status_code)
+        self.send_header('Content-type', content_type)
+        self.end_headers()
+        self.wfile.write(text.encode('utf-8'))
+
     def _send_response(self, json_, status_code=200):
         self.send_response(status_code)
         self.send_header('Content-type', 'application/json')
@@ -70,10 +83,15 @@ class _Handler(BaseHTTPRequestHandler):
         self.wfile.write(json.dumps(json_).encode('utf-8'))
 
 
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    # Each request is served in separate thread, so slow requests are not blocking the others
+    daemon_threads = True
+
+
 def start_server(port, cmd_helper: CmdHelper) -> threading.Thread:
     def _thread_func():
         _Handler.cmd_helper = cmd_helper
-        server = HTTPServer(('', port), _Handler)
+        server = _ThreadingHTTPServer(('', port), _Handler)
         server.serve_forever()
         server.socket.close()
 
@@ -0,0 +1,162 @@
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+_LOG = logging.getLogger('bubuku.metrics')
+
+
+def _percentile(sorted_values: list, percentile: float):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * percentile))]
+
+
+class RollingHistogram(object):
+    """
+    Distribution of recent values. Percentiles and max are calculated over last window_size values, while count and
+    sum are accumulated over the whole lifetime.
+    """
+
+    def __init__(self, window_size: int = 1000):
+        self.values = deque(maxlen=window_size)
+        self.count = 0
+        self.sum = 0.
+
+    def update(self, value: float):
+        self.values.append(value)
+        self.count += 1
+        self.sum += value
+
+    def snapshot(self) -> dict:
+        values = sorted(self.values)
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'p50': _percentile(values, 0.5),
+            'p99': _percentile(values, 0.99),
+            'max': values[-1] if values else None,
+        }
+
+
+class Timings(object):
+    """
+    Thread-safe collection of duration histograms, grouped by category (check, change, lock, ...) and name.
+    """
+
+    def __init__(self, slow_threshold_s: float = None, window_size: int = 1000):
+        """
+        :param slow_threshold_s: durations longer than that are logged, None disables logging
+        :param window_size: amount of recent values used to calculate percentiles
+        """
+        self.slow_threshold_s = slow_threshold_s
+        self.window_size = window_size
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def update(self, category: str, name: str, duration_s: float):
+        with self.lock:
+            key = (category, name)
+            if key not in self.histograms:
+                self.histograms[key] = RollingHistogram(self.window_size)
+            self.histograms[key].update(duration_s)
+        if self.slow_threshold_s is not None and duration_s > self.slow_threshold_s:
+            _LOG.warning('Slow {} {}: took {:.3f}s, threshold is {}s'.format(
+                category, name, duration_s, self.slow_threshold_s))
+
+    @contextmanager
+    def measure(self, category: str, name: str):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.update(category, name, time.time() - start)
+
+    def snapshot(self) -> dict:
+        """
+        :return: dictionary category -> name -> dictionary with keys count, sum, p50, p99, max (in seconds)
+        """
+        with self.lock:
+            items = [(key, histogram.snapshot()) for key, histogram in self.histograms.items()]
+        result = {}
+        for (category, name), data in items:
+            result.setdefault(category, {})[name] = data
+        return result
+
+
+_TIMINGS = Timings()
+
+
+def get_timings() -> Timings:
+    """
+    :return: process-wide timings, used by controller and exposed by health server
+    """
+    return _TIMINGS
+
+
+_GAUGES = {}  # Holds mapping from metric name to tuple (description, label, callback)
+
+
+def register_gauge(name: str, description: str, callback, label: str = None):
+    """
+    Registers gauge, that is evaluated on each metrics request. Gauge with the same name is replaced.
+    :param name: metric name in prometheus format
+    :param description: metric description
+    :param callback: function without arguments, returning number (or None if value is unknown). If label is set,
+    function should return dictionary label value -> number
+    :param label: name of the label
+    """
+    _GAUGES[name] = (description, label, callback)
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value) -> str:
+    return repr(float(value))
+
+
+def format_prometheus(timings: Timings = None) -> str:
+    """
+    Renders timings as summaries and registered gauges in prometheus text exposition format
+    :param timings: timings to render, process-wide timings by default
+    :return: text to be served by /metrics endpoint
+    """
+    if timings is None:
+        timings = get_timings()
+    lines = []
+    for category, histograms in sorted(timings.snapshot().items()):
+        metric = 'bubuku_{}_duration_seconds'.format(category)
+        lines.append('# HELP {} Duration of {} operations'.format(metric, category))
+        lines.append('# TYPE {} summary'.format(metric))
+        for name, data in sorted(histograms.items()):
+            for quantile, key in (('0.5', 'p50'), ('0.99', 'p99')):
+                value = data[key]
+                if value is not None:
+                    lines.append('{}{{name="{}",quantile="{}"}} {}'.format(
+                        metric, _escape(name), quantile, _format_value(value)))
+            lines.append('{}_sum{{name="{}"}} {}'.format(metric, _escape(name), _format_value(data['sum'])))
+            lines.append('{}_count{{name="{}"}} {}'.format(metric, _escape(name), data['count']))
+        lines.append('# HELP {}_max Maximum recent duration of {} operations'.format(metric, category))
+        lines.append('# TYPE {}_max gauge'.format(metric))
+        for name, data in sorted(histograms.items()):
+            if data['max'] is not None:
+                lines.append('{}_max{{name="{}"}} {}'.format(metric, _escape(name), _format_value(data['max'])))
+    for name, (description, label, callback) in sorted(_GAUGES.items()):
+        try:
+            value = callback()
+        except Exception as e:
+            _LOG.warning('Failed to evaluate gauge {}'.format(name), exc_info=e)
+            continue
+        lines.append('# HELP {} {}'.format(name, description))
+        lines.append('# TYPE {} gauge'.format(name))
+        if label is None:
+            if value is not None:
+                lines.append('{} {}'.format(name, _format_value(value)))
+        else:
+            for label_value, item in sorted(value.items()):
+                if item is not None:
+                    lines.append('{}{{{}="{}"}} {}'.format(name, label, _escape(label_value), _format_value(item)))
+    return '\n'.join(lines) + '\n'
@@ -1,12 +1,73 @@
+import os
 import subprocess
+import threading
+import time
+
+
+def _get_existing_path(path: str) -> str:
+    # Log directory may be not created yet, in this case the file system it will be created on is used
+    path = os.path.abspath(path)
+    while not os.path.exists(path) and os.path.dirname(path) != path:
+        path = os.path.dirname(path)
+    return path
+
+
+def get_statvfs_disk_stats(paths: list) -> (int, int):
+    """
+    Calculates disk stats of file systems holding paths. Each file system is counted once, even if several paths
+    are located on it.
+    :param paths: list of directories
+    :return: used_kb, free_kb
+    """
+    total_used = total_free = 0
+    devices = set()
+    for path in paths:
+        path = _get_existing_path(path)
+        device = os.stat(path).st_dev
+        if device in devices:
+            continue
+        devices.add(device)
+        stat = os.statvfs(path)
+        # The same numbers as shown by df: used excludes reserved blocks, free is available for unprivileged users
+        total_used += (stat.f_blocks - stat.f_bfree) * stat.f_frsize // 1024
+        total_free += stat.f_bavail * stat.f_frsize // 1024
+    return total_used, total_free
 
 
 class CmdHelper(object):
+    def __init__(self, disk_stats_ttl_s: float = 5):
+        """
+        :param disk_stats_ttl_s: time to cache disk stats of log directories for
+        """
+        self.log_dirs = None
+        self.disk_stats_ttl_s = disk_stats_ttl_s
+        self.disk_stats = None
+        self.disk_stats_timestamp = 0
+        self.disk_stats_lock = threading.Lock()
+
+    def set_log_dirs(self, log_dirs: list):
+        """
+        Limits disk stats to file systems holding kafka log directories
+        """
+        with self.disk_stats_lock:
+            self.log_dirs = [d.strip() for d in log_dirs if d.strip()]
+            self.disk_stats = None
+
     def get_disk_stats(self) -> (int, int):
         """
-        Returns total disk stats,
+        Returns total disk stats, for file systems with kafka log directories if they are set, for all the mounted file
+        systems otherwise.
         :return: used_kb, free_kb
         """
+        if not self.log_dirs:
+            return self._get_df_disk_stats()
+        with self.disk_stats_lock:
+            if self.disk_stats is None or time.time() - self.disk_stats_timestamp > self.disk_stats_ttl_s:
+                self.disk_stats = get_statvfs_disk_stats(self.log_dirs)
+                self.disk_stats_timestamp = time.time()
+            return self.disk_stats
+
+    def _get_df_disk_stats(self) -> (int, int):
         disks = self.cmd_run("df -k | tail -n +2 |  awk '{ print $3, $4 }'").split("\n")
         total_used = total_free = 0
         for disk in disks:
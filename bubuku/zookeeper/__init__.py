@@ -2,15 +2,26 @@ import json
 import logging
 import threading
 import time
-import uuid
+from collections import deque
 
 from typing import Dict
 
 from kazoo.client import KazooClient
-from kazoo.exceptions import NodeExistsError, NoNodeError, ConnectionLossException
+from kazoo.exceptions import NodeExistsError, NoNodeError, ConnectionLossException, BadVersionError
+
+from bubuku.metrics import get_timings, register_gauge
+from bubuku.zookeeper.action_queue import ActionQueue, DEFAULT_PRIORITY
+from bubuku.zookeeper.cache import PartitionAssignmentCache, PartitionStateIndex
+from bubuku.zookeeper.chunked import delete_chunked, read_chunked, write_chunked
+from bubuku.zookeeper.size_stats import DiskStatsWriter, read_disk_stats, get_delta_path
+from bubuku.zookeeper.throttle import ReassignmentThrottle
 
 _LOG = logging.getLogger('bubuku.exhibitor')
 
+# Amount of asynchronous requests that are kept in flight by pipelined reads
+_PIPELINE_WINDOW = 64
+_PLAN_CHECKPOINT_PATH = '/bubuku/plan_checkpoint'
+
 
 class WaitingCounter(object):
     def __init__(self, limit=100):
@@ -88,11 +99,14 @@ class _ZookeeperProxy(object):
         self.conn_str = None
         self.client = None
         self.prefix = prefix
+        self.session_listeners = []
         self.hosts_cache = SlowlyUpdatedCache(
             self.address_provider.get_latest_address,
             self._update_hosts,
             30,  # Refresh every 30 seconds
             3 * 60)  # Update only after 180 seconds of stability
+        register_gauge('bubuku_zookeeper_async_in_flight', 'Amount of asynchronous zookeeper requests in progress',
+                       lambda: self.async_counter.counter)
 
     def _update_hosts(self, value):
         hosts, port = value
@@ -113,51 +127,110 @@ class _ZookeeperProxy(object):
             self.client.stop()
 
     def session_listener(self, state):
-        pass
+        for listener in self.session_listeners:
+            listener(state)
+
+    def add_session_listener(self, listener):
+        self.session_listeners.append(listener)
 
     def get_conn_str(self):
         return self.conn_str
 
     def get(self, *params):
         self.hosts_cache.touch()
-        return self.client.retry(self.client.get, *params)
+        with get_timings().measure('zookeeper', 'get'):
+            return self.client.retry(self.client.get, *params)
 
     def get_async(self, *params):
         # Exhibitor is not polled here and it's totally fine!
         self.async_counter.increment()
+        start = time.time()
         try:
             i_async = self.client.get_async(*params)
-            i_async.rawlink(self._decrement)
+            i_async.rawlink(lambda result: self._decrement(start))
             return i_async
         except Exception as e:
-            self._decrement()
+            self._decrement(start)
             raise e
 
-    def _decrement(self, *args, **kwargs):
+    def _decrement(self, start):
         self.async_counter.decrement()
+        get_timings().update('zookeeper', 'get_async', time.time() - start)
 
     def set(self, *args, **kwargs):
         self.hosts_cache.touch()
-        return self.client.retry(self.client.set, *args, **kwargs)
+        with get_timings().measure('zookeeper', 'set'):
+            return self.client.retry(self.client.set, *args, **kwargs)
 
     def create(self, *args, **kwargs):
         self.hosts_cache.touch()
-        return self.client.retry(self.client.create, *args, **kwargs)
+        with get_timings().measure('zookeeper', 'create'):
+            return self.client.retry(self.client.create, *args, **kwargs)
 
     def delete(self, *args, **kwargs):
         self.hosts_cache.touch()
         try:
-            return self.client.retry(self.client.delete, *args, **kwargs)
+            with get_timings().measure('zookeeper', 'delete'):
+                return self.client.retry(self.client.delete, *args, **kwargs)
         except NoNodeError:
             pass
 
     def get_children(self, *args, **kwargs):
         self.hosts_cache.touch()
         try:
-            return self.client.retry(self.client.get_children, *args, **kwargs)
+            with get_timings().measure('zookeeper', 'get_children'):
+                return self.client.retry(self.client.get_children, *args, **kwargs)
         except NoNodeError:
             return []
 
+    def watch_children(self, path, watch):
+        # Called from watch callbacks, so exhibitor is not polled here to avoid client restart on kazoo thread
+        try:
+            return self.client.retry(self.client.get_children, path, watch)
+        except NoNodeError:
+            return []
+
+    def watch_data(self, path, watch):
+        """
+        Reads node data setting a watch on it. In case if node doesn't exist, watch is set for node creation.
+        Exhibitor is not polled here, same as for watch_children.
+        :return: tuple (data, stat) or (None, None) if node doesn't exist
+        """
+        try:
+            return self.client.retry(self.client.get, path, watch)
+        except NoNodeError:
+            if self.client.retry(self.client.exists, path, watch) is None:
+                return None, None
+        # Node was created between calls
+        return self.client.retry(self.client.get, path, watch)
+
+    def subscribe_children(self, path, callback):
+        """
+        Calls callback each time when children list of the node is changed. Watch survives session loss.
+        """
+        self.hosts_cache.touch()
+        self.client.ChildrenWatch(path, lambda children: callback())
+
+    def subscribe_node(self, path, callback):
+        """
+        Calls callback each time when node is created, removed or its data is changed. Watch survives session loss.
+        """
+        self.hosts_cache.touch()
+        self.client.DataWatch(path, lambda data, stat: callback())
+
+    def commit(self, build):
+        """
+        Executes several operations atomically in one round-trip. Commit is not retried: in case of connection loss
+        transaction may be applied or not, so caller has to check the result on its own.
+        :param build: function, that adds operations to kazoo transaction
+        :return: list of operation results, failed operations are represented with exceptions
+        :raise ConnectionLossException: if connection was lost before the result was received
+        """
+        self.hosts_cache.touch()
+        transaction = self.client.transaction()
+        build(transaction)
+        return transaction.commit()
+
     def take_lock(self, *args, **kwargs):
         while True:
             try:
@@ -167,10 +240,37 @@ class _ZookeeperProxy(object):
                 _LOG.error('Failed to obtain lock for exhibitor, retrying', exc_info=e)
 
 
+def _is_failed(transaction_results: list) -> bool:
+    return any(isinstance(r, Exception) for r in transaction_results)
+
+
+class _TimedLock(object):
+    """
+    Lock wrapper, that measures time spent waiting for the lock
+    """
+
+    def __init__(self, lock, name: str):
+        self.lock = lock
+        self.name = name
+
+    def __enter__(self):
+        with get_timings().measure('lock', self.name):
+            self.lock.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.lock.release()
+
+
 class BukuExhibitor(object):
     def __init__(self, exhibitor: _ZookeeperProxy, async=True):
         self.exhibitor = exhibitor
         self.async = async
+        self.assignment_cache = None
+        self.partition_state_index = None
+        self.throttle = None
+        self.disk_stats_writers = {}
+        self.action_queues = {}
         for node in ('changes', 'actions/global'):
             try:
                 self.exhibitor.create('/bubuku/{}'.format(node), makepath=True)
@@ -199,12 +299,124 @@ class BukuExhibitor(object):
         """
         return sorted(self.exhibitor.get_children('/brokers/ids'))
 
+    def _get_many(self, paths: list) -> list:
+        """
+        Reads data of several nodes. In async mode requests are pipelined, amount of requests in flight is limited by
+        exhibitor.
+        :param paths: list of node paths
+        :return: list of node data, None for nodes that do not exist
+        """
+        if self.async:
+            return [value for _, value in self._get_pipelined((path, path) for path in paths)]
+        result = []
+        for path in paths:
+            try:
+                result.append(self.exhibitor.get(path)[0])
+            except NoNodeError:
+                result.append(None)
+        return result
+
+    def _get_pipelined(self, items):
+        """
+        Reads nodes data asynchronously, keeping at most _PIPELINE_WINDOW requests in flight. Results are yielded in
+        the same order as items, as soon as they arrive, so memory usage doesn't depend on amount of items.
+        :param items: iterable of tuples (key, path)
+        :return: generator of tuples (key, data), where data is None if node doesn't exist
+        """
+        window = deque()
+        for key, path in items:
+            window.append((key, path, self.exhibitor.get_async(path)))
+            if len(window) >= _PIPELINE_WINDOW:
+                yield self._get_async_result(*window.popleft())
+        while window:
+            yield self._get_async_result(*window.popleft())
+
+    def _get_async_result(self, key, path: str, i_async) -> tuple:
+        try:
+            value, stat = i_async.get(block=True)
+        except ConnectionLossException:
+            try:
+                value, stat = self.exhibitor.get(path)
+            except NoNodeError:
+                value = None
+        except NoNodeError:
+            value = None
+        return key, value
+
+    def get_broker_metadata(self) -> Dict[int, dict]:
+        """
+        Loads registrations of all the active brokers in one pass
+        :return: dictionary broker_id -> registration data from /brokers/ids/<broker_id> (host, port, rack, ...)
+        """
+        broker_ids = self.get_broker_ids()
+        result = {}
+        for broker_id, data in zip(broker_ids, self._get_many(['/brokers/ids/{}'.format(b) for b in broker_ids])):
+            if data is not None:  # Broker is gone while reading
+                result[int(broker_id)] = json.loads(data.decode('utf-8'))
+        return result
+
     def get_broker_racks(self) -> Dict[int, str]:
         """
         Lists the rack of each broker, if it exists
         :return: a dictionary of tuples (broker_id, rack), where rack can be None
         """
-        return {int(broker): json.loads(self.exhibitor.get('/brokers/ids/{}'.format(broker))[0].decode('utf-8')).get('rack') for broker in self.get_broker_ids()}
+        return {broker_id: metadata.get('rack') for broker_id, metadata in self.get_broker_metadata().items()}
+
+    def subscribe_children(self, path: str, callback):
+        """
+        Subscribes to changes of children list of the node. Node is created if it doesn't exist yet.
+        :param path: path to node
+        :param callback: function without arguments, that is called from zookeeper thread
+        """
+        try:
+            self.exhibitor.create(path, makepath=True)
+        except NodeExistsError:
+            pass
+        self.exhibitor.subscribe_children(path, callback)
+
+    def subscribe_node(self, path: str, callback):
+        """
+        Subscribes to creation, removal and data changes of the node.
+        :param path: path to node
+        :param callback: function without arguments, that is called from zookeeper thread
+        """
+        self.exhibitor.subscribe_node(path, callback)
+
+    def enable_assignment_cache(self):
+        """
+        Switches load_partition_assignment to in-memory cache, that is kept fresh with zookeeper watches.
+        """
+        if self.assignment_cache is None:
+            _LOG.info('Enabling partition assignment cache')
+            self.assignment_cache = PartitionAssignmentCache(self.exhibitor)
+
+    def enable_partition_state_index(self) -> PartitionStateIndex:
+        """
+        Creates index of partition states by leader, that is kept fresh with zookeeper watches. Partition assignment
+        cache is enabled as well, as it is used to track partition list.
+        :return: partition state index
+        """
+        if self.partition_state_index is None:
+            self.enable_assignment_cache()
+            _LOG.info('Enabling partition state index')
+            self.partition_state_index = PartitionStateIndex(self.exhibitor, self.assignment_cache)
+        return self.partition_state_index
+
+    def enable_reassignment_throttle(self, rate_bytes: int):
+        """
+        Enables replication throttling for partitions that are reassigned with reallocate_partitions. Throttles are
+        removed with clear_reassignment_throttle, when rebalance change is finished.
+        :param rate_bytes: replication rate limit in bytes per second for each broker taking part in reassignment
+        """
+        _LOG.info('Enabling reassignment throttle with rate {} bytes/sec'.format(rate_bytes))
+        self.throttle = ReassignmentThrottle(self.exhibitor, rate_bytes)
+
+    def get_assignment_generation(self):
+        """
+        Returns generation of partition assignment. Generation is changed each time when assignment is changed.
+        :return: generation number or None, if assignment cache is not enabled
+        """
+        return self.assignment_cache.get_generation() if self.assignment_cache is not None else None
 
     def load_partition_assignment(self, topics=None) -> list:
         """
@@ -212,6 +424,9 @@ class BukuExhibitor(object):
         :param topics Optional list of topics to get data for
         :returns generator of tuples (topic_name:str, partition:int, replica_list:list(int)), for ex. "test", 0, [1,2,3]
         """
+        if self.assignment_cache is not None:
+            yield from self.assignment_cache.load_partition_assignment(topics)
+            return
         topics_ = self.exhibitor.get_children('/brokers/topics') if topics is None else topics
         if self.async:
             results = [(topic, self.exhibitor.get_async('/brokers/topics/{}'.format(topic))) for topic in topics_]
@@ -236,15 +451,11 @@ class BukuExhibitor(object):
         (topic_name: str, partition: int, state: json from /brokers/topics/{}/partitions/{}/state)
         """
         if self.async:
-            asyncs = []
-            for topic, partition, _ in self.load_partition_assignment(topics):
-                asyncs.append((topic, partition, self.exhibitor.get_async(
-                    '/brokers/topics/{}/partitions/{}/state'.format(topic, partition))))
-            for topic, partition, async in asyncs:
-                try:
-                    value, stat = async.get(block=True)
-                except ConnectionLossException:
-                    value, stat = self.exhibitor.get('/brokers/topics/{}/partitions/{}/state'.format(topic, partition))
+            items = (((topic, partition), '/brokers/topics/{}/partitions/{}/state'.format(topic, partition))
+                     for topic, partition, _ in self.load_partition_assignment(topics))
+            for (topic, partition), value in self._get_pipelined(items):
+                if value is None:
+                    continue  # Partition is being created or deleted
                 yield (topic, int(partition), json.loads(value.decode('utf-8')))
         else:
             topics_ = self.exhibitor.get_children('/brokers/topics') if topics is None else topics
@@ -276,20 +487,67 @@ class BukuExhibitor(object):
         }
         try:
             data = json.dumps(j)
+            assignment = None
+            if self.throttle is not None:
+                # Replicas are read before reassignment starts, kafka replaces them with old + new ones afterwards
+                topics = list(set(topic for topic, _, _ in partitions_data))
+                assignment = {(topic, partition): replicas for topic, partition, replicas in
+                              self.load_partition_assignment(topics)}
             self.exhibitor.create("/admin/reassign_partitions", data.encode('utf-8'))
             _LOG.info("Reallocating {}".format(data))
+            if assignment is not None:
+                # Throttles are set only when reassignment is accepted, not to touch the one in progress
+                self.throttle.apply(assignment, partitions_data)
             return True
         except NodeExistsError:
             _LOG.info("Waiting for free reallocation slot, still in progress...")
         return False
 
-    def update_disk_stats(self, broker_id: str, data: dict):
-        data_bytes = json.dumps(data, separators=(',', ':')).encode('utf-8')
-        path = '/bubuku/size_stats/{}'.format(broker_id)
+    def save_plan_checkpoint(self, data: dict):
+        """
+        Persists reassignment plan, so it survives daemon restart. There is only one checkpoint in cluster, as only
+        one rebalance can run at a time.
+        """
+        write_chunked(self.exhibitor, _PLAN_CHECKPOINT_PATH, data)
+
+    def load_plan_checkpoint(self):
+        """
+        :return: data saved with save_plan_checkpoint or None, if there is no valid checkpoint
+        """
         try:
-            self.exhibitor.create(path, data_bytes, ephemeral=True, makepath=True)
-        except NodeExistsError:
-            self.exhibitor.set(path, data_bytes)
+            return read_chunked(self.exhibitor, _PLAN_CHECKPOINT_PATH)
+        except NoNodeError:
+            return None
+        except ValueError as e:
+            _LOG.warning('Failed to read plan checkpoint, ignoring it', exc_info=e)
+            return None
+
+    def remove_plan_checkpoint(self):
+        delete_chunked(self.exhibitor, _PLAN_CHECKPOINT_PATH)
+
+    def save_reassignment_plan(self, plan_id: str, data):
+        """
+        Stores reassignment plan submitted for execution. Plans are too big to be stored in action itself.
+        """
+        write_chunked(self.exhibitor, '/bubuku/plans/{}'.format(plan_id), data)
+
+    def load_reassignment_plan(self, plan_id: str):
+        """
+        :return: data saved with save_reassignment_plan or None, if plan doesn't exist
+        """
+        try:
+            return read_chunked(self.exhibitor, '/bubuku/plans/{}'.format(plan_id))
+        except NoNodeError:
+            return None
+
+    def remove_reassignment_plan(self, plan_id: str):
+        delete_chunked(self.exhibitor, '/bubuku/plans/{}'.format(plan_id))
+
+    def update_disk_stats(self, broker_id: str, data: dict):
+        if broker_id not in self.disk_stats_writers:
+            self.disk_stats_writers[broker_id] = DiskStatsWriter(
+                self.exhibitor, '/bubuku/size_stats/{}'.format(broker_id))
+        self.disk_stats_writers[broker_id].write(data)
 
     def get_broker_address(self, broker_id):
         try:
@@ -300,13 +558,18 @@ class BukuExhibitor(object):
 
     def get_disk_stats(self):
         stats = {}
-        for broker_id in self.get_broker_ids():
+        broker_ids = self.get_broker_ids()
+        paths = ['/bubuku/size_stats/{}'.format(broker_id) for broker_id in broker_ids]
+        data = self._get_many([p for path in paths for p in (path, get_delta_path(path))])
+        for idx, broker_id in enumerate(broker_ids):
+            if data[2 * idx] is None:
+                continue
             try:
-                broker_stats_data, zk_stat = self.exhibitor.get('/bubuku/size_stats/{}'.format(broker_id))
-                broker_stats = json.loads(broker_stats_data.decode("utf-8"))
-                stats[broker_id] = broker_stats
+                stats[broker_id] = read_disk_stats(self.exhibitor, paths[idx], (data[2 * idx], data[2 * idx + 1]))
             except NoNodeError:
                 pass
+            except ValueError as e:
+                _LOG.warning('Failed to read size stats of broker {}'.format(broker_id), exc_info=e)
         return stats
 
     def get_conn_str(self):
@@ -324,49 +587,138 @@ class BukuExhibitor(object):
         except NoNodeError:
             return False
 
-    def register_action(self, data: dict, broker_id: str = 'global'):
-        registered = False
-        while not registered:
-            name = '/bubuku/actions/{}/{}'.format(broker_id, uuid.uuid4())
-            try:
-                self.exhibitor.create(name, json.dumps(data).encode('utf-8'), makepath=True)
-                _LOG.info('Action {} registered with name {}'.format(data, name))
-                registered = True
-            except NodeExistsError:
-                pass
+    def get_reassigning_partitions(self) -> dict:
+        """
+        :return: dictionary (topic, partition: int) -> target replica list of partitions, that are being reassigned
+        """
+        try:
+            data = json.loads(self.exhibitor.get('/admin/reassign_partitions')[0].decode('utf-8'))
+        except NoNodeError:
+            return {}
+        return {(item['topic'], int(item['partition'])): [int(r) for r in item['replicas']]
+                for item in data['partitions']}
 
-    def take_action(self, broker_id):
-        paths = ['/bubuku/actions/global']
-        if broker_id:
-            paths.insert(0, '/bubuku/actions/{}'.format(broker_id))
+    def clear_reassignment_throttle(self):
+        """
+        Removes replication throttles, that were set for reassigned partitions. Throttles are kept while reassignment
+        is in progress.
+        """
+        if self.throttle is None:
+            return
+        try:
+            self.exhibitor.get('/admin/reassign_partitions')
+            _LOG.info('Reassignment is in progress, keeping replication throttle')
+        except NoNodeError:
+            self.throttle.clear()
 
-        for base_path in paths:
-            for action in self.exhibitor.get_children(base_path):
-                name = '{}/{}'.format(base_path, action)
-                try:
-                    return json.loads(self.exhibitor.get(name)[0].decode('utf-8'))
-                except Exception as e:
-                    _LOG.error('Failed to take action {}, but anyway will remove it'.format(name), exc_info=e)
-                finally:
-                    self.exhibitor.delete(name)
+    def _get_action_queue(self, broker_id: str) -> ActionQueue:
+        if broker_id not in self.action_queues:
+            self.action_queues[broker_id] = ActionQueue(self.exhibitor, '/bubuku/actions/{}'.format(broker_id))
+        return self.action_queues[broker_id]
+
+    def register_action(self, data: dict, broker_id: str = 'global', priority: int = DEFAULT_PRIORITY,
+                        deduplicate: bool = False):
+        """
+        Registers action to be taken by broker
+        :param data: action data
+        :param broker_id: broker to run action on, 'global' for any broker
+        :param priority: priority class of action, actions with lower number are taken first
+        :param deduplicate: skip registration if identical action is already waiting for the broker
+        :return: True if action was registered
+        """
+        name = self._get_action_queue(broker_id).put(data, priority, deduplicate)
+        if name is not None:
+            _LOG.info('Action {} registered with name {}'.format(data, name))
+        return name is not None
+
+    def take_action(self, broker_id):
+        """
+        Takes the first action from queue of the broker or, if it's empty, from global queue
+        :return: action data or None if there are no actions
+        """
+        broker_ids = [broker_id, 'global'] if broker_id else ['global']
+        for queue_id in broker_ids:
+            data = self._get_action_queue(queue_id).take()
+            if data is not None:
+                return data
         return None
 
     def lock(self, lock_data=None):
-        return self.exhibitor.take_lock('/bubuku/global_lock', lock_data)
+        """
+        Global lock, that is used to register changes
+        """
+        return _TimedLock(self.exhibitor.take_lock('/bubuku/global_lock', lock_data), 'global')
 
     def get_running_changes(self) -> dict:
+        """
+        Lists registered changes. Can be called without lock, changes removed while reading are skipped.
+        :return: dictionary change name -> provider id
+        """
+        return self.load_running_changes()[0]
+
+    def load_running_changes(self) -> (dict, int):
+        """
+        Lists registered changes together with version of change registry, that is used by register_changes to
+        detect conflicting registrations.
+        :return: tuple (dictionary change name -> provider id, registry version)
+        """
+        changes, stat = self.exhibitor.get_children('/bubuku/changes', include_data=True)
         return {
-            change: self.exhibitor.get('/bubuku/changes/{}'.format(change))[0].decode('utf-8')
-            for change in self.exhibitor.get_children('/bubuku/changes')
-            }
+            change: data.decode('utf-8')
+            for change, data in zip(changes, self._get_many(['/bubuku/changes/{}'.format(c) for c in changes]))
+            if data is not None}, stat.version
 
-    def register_change(self, name, provider_id):
-        _LOG.info('Registering change in zk: {}'.format(name))
-        self.exhibitor.create('/bubuku/changes/{}'.format(name), provider_id.encode('utf-8'), ephemeral=True)
+    def register_changes(self, names: list, provider_id: str, version: int = -1) -> bool:
+        """
+        Registers changes atomically. Registry version is increased with each registration, so if it was changed
+        after the registry was read, nothing is registered.
+        :param names: list of change names to register
+        :param provider_id: id of registering instance
+        :param version: version of registry, returned by load_running_changes, -1 to skip the check
+        :return: True if all the changes were registered
+        """
+        _LOG.info('Registering changes in zk: {}'.format(names))
 
-    def unregister_change(self, name):
+        def _build(transaction):
+            transaction.set_data('/bubuku/changes', b'', version=version)
+            for name in names:
+                transaction.create('/bubuku/changes/{}'.format(name), provider_id.encode('utf-8'), ephemeral=True)
+
+        try:
+            results = self.exhibitor.commit(_build)
+        except ConnectionLossException:
+            # Registry is read again on next step, changes are registered already if transaction was applied
+            _LOG.warning('Connection lost while registering changes {}'.format(names))
+            return False
+        if _is_failed(results):
+            _LOG.info('Changes {} were not registered: {}'.format(names, results))
+            return False
+        return True
+
+    def unregister_change(self, name, provider_id=None):
+        """
+        Removes change registration
+        :param name: change name
+        :param provider_id: if set, registration is removed only if it belongs to this provider. Check and removal
+        are atomic, so lock is not needed in this case
+        """
+        path = '/bubuku/changes/{}'.format(name)
+        if provider_id is None:
+            _LOG.info('Removing change {} from locks'.format(name))
+            self.exhibitor.delete(path, recursive=True)
+            return
+        try:
+            data, stat = self.exhibitor.get(path)
+        except NoNodeError:
+            return
+        if data.decode('utf-8') != provider_id:
+            _LOG.info('Change {} is registered by {}, not removing it'.format(name, data.decode('utf-8')))
+            return
         _LOG.info('Removing change {} from locks'.format(name))
-        self.exhibitor.delete('/bubuku/changes/{}'.format(name), recursive=True)
+        try:
+            self.exhibitor.delete(path, version=stat.version)
+        except BadVersionError:
+            _LOG.info('Change {} was registered again while removing, not removing it'.format(name))
 
 
 def load_exhibitor_proxy(address_provider: AddressListProvider, prefix: str) -> BukuExhibitor:
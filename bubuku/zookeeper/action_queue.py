@@ -0,0 +1,146 @@
+import hashlib
+import json
+import logging
+from collections import deque
+
+from kazoo.exceptions import ConnectionLossException, NoNodeError, NodeExistsError
+from kazoo.protocol.states import KazooState
+
+_LOG = logging.getLogger('bubuku.zookeeper.action_queue')
+
+DEFAULT_PRIORITY = 5
+
+
+def get_action_hash(data: dict) -> str:
+    """
+    :return: hash of action, that is the same for identical actions
+    """
+    return hashlib.sha1(json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+
+def _get_sort_key(name: str) -> tuple:
+    # Nodes are named p<priority>-<hash>-<sequence>. Legacy nodes (named with uuid) were created before any of
+    # sequential ones, so they go first
+    parts = name.split('-')
+    if len(parts) == 3 and parts[0][:1] == 'p' and parts[0][1:].isdigit() and parts[2].isdigit():
+        return int(parts[0][1:]), int(parts[2])
+    return -1, name
+
+
+def _get_hash(name: str):
+    parts = name.split('-')
+    return parts[1] if len(parts) == 3 else None
+
+
+class ActionQueue(object):
+    """
+    FIFO queue of actions with priorities, stored as sequential children of a zookeeper node. Actions with lower
+    priority number are taken first, actions with the same priority are taken in order of registration.
+    Zookeeper can't read the head of children list only, so the list is cached and sorted once. It is reloaded only
+    when children watch reports a change, taking an action from unchanged queue costs no listing at all.
+    """
+
+    def __init__(self, exhibitor, path: str):
+        self.exhibitor = exhibitor
+        self.path = path
+        self.pending = deque()
+        self.valid = False
+        try:
+            self.exhibitor.create(self.path, makepath=True)
+        except NodeExistsError:
+            pass
+        self.exhibitor.add_session_listener(self._on_session_state)
+
+    def __str__(self):
+        return 'ActionQueue(path={}, pending={}, valid={})'.format(self.path, len(self.pending), self.valid)
+
+    def _on_session_state(self, state):
+        if state == KazooState.LOST:
+            self.valid = False
+
+    def _on_change(self, event):
+        self.valid = False
+
+    def put(self, data: dict, priority: int = DEFAULT_PRIORITY, deduplicate: bool = False):
+        """
+        Registers action in the queue
+        :param data: action to register
+        :param priority: priority class of action, 0 is the highest one
+        :param deduplicate: skip registration if identical action is already waiting in the queue
+        :return: name of registered node, None if action was deduplicated
+        """
+        action_hash = get_action_hash(data)
+        prefix = '{}/p{}-{}-'.format(self.path, int(priority), action_hash)
+        value = json.dumps(data).encode('utf-8')
+        if not deduplicate:
+            return self.exhibitor.create(prefix, value, sequence=True, makepath=True)
+        while True:
+            children, stat = self.exhibitor.get_children(self.path, include_data=True)
+            if any(_get_hash(c) == action_hash for c in children):
+                _LOG.info('Action {} is already waiting in {}, skipping'.format(data, self.path))
+                return None
+
+            # Version of queue node is increased with each deduplicated registration, so identical actions can't be
+            # registered concurrently
+            def _build(transaction):
+                transaction.set_data(self.path, b'', version=stat.version)
+                transaction.create(prefix, value, sequence=True)
+
+            try:
+                results = self.exhibitor.commit(_build)
+            except ConnectionLossException:
+                # Queue is read again, so action is deduplicated if transaction was applied
+                _LOG.warning('Connection lost while registering action {} in {}, retrying'.format(data, self.path))
+                continue
+            if not any(isinstance(r, Exception) for r in results):
+                return results[1]
+            _LOG.info('Queue {} was changed while registering action {}, retrying'.format(self.path, data))
+
+    def take(self):
+        """
+        Removes the first action from the queue. Action is owned by the one, who removed the node with the version
+        that was read, so several instances can take actions concurrently without locks.
+        :return: action data or None, if queue is empty
+        """
+        while True:
+            if not self.valid:
+                # Mark as valid before loading, so change during load will force reload once again.
+                self.valid = True
+                try:
+                    children = self.exhibitor.watch_children(self.path, self._on_change)
+                except Exception:
+                    self.valid = False
+                    raise
+                self.pending = deque(sorted(children, key=_get_sort_key))
+            if not self.pending:
+                return None
+            child = self.pending.popleft()
+            name = '{}/{}'.format(self.path, child)
+            try:
+                data, stat = self.exhibitor.get(name)
+            except NoNodeError:
+                continue  # Action was taken by someone else
+            try:
+                results = self.exhibitor.commit(lambda t: t.delete(name, version=stat.version))
+            except ConnectionLossException:
+                if self._exists(name):
+                    _LOG.warning('Connection lost while taking action {}, retrying'.format(name))
+                    self.pending.appendleft(child)
+                    continue
+                # Delete was applied. Action could be taken by someone else at the same time, but it is better to
+                # run it twice than to lose it.
+                _LOG.warning('Connection lost while taking action {}, but it was removed'.format(name))
+                results = []
+            if any(isinstance(r, Exception) for r in results):
+                continue
+            try:
+                return json.loads(data.decode('utf-8'))
+            except Exception as e:
+                _LOG.error('Failed to take action {}, removed it'.format(name), exc_info=e)
+
+    def _exists(self, name: str) -> bool:
+        try:
+            self.exhibitor.get(name)
+            return True
+        except NoNodeError:
+            return False
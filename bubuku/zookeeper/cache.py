@@ -0,0 +1,243 @@
+import json
+import logging
+import threading
+
+from kazoo.exceptions import NoNodeError, ConnectionLossException
+from kazoo.protocol.states import EventType, KazooState
+
+_LOG = logging.getLogger('bubuku.zookeeper.cache')
+
+_TOPICS_PATH = '/brokers/topics'
+
+
+class PartitionAssignmentCache(object):
+    """
+    In-memory copy of partition assignments from /brokers/topics/<topic>. The copy is loaded once and is kept fresh
+    using children watch on /brokers/topics and data watches on each topic node. Each modification of cached data
+    increments generation counter, so callers can find out that assignment was changed.
+    All the watches are lost together with zookeeper session, so the cache is reloaded on first access after session
+    loss.
+    """
+
+    def __init__(self, exhibitor):
+        self.exhibitor = exhibitor
+        self.lock = threading.Lock()
+        self.assignment = {}  # topic -> {partition: replicas}
+        self.generation = 0
+        self.valid = False
+        self.exhibitor.add_session_listener(self._on_session_state)
+
+    def __str__(self):
+        return 'PartitionAssignmentCache(topics={}, generation={}, valid={})'.format(
+            len(self.assignment), self.generation, self.valid)
+
+    def get_generation(self) -> int:
+        self._ensure_loaded()
+        return self.generation
+
+    def load_partition_assignment(self, topics=None) -> list:
+        """
+        Returns cached assignment in the same format as BukuExhibitor.load_partition_assignment
+        :param topics: Optional list of topics to get data for
+        :return: list of tuples (topic_name:str, partition:int, replica_list:list(int))
+        """
+        self._ensure_loaded()
+        with self.lock:
+            topics_ = self.assignment.keys() if topics is None else [t for t in topics if t in self.assignment]
+            return [(topic, partition, list(replicas))
+                    for topic in topics_ for partition, replicas in self.assignment[topic].items()]
+
+    def _ensure_loaded(self):
+        if self.valid:
+            return
+        _LOG.info('Loading partition assignment cache')
+        # Mark as valid before loading, so session loss during load will force reload once again.
+        self.valid = True
+        try:
+            self._load_topics()
+        except Exception:
+            self.valid = False
+            raise
+        _LOG.info('Partition assignment cache loaded: {}'.format(self))
+
+    def _on_session_state(self, state):
+        if state == KazooState.LOST:
+            _LOG.warning('Zookeeper session lost, partition assignment cache will be reloaded')
+            self.valid = False
+
+    def _load_topics(self, event=None):
+        topics = self.exhibitor.watch_children(_TOPICS_PATH, self._load_topics)
+        with self.lock:
+            removed = [t for t in self.assignment.keys() if t not in topics]
+            for topic in removed:
+                del self.assignment[topic]
+            if removed:
+                self.generation += 1
+            # Data watches are already set for known topics, unless session was lost
+            to_load = [t for t in topics if t not in self.assignment] if event else topics
+        if event is None:
+            self._load_assignment_async(to_load)
+        else:
+            # Called on watch thread, async pipelining would block the thread that is processing async results.
+            for topic in to_load:
+                self._load_assignment_sync(topic)
+
+    def _on_topic_event(self, event):
+        topic = event.path[len(_TOPICS_PATH) + 1:]
+        if event.type == EventType.DELETED:
+            self._update_topic(topic, None)
+        else:
+            self._load_assignment_sync(topic)
+
+    def _load_assignment_async(self, topics):
+        results = [(topic, self.exhibitor.get_async(
+            '{}/{}'.format(_TOPICS_PATH, topic), self._on_topic_event)) for topic in topics]
+        for topic, result in results:
+            try:
+                value, _ = result.get(block=True)
+                self._update_topic(topic, value)
+            except (ConnectionLossException, NoNodeError):
+                self._load_assignment_sync(topic)
+
+    def _load_assignment_sync(self, topic):
+        value, _ = self.exhibitor.watch_data('{}/{}'.format(_TOPICS_PATH, topic), self._on_topic_event)
+        self._update_topic(topic, value)
+
+    def _update_topic(self, topic, value):
+        partitions = None
+        if value is not None:
+            data = json.loads(value.decode('utf-8'))
+            partitions = {int(k): v for k, v in data['partitions'].items()}
+        with self.lock:
+            if self.assignment.get(topic) == partitions:
+                return
+            if partitions is None:
+                del self.assignment[topic]
+            else:
+                self.assignment[topic] = partitions
+            self.generation += 1
+
+
+class PartitionStateIndex(object):
+    """
+    In-memory index of partition states (/brokers/topics/<topic>/partitions/<partition>/state) grouped by leader.
+    The list of partitions is taken from PartitionAssignmentCache, states are kept fresh with data watches on state
+    nodes. The index allows to answer questions like "does broker X lead anything" without reading state of every
+    partition in cluster.
+    """
+
+    def __init__(self, exhibitor, assignment_cache: PartitionAssignmentCache):
+        self.exhibitor = exhibitor
+        self.assignment_cache = assignment_cache
+        self.lock = threading.Lock()
+        self.partitions = set()  # (topic, partition) tracked with watches
+        self.states = {}  # (topic, partition) -> state
+        self.leaders = {}  # leader id (str) -> set of (topic, partition)
+        self.assignment_generation = None
+        self.valid = False
+        self.exhibitor.add_session_listener(self._on_session_state)
+
+    def __str__(self):
+        return 'PartitionStateIndex(partitions={}, leaders={}, valid={})'.format(
+            len(self.states), len(self.leaders), self.valid)
+
+    def get_leaders(self) -> list:
+        """
+        Lists brokers that are leaders for at least one partition
+        :return: list of broker ids (str)
+        """
+        self._ensure_loaded()
+        with self.lock:
+            return list(self.leaders.keys())
+
+    def list_states(self, leaders: list) -> list:
+        """
+        Lists states of partitions that are led by brokers from leaders list
+        :param leaders: list of broker ids (str)
+        :return: list of tuples (topic_name: str, partition: int, state: dict)
+        """
+        self._ensure_loaded()
+        with self.lock:
+            return [(topic, partition, self.states[(topic, partition)])
+                    for leader in leaders for topic, partition in self.leaders.get(str(leader), ())]
+
+    def _on_session_state(self, state):
+        if state == KazooState.LOST:
+            _LOG.warning('Zookeeper session lost, partition state index will be reloaded')
+            self.valid = False
+
+    def _ensure_loaded(self):
+        generation = self.assignment_cache.get_generation()
+        if self.valid and generation == self.assignment_generation:
+            return
+        reload = not self.valid
+        self.valid = True
+        try:
+            self._sync_partitions(generation, reload)
+        except Exception:
+            self.valid = False
+            raise
+
+    def _sync_partitions(self, generation, reload: bool):
+        partitions = set((topic, partition) for topic, partition, _ in
+                         self.assignment_cache.load_partition_assignment())
+        with self.lock:
+            for key in [k for k in self.partitions if k not in partitions]:
+                self._set_state(key, None)
+            to_load = partitions if reload else [k for k in partitions if k not in self.partitions]
+            self.partitions = partitions
+        self.assignment_generation = generation
+        if reload:
+            _LOG.info('Loading partition state index for {} partitions'.format(len(to_load)))
+        results = [(key, self.exhibitor.get_async(_state_path(*key), self._on_state_event)) for key in to_load]
+        for key, result in results:
+            try:
+                value, _ = result.get(block=True)
+                self._update_state(key, value)
+            except (ConnectionLossException, NoNodeError):
+                self._load_state_sync(key)
+
+    def _on_state_event(self, event):
+        # /brokers/topics/<topic>/partitions/<partition>/state
+        parts = event.path.split('/')
+        key = (parts[-4], int(parts[-2]))
+        with self.lock:
+            if key not in self.partitions:
+                # Partition was removed from index, do not rearm the watch
+                return
+        self._load_state_sync(key)
+
+    def _load_state_sync(self, key):
+        value, _ = self.exhibitor.watch_data(_state_path(*key), self._on_state_event)
+        self._update_state(key, value)
+
+    def _update_state(self, key, value):
+        state = json.loads(value.decode('utf-8')) if value is not None else {}
+        with self.lock:
+            if key in self.partitions:
+                self._set_state(key, state)
+
+    def _set_state(self, key, state):
+        old_state = self.states.get(key)
+        if old_state is not None:
+            self._remove_leader(old_state.get('leader'), key)
+        if state is None:
+            self.states.pop(key, None)
+            return
+        self.states[key] = state
+        leader = state.get('leader')
+        if leader is not None:
+            self.leaders.setdefault(str(leader), set()).add(key)
+
+    def _remove_leader(self, leader, key):
+        if leader is None:
+            return
+        led = self.leaders.get(str(leader))
+        if led is not None:
+            led.discard(key)
+            if not led:
+                del self.leaders[str(leader)]
+
+
+def _state_path(topic, partition):
+    return '{}/{}/partitions/{}/state'.format(_TOPICS_PATH, topic, partition)
@@ -0,0 +1,113 @@
+import json
+import logging
+import zlib
+
+from kazoo.exceptions import NoNodeError, NodeExistsError
+
+_LOG = logging.getLogger('bubuku.zookeeper.chunked')
+
+_FORMAT = 'c1'
+# Zookeeper refuses nodes bigger than 1 Mb (jute.maxbuffer), payload is split into chunks of this size
+CHUNK_SIZE = 512 * 1024
+_READ_ATTEMPTS = 3
+
+
+def _get_chunk_path(path: str, idx: int) -> str:
+    # Ephemeral nodes can't have children, so chunks are stored as siblings
+    return '{}.{}'.format(path, idx)
+
+
+def create_or_set(exhibitor, path: str, value: bytes, ephemeral: bool = False):
+    try:
+        exhibitor.create(path, value, ephemeral=ephemeral, makepath=True)
+    except NodeExistsError:
+        exhibitor.set(path, value)
+
+
+def _list_chunks(exhibitor, path: str) -> list:
+    """
+    :return: list of tuples (chunk index, chunk path) of existing chunk nodes
+    """
+    parent, name = path.rsplit('/', 1)
+    result = []
+    for child in exhibitor.get_children(parent):
+        if child.startswith(name + '.'):
+            idx = child[len(name) + 1:]
+            if idx.isdigit():
+                result.append((int(idx), '{}/{}'.format(parent, child)))
+    return result
+
+
+def write_chunks(exhibitor, path: str, payload: bytes, format_: str, ephemeral: bool = False) -> int:
+    """
+    Writes payload split into chunks. Main node holds header "<format> <crc32> <chunks>\\n" followed by the first
+    chunk of payload, the rest of chunks are written to nodes <path>.1, <path>.2, ...
+    :param format_: format of payload, it is checked by read_chunks
+    :param ephemeral: create nodes as ephemeral ones
+    :return: checksum of payload
+    """
+    chunks = [payload[i:i + CHUNK_SIZE] for i in range(0, len(payload), CHUNK_SIZE)] or [b'']
+    crc = zlib.crc32(payload)
+    header = '{} {} {}\n'.format(format_, crc, len(chunks)).encode('utf-8')
+    for idx in range(1, len(chunks)):
+        create_or_set(exhibitor, _get_chunk_path(path, idx), chunks[idx], ephemeral)
+    create_or_set(exhibitor, path, header + chunks[0], ephemeral)
+    for idx, chunk_path in _list_chunks(exhibitor, path):
+        if idx >= len(chunks):
+            exhibitor.delete(chunk_path)
+    _LOG.debug('{} bytes written to {} in {} chunks'.format(len(payload), path, len(chunks)))
+    return crc
+
+
+def read_chunks(exhibitor, path: str, format_: str, prefetched: bytes = None) -> (bytes, int):
+    """
+    Reads payload written by write_chunks
+    :param prefetched: data of <path>, if already loaded
+    :return: tuple (payload, checksum of payload)
+    :raise NoNodeError: if payload is not written
+    :raise ValueError: if payload has another format or can't be read
+    """
+    for attempt in range(_READ_ATTEMPTS):
+        data = prefetched if attempt == 0 and prefetched is not None else exhibitor.get(path)[0]
+        header, first_chunk = data.split(b'\n', 1)
+        data_format, crc, chunks_count = header.decode('utf-8').split(' ')
+        if data_format != format_:
+            raise ValueError('Format {} of {} is not supported'.format(data_format, path))
+        chunks = [first_chunk]
+        try:
+            for idx in range(1, int(chunks_count)):
+                chunks.append(exhibitor.get(_get_chunk_path(path, idx))[0])
+        except NoNodeError:
+            _LOG.info('Chunks of {} were changed while reading, retrying'.format(path))
+            continue
+        payload = b''.join(chunks)
+        if zlib.crc32(payload) == int(crc):
+            return payload, int(crc)
+        _LOG.info('{} was changed while reading, retrying'.format(path))
+    raise ValueError('Failed to read consistent data from {}'.format(path))
+
+
+def write_chunked(exhibitor, path: str, data):
+    """
+    Writes json-serializable data to persistent node in compressed form.
+    """
+    payload = zlib.compress(json.dumps(data, separators=(',', ':')).encode('utf-8'))
+    write_chunks(exhibitor, path, payload, _FORMAT)
+    _LOG.info('{} bytes written to {}'.format(len(payload), path))
+
+
+def read_chunked(exhibitor, path: str):
+    """
+    Reads data written by write_chunked
+    :raise NoNodeError: if data is not written
+    :raise ValueError: if data can't be decoded
+    """
+    payload, _ = read_chunks(exhibitor, path, _FORMAT)
+    return json.loads(zlib.decompress(payload).decode('utf-8'))
+
+
+def delete_chunked(exhibitor, path: str):
+    # Main node is removed first, so readers never see partially removed data
+    exhibitor.delete(path)
+    for _, chunk_path in _list_chunks(exhibitor, path):
+        exhibitor.delete(chunk_path)
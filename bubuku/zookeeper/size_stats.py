@@ -0,0 +1,173 @@
+import json
+import logging
+import zlib
+
+from kazoo.exceptions import NoNodeError
+from kazoo.protocol.states import KazooState
+
+from bubuku.zookeeper import chunked
+
+_LOG = logging.getLogger('bubuku.zookeeper.size_stats')
+
+_VERSION = 2
+_DELTA_SUFFIX = '.delta'
+# Partition size changes smaller than that are not published in delta
+_MIN_CHANGE_KB = 1024
+_MIN_CHANGE_RATIO = 0.01
+
+
+def encode_disk_stats(data: dict) -> bytes:
+    """
+    Converts size stats to compact form: topic names are listed once and partition sizes of each topic are stored as
+    flat array [partition, size_kb, partition, size_kb, ...], the result is compressed.
+    :param data: dictionary {"disk": {...}, "topics": {topic: {partition: size_kb}}}
+    :return: compressed payload
+    """
+    topics = sorted(data.get('topics', {}).keys())
+    compact = {k: v for k, v in data.items() if k != 'topics'}
+    compact['topics'] = topics
+    compact['partitions'] = [
+        [item for partition, size_kb in sorted(data['topics'][topic].items(), key=lambda x: int(x[0]))
+         for item in (int(partition), size_kb)]
+        for topic in topics]
+    return zlib.compress(json.dumps(compact, separators=(',', ':')).encode('utf-8'))
+
+
+def decode_disk_stats(payload: bytes) -> dict:
+    """
+    Restores size stats from payload created by encode_disk_stats
+    """
+    compact = json.loads(zlib.decompress(payload).decode('utf-8'))
+    result = {k: v for k, v in compact.items() if k not in ('topics', 'partitions')}
+    result['topics'] = {
+        topic: {str(sizes[i]): sizes[i + 1] for i in range(0, len(sizes), 2)}
+        for topic, sizes in zip(compact['topics'], compact['partitions'])}
+    return result
+
+
+def write_disk_stats(exhibitor, path: str, data: dict) -> int:
+    """
+    Writes size stats in compact format to ephemeral nodes, split into chunks with format "v<version>"
+    :return: checksum of written snapshot
+    """
+    return chunked.write_chunks(exhibitor, path, encode_disk_stats(data), 'v{}'.format(_VERSION), ephemeral=True)
+
+
+def get_delta_path(path: str) -> str:
+    return path + _DELTA_SUFFIX
+
+
+def _read_snapshot(exhibitor, path: str, prefetched: bytes = None) -> (dict, int):
+    data = prefetched if prefetched is not None else exhibitor.get(path)[0]
+    if data.startswith(b'{'):
+        return json.loads(data.decode('utf-8')), None
+    payload, crc = chunked.read_chunks(exhibitor, path, 'v{}'.format(_VERSION), data)
+    return decode_disk_stats(payload), crc
+
+
+def _read_delta(exhibitor, path: str, base_crc: int, prefetched: tuple):
+    if prefetched is not None:
+        data = prefetched[1]
+    else:
+        try:
+            data = exhibitor.get(get_delta_path(path))[0]
+        except NoNodeError:
+            data = None
+    if data is None:
+        return None
+    header, payload = data.split(b'\n', 1)
+    version, crc = header.decode('utf-8')[1:].split(' ')
+    if int(version) != _VERSION or int(crc) != base_crc:
+        return None  # Delta was written for another snapshot
+    return decode_disk_stats(payload)
+
+
+def read_disk_stats(exhibitor, path: str, prefetched: tuple = None) -> dict:
+    """
+    Reads size stats written either in compact or in plain json format, applying delta published after snapshot.
+    :param prefetched: tuple (data of <path>, data of delta node or None if it doesn't exist), if already loaded
+    :raise NoNodeError: if stats are not written
+    :raise ValueError: if stats can't be decoded
+    """
+    result, crc = _read_snapshot(exhibitor, path, prefetched[0] if prefetched is not None else None)
+    if crc is None:
+        return result
+    delta = _read_delta(exhibitor, path, crc, prefetched)
+    if delta is not None:
+        result['disk'] = delta['disk']
+        for topic, partitions in delta['topics'].items():
+            result['topics'].setdefault(topic, {}).update(partitions)
+        for topic, partitions in delta['removed'].items():
+            topic_stats = result['topics'].get(topic, {})
+            for partition in partitions:
+                topic_stats.pop(partition, None)
+            if not topic_stats:
+                result['topics'].pop(topic, None)
+    return result
+
+
+def _is_significant(old_kb, new_kb) -> bool:
+    return old_kb is None or abs(new_kb - old_kb) > max(_MIN_CHANGE_KB, old_kb * _MIN_CHANGE_RATIO)
+
+
+class DiskStatsWriter(object):
+    """
+    Publishes size stats of a broker incrementally. Full snapshot is written rarely, in between only delta against
+    the last snapshot is written to <path>.delta: partitions, which size changed noticeably (by more than 1 Mb and
+    1%), appeared or were removed. Amount of data written to zookeeper depends on churn instead of partition count.
+    """
+
+    def __init__(self, exhibitor, path: str, snapshot_interval: int = 6, max_delta_ratio: float = 0.2):
+        """
+        :param snapshot_interval: amount of deltas written between snapshots
+        :param max_delta_ratio: snapshot is written if delta contains bigger part of partitions
+        """
+        self.exhibitor = exhibitor
+        self.path = path
+        self.snapshot_interval = snapshot_interval
+        self.max_delta_ratio = max_delta_ratio
+        self.snapshot = None
+        self.snapshot_crc = None
+        self.deltas_written = 0
+        self.exhibitor.add_session_listener(self._on_session_state)
+
+    def _on_session_state(self, state):
+        if state == KazooState.LOST:
+            # Ephemeral nodes are removed together with session, snapshot should be written again
+            self.snapshot = None
+
+    def write(self, data: dict):
+        if self.snapshot is not None and self.deltas_written < self.snapshot_interval:
+            delta, changed = self._get_delta(data)
+            total = sum(len(partitions) for partitions in data['topics'].values())
+            payload = encode_disk_stats(delta)
+            if changed <= total * self.max_delta_ratio and len(payload) < chunked.CHUNK_SIZE:
+                header = 'd{} {}\n'.format(_VERSION, self.snapshot_crc).encode('utf-8')
+                chunked.create_or_set(self.exhibitor, get_delta_path(self.path), header + payload, ephemeral=True)
+                self.deltas_written += 1
+                _LOG.info('Size stats delta with {} changed partitions written to {}'.format(changed, self.path))
+                return
+        self.snapshot_crc = write_disk_stats(self.exhibitor, self.path, data)
+        self.exhibitor.delete(get_delta_path(self.path))
+        self.snapshot = data
+        self.deltas_written = 0
+        _LOG.info('Size stats snapshot written to {}'.format(self.path))
+
+    def _get_delta(self, data: dict) -> (dict, int):
+        """
+        :return: tuple (delta, amount of changed partitions)
+        """
+        changed = {}
+        removed = {}
+        for topic, partitions in data['topics'].items():
+            old_partitions = self.snapshot['topics'].get(topic, {})
+            for partition, size_kb in partitions.items():
+                if _is_significant(old_partitions.get(partition), size_kb):
+                    changed.setdefault(topic, {})[partition] = size_kb
+        for topic, partitions in self.snapshot['topics'].items():
+            new_partitions = data['topics'].get(topic, {})
+            missing = [partition for partition in partitions.keys() if partition not in new_partitions]
+            if missing:
+                removed[topic] = missing
+        count = sum(len(p) for p in changed.values()) + sum(len(p) for p in removed.values())
+        return {'disk': data['disk'], 'topics': changed, 'removed': removed}, count
@@ -0,0 +1,124 @@
+import json
+import logging
+
+from kazoo.exceptions import NoNodeError, NodeExistsError
+
+_LOG = logging.getLogger('bubuku.zookeeper.throttle')
+
+_STATE_PATH = '/bubuku/throttle'
+
+_BROKER_RATE_KEYS = ('leader.replication.throttled.rate', 'follower.replication.throttled.rate')
+_TOPIC_LEADER_KEY = 'leader.replication.throttled.replicas'
+_TOPIC_FOLLOWER_KEY = 'follower.replication.throttled.replicas'
+
+
+class ReassignmentThrottle(object):
+    """
+    Limits inter-broker replication traffic for partitions that are being reassigned, the same way as kafka
+    reassignment tool does:
+     - brokers taking part in reassignment get leader and follower replication throttled rate
+     - topics get list of throttled replicas - current replicas are throttled as leaders, new ones as followers.
+    Configs are written to /config/brokers/<id> and /config/topics/<topic>, kafka is notified about the change
+    through /config/changes. The list of throttled brokers and topics is kept in zookeeper, so throttles are cleared
+    even if reassignment was started by another instance of bubuku.
+    """
+
+    def __init__(self, exhibitor, rate_bytes: int):
+        self.exhibitor = exhibitor
+        self.rate_bytes = int(rate_bytes)
+
+    def __str__(self):
+        return 'ReassignmentThrottle(rate_bytes={})'.format(self.rate_bytes)
+
+    def apply(self, assignment: dict, partitions_data: list):
+        """
+        Sets throttles for reassignment of partitions
+        :param assignment: dictionary (topic, partition: int) -> current replica list
+        :param partitions_data: list of tuples (topic, partition, new_replicas) to be reassigned
+        """
+        leaders = {}
+        followers = {}
+        brokers = set()
+        for topic, partition, replicas in partitions_data:
+            current = [int(r) for r in assignment.get((topic, int(partition)), [])]
+            new = [int(r) for r in replicas if int(r) not in current]
+            if not new:
+                continue
+            brokers.update(current)
+            brokers.update(new)
+            leaders.setdefault(topic, []).extend('{}:{}'.format(partition, r) for r in current)
+            followers.setdefault(topic, []).extend('{}:{}'.format(partition, r) for r in new)
+        if not brokers:
+            return
+        throttled = self._load_throttled()
+        throttled['brokers'] = sorted(set(throttled['brokers']) | brokers)
+        throttled['topics'] = sorted(set(throttled['topics']) | set(leaders.keys()))
+        # State is saved first, so throttles will be cleared even if process dies in the middle
+        self._save_throttled(throttled)
+        _LOG.info('Throttling replication to {} bytes/sec for brokers {} and topics {}'.format(
+            self.rate_bytes, sorted(brokers), sorted(leaders.keys())))
+        for broker_id in sorted(brokers):
+            self._update_config('brokers', str(broker_id), {k: str(self.rate_bytes) for k in _BROKER_RATE_KEYS})
+        for topic in sorted(leaders.keys()):
+            self._update_config('topics', topic, {
+                _TOPIC_LEADER_KEY: ','.join(leaders[topic]),
+                _TOPIC_FOLLOWER_KEY: ','.join(followers[topic]),
+            })
+
+    def clear(self):
+        """
+        Removes all the throttles that were set by apply, including the ones set by other instances of bubuku.
+        """
+        throttled = self._load_throttled()
+        if not throttled['brokers'] and not throttled['topics']:
+            return
+        _LOG.info('Removing replication throttle from brokers {} and topics {}'.format(
+            throttled['brokers'], throttled['topics']))
+        for broker_id in throttled['brokers']:
+            self._update_config('brokers', str(broker_id), {k: None for k in _BROKER_RATE_KEYS})
+        for topic in throttled['topics']:
+            self._update_config('topics', topic, {_TOPIC_LEADER_KEY: None, _TOPIC_FOLLOWER_KEY: None})
+        self.exhibitor.delete(_STATE_PATH)
+
+    def _load_throttled(self) -> dict:
+        # State is not cached, as it is shared between instances of bubuku
+        try:
+            return json.loads(self.exhibitor.get(_STATE_PATH)[0].decode('utf-8'))
+        except NoNodeError:
+            return {'brokers': [], 'topics': []}
+
+    def _save_throttled(self, throttled: dict):
+        data = json.dumps(throttled).encode('utf-8')
+        try:
+            self.exhibitor.create(_STATE_PATH, data, makepath=True)
+        except NodeExistsError:
+            self.exhibitor.set(_STATE_PATH, data)
+
+    def _update_config(self, entity_type: str, entity_name: str, changes: dict):
+        """
+        Updates dynamic config of kafka entity, keeping the rest of properties untouched
+        :param changes: dictionary property -> value, None value removes property
+        """
+        path = '/config/{}/{}'.format(entity_type, entity_name)
+        try:
+            data = json.loads(self.exhibitor.get(path)[0].decode('utf-8'))
+            exists = True
+        except NoNodeError:
+            data = {'version': 1, 'config': {}}
+            exists = False
+        config = data.setdefault('config', {})
+        for key, value in changes.items():
+            if value is None:
+                config.pop(key, None)
+            else:
+                config[key] = value
+        if exists:
+            self.exhibitor.set(path, json.dumps(data).encode('utf-8'))
+        elif config:
+            self.exhibitor.create(path, json.dumps(data).encode('utf-8'), makepath=True)
+        else:
+            return
+        # Kafka 0.10.1+ accepts version 1 of notification only for topics and clients, version 2 works for brokers
+        self.exhibitor.create('/config/changes/config_change_', json.dumps({
+            'version': 2, 'entity_path': '{}/{}'.format(entity_type, entity_name)}).encode('utf-8'),
+            sequence=True, makepath=True)
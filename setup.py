@@ -114,8 +114,9 @@ def setup_package():
         keywords=KEYWORDS,
         classifiers=CLASSIFIERS,
         test_suite='tests',
-        packages=setuptools.find_packages(exclude=['tests', 'tests.*']),
+        packages=setuptools.find_packages(exclude=['tests', 'tests.*', 'benchmarks', 'benchmarks.*']),
         install_requires=[req for req in read('requirements.txt').split('\\n') if req != ''],
+        extras_require={'numpy': ['numpy']},
         cmdclass={'test': PyTest, 'docker_up': DockerUpCommand, 'docker_down': DockerDownCommand},
         tests_require=['pytest-cov', 'pytest'],
         command_options=command_options,
@@ -119,3 +119,22 @@ class TestBroker(unittest.TestCase):
         except Exception as e:
             error_msg = str(e)
             assert error_msg != 'No connection to zookeeper'
+
+    def test_leadership_check_uses_state_index(self):
+        kafka_props, broker = _prepare_for_start_fail(['1', '2'], 3, [1, 5])
+        index = MagicMock()
+        index.get_leaders.return_value = ['1', '2', '3']
+        index.list_states.return_value = [('t0', 0, {'leader': 3, 'isr': [1, 5]})]
+        broker.partition_state_index = index
+        try:
+            broker.start_kafka_process(zk_fake_host)
+            assert False, 'Broker must not start in case where it''s possible to change leader'
+        except LeaderElectionInProgress:
+            pass
+        index.list_states.assert_called_with(['3'])
+        assert not broker.exhibitor.load_partition_states.called
+
+        index.get_leaders.return_value = ['2']
+        index.list_states.return_value = []
+        assert not broker.has_leadership()
+        index.list_states.assert_called_with([])
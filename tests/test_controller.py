@@ -1,6 +1,10 @@
-from unittest.mock import MagicMock
+import threading
+import time
+from unittest.mock import MagicMock, patch
 
+from bubuku.communicate import wake_up_controller, sleep_and_operate
 from bubuku.controller import Controller, Check, Change, _exclude_self
+from bubuku.features.restart_if_dead import CheckBrokerStopped
 
 
 def test_exculde_self():
@@ -43,8 +47,10 @@ def test_multiple_changes_are_executed_one_by_one():
     current_changes = {}
     zk = MagicMock()
     zk.get_running_changes.return_value = current_changes
-    zk.register_change = lambda x, y: current_changes.update({x: y})
-    zk.unregister_change = lambda x: current_changes.pop(x)
+    zk.load_running_changes = lambda: (dict(current_changes), 0)
+    zk.register_changes = lambda names, provider_id, version: current_changes.update(
+        {n: provider_id for n in names}) or True
+    zk.unregister_change = lambda x, provider_id=None: current_changes.pop(x)
 
     controller = Controller(MagicMock(), zk, MagicMock())
     controller.provider_id = 'fake'
@@ -78,3 +84,219 @@ def test_multiple_changes_are_executed_one_by_one():
     controller.make_step()
     assert [0, 0, 0] == running_count
     assert not current_changes
+
+
+def test_watched_check_is_triggered_by_zookeeper():
+    class FakeCheck(Check):
+        def __init__(self):
+            super().__init__(5)
+            self.executed = 0
+
+        def check(self):
+            self.executed += 1
+
+        def get_watched_paths(self):
+            return ['/brokers/ids']
+
+    subscriptions = {}
+    zk = MagicMock()
+    zk.subscribe_children = lambda path, callback: subscriptions.update({path: callback})
+
+    controller = Controller(MagicMock(), zk, MagicMock())
+    controller.provider_id = 'fake'
+    check = FakeCheck()
+    controller.add_check(check)
+    controller.enable_watches()
+    zk.subscribe_node.assert_called_once_with('/admin/reassign_partitions', wake_up_controller)
+
+    assert ['/brokers/ids'] == list(subscriptions.keys())
+    assert check.check_interval_s == Controller._WATCHED_CHECK_INTERVAL_S
+
+    controller.make_step()
+    assert 1 == check.executed
+    controller.make_step()
+    assert 1 == check.executed
+    assert check.time_till_check() > 0
+
+    with patch('bubuku.controller.wake_up_controller') as wake_up:
+        subscriptions['/brokers/ids']()
+        wake_up.assert_called_once_with()
+    assert 0 == check.time_till_check()
+    controller.make_step()
+    assert 2 == check.executed
+
+
+def test_watched_paths_are_added_when_known():
+    broker_id = [None]
+
+    class FakeCheck(Check):
+        def check(self):
+            pass
+
+        def get_watched_paths(self):
+            return ['/global'] + (['/{}'.format(broker_id[0])] if broker_id[0] else [])
+
+    zk = MagicMock()
+    zk.get_running_changes.return_value = {}
+    controller = Controller(MagicMock(), zk, MagicMock())
+    controller.add_check(FakeCheck())
+    controller.enable_watches()
+    controller.make_step()
+    assert ['/global'] == [c[0][0] for c in zk.subscribe_children.call_args_list]
+
+    broker_id[0] = '1'
+    controller.make_step()
+    controller.make_step()
+    assert ['/global', '/1'] == [c[0][0] for c in zk.subscribe_children.call_args_list]
+
+
+def test_wake_up_interrupts_sleep():
+    wake_up_controller()
+    start = time.time()
+    sleep_and_operate(MagicMock(), 10)
+    assert time.time() - start < 5
+
+
+def test_background_check():
+    release = threading.Event()
+
+    class FakeChange(Change):
+        def get_name(self):
+            return 'fake'
+
+    class SlowCheck(Check):
+        def __init__(self):
+            super().__init__(0, background=True, timeout_s=60)
+            self.executed = 0
+
+        def check(self):
+            self.executed += 1
+            release.wait(5)
+            return FakeChange()
+
+    controller = Controller(MagicMock(), MagicMock(), MagicMock())
+    check = SlowCheck()
+    controller.add_check(check)
+
+    controller.make_step()
+    controller.make_step()
+    # Check is not started again while it's running, controller is not blocked
+    assert 1 == len(controller.background_checks)
+    assert not controller.changes
+
+    release.set()
+    future = controller.background_checks[check][0]
+    future.result(5)
+    controller.make_step()
+    assert 1 == len(controller.changes['fake'])
+    assert 1 == check.executed
+
+
+def test_background_check_timeout():
+    release = threading.Event()
+
+    class SlowCheck(Check):
+        def __init__(self):
+            super().__init__(0, background=True, timeout_s=0)
+
+        def check(self):
+            release.wait(5)
+            return MagicMock()
+
+    controller = Controller(MagicMock(), MagicMock(), MagicMock())
+    check = SlowCheck()
+    controller.add_check(check)
+    controller.make_step()
+    time.sleep(0.01)
+    controller.make_step()
+    assert controller.background_checks[check][2]
+
+    release.set()
+    controller.background_checks[check][0].result(5)
+    controller.make_step()
+    assert not controller.changes
+    assert not controller.background_checks
+
+
+def test_registered_changes_do_not_take_lock():
+    class FakeChange(Change):
+        def __init__(self):
+            self.steps = 3
+
+        def get_name(self):
+            return 'fake'
+
+        def can_run(self, current_actions):
+            return True
+
+        def run(self, current_actions):
+            self.steps -= 1
+            return self.steps > 0
+
+    current_changes = {}
+    zk = MagicMock()
+    zk.get_running_changes = lambda: dict(current_changes)
+    zk.load_running_changes = lambda: (dict(current_changes), 0)
+    zk.register_changes = lambda names, provider_id, version: current_changes.update(
+        {n: provider_id for n in names}) or True
+    zk.unregister_change = lambda x, provider_id: current_changes.pop(x) if current_changes.get(x) == provider_id \
+        else None
+
+    controller = Controller(MagicMock(), zk, MagicMock())
+    controller.provider_id = 'fake'
+    controller._add_change_to_queue(FakeChange())
+    controller.make_step()
+    assert 1 == zk.lock.call_count
+    assert {'fake': 'fake'} == current_changes
+    controller.make_step()
+    controller.make_step()
+    # Change was executed while holding registration, without taking global lock
+    assert 1 == zk.lock.call_count
+    assert not current_changes
+    assert not controller.changes
+
+
+def test_cancelled_change_is_not_resumed():
+    events = []
+
+    class FakeChange(Change):
+        def get_name(self):
+            return 'fake'
+
+        def can_run(self, current_actions):
+            return True
+
+        def run(self, current_actions):
+            return True
+
+        def on_cancel(self):
+            events.append('cancel')
+
+        def on_remove(self):
+            events.append('remove')
+
+    zk = MagicMock()
+    zk.get_running_changes.return_value = {'fake': 'fake'}
+    controller = Controller(MagicMock(), zk, MagicMock())
+    controller.provider_id = 'fake'
+    controller._add_change_to_queue(FakeChange())
+    assert 1 == controller.cancel_changes('fake')
+    assert ['cancel', 'remove'] == events
+    assert not controller.changes
+
+    # Change stopped on shutdown keeps its state
+    events.clear()
+    controller._add_change_to_queue(FakeChange())
+    controller.running = False
+    controller.make_step()
+    assert ['remove'] == events
+    assert not controller.changes
+
+
+def test_broker_liveness_is_polled():
+    controller = Controller(MagicMock(), MagicMock(), MagicMock())
+    check = CheckBrokerStopped(MagicMock(), MagicMock())
+    controller.add_check(check)
+    controller.enable_watches()
+    # Kafka process can die without changing zookeeper state
+    assert 5 == check.check_interval_s
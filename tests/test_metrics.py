@@ -0,0 +1,67 @@
+from unittest.mock import MagicMock, patch
+
+import bubuku.metrics
+from bubuku.controller import Controller, Check
+from bubuku.metrics import RollingHistogram, Timings, register_gauge, format_prometheus
+
+
+def test_rolling_histogram():
+    histogram = RollingHistogram(100)
+    assert {'count': 0, 'sum': 0., 'p50': None, 'p99': None, 'max': None} == histogram.snapshot()
+    for i in range(0, 200):
+        histogram.update(i)
+    snapshot = histogram.snapshot()
+    assert 200 == snapshot['count']
+    assert 150 == snapshot['p50']
+    assert 199 == snapshot['p99']
+    assert 199 == snapshot['max']
+
+
+def test_slow_step_is_logged():
+    timings = Timings(slow_threshold_s=1)
+    with patch('bubuku.metrics._LOG') as log:
+        timings.update('check', 'fast', 0.5)
+        assert not log.warning.called
+        timings.update('check', 'slow', 2)
+        assert log.warning.called
+    assert ['fast', 'slow'] == sorted(timings.snapshot()['check'].keys())
+
+
+def test_controller_step_is_measured():
+    class FakeCheck(Check):
+        def __init__(self):
+            super().__init__(0)
+
+        def check(self):
+            return None
+
+    timings = Timings()
+    controller = Controller(MagicMock(), MagicMock(), MagicMock(), timings)
+    controller.add_check(FakeCheck())
+    controller.make_step()
+    controller.make_step()
+    assert 2 == timings.snapshot()['check']['FakeCheck']['count']
+
+
+def test_prometheus_format():
+    timings = Timings()
+    timings.update('zookeeper', 'get', 0.5)
+    timings.update('zookeeper', 'get', 1.5)
+    register_gauge('bubuku_test_gauge', 'Test gauge', lambda: 3)
+    register_gauge('bubuku_test_labeled', 'Test labeled gauge', lambda: {'a"b': 1, 'c': None}, 'change')
+    register_gauge('bubuku_test_failing', 'Failing gauge', lambda: 1 / 0)
+
+    try:
+        lines = format_prometheus(timings).split('\n')
+    finally:
+        for name in ('bubuku_test_gauge', 'bubuku_test_labeled', 'bubuku_test_failing'):
+            del bubuku.metrics._GAUGES[name]
+    assert '# TYPE bubuku_zookeeper_duration_seconds summary' in lines
+    assert 'bubuku_zookeeper_duration_seconds{name="get",quantile="0.5"} 1.5' in lines
+    assert 'bubuku_zookeeper_duration_seconds_sum{name="get"} 2.0' in lines
+    assert 'bubuku_zookeeper_duration_seconds_count{name="get"} 2' in lines
+    assert 'bubuku_zookeeper_duration_seconds_max{name="get"} 1.5' in lines
+    assert 'bubuku_test_gauge 3.0' in lines
+    assert 'bubuku_test_labeled{change="a\\"b"} 1.0' in lines
+    assert not [l for l in lines if l.startswith('bubuku_test_labeled{change="c"')]
+    assert not [l for l in lines if 'bubuku_test_failing' in l]
@@ -2,6 +2,8 @@ import unittest
 from unittest.mock import MagicMock
 
 from bubuku.features.migrate import MigrationChange
+from bubuku.features.rebalance.checkpoint import PlanCheckpoint
+from test_rebalance import mock_plan_checkpoint
 
 
 class TestMigrate(unittest.TestCase):
@@ -54,6 +56,57 @@ class TestMigrate(unittest.TestCase):
 
         assert expected == result
 
+    def test_migration_resumed_from_checkpoint(self):
+        partitions = {('t{}'.format(t), p): [1, 2] for t in range(0, 3) for p in range(0, 2)}
+        partitions[('other', 0)] = [3]
+        loaded_topics = []
+
+        def _load_assignment(topics=None):
+            loaded_topics.append(topics)
+            return [(k[0], k[1], list(v)) for k, v in partitions.items() if topics is None or k[0] in topics]
+
+        def _reallocate_partitions(items):
+            for topic, partition, replicas in items:
+                partitions[(topic, partition)] = replicas
+            return True
+
+        zk = MagicMock()
+        zk.is_rebalancing = lambda: False
+        zk.get_broker_ids = lambda: ['1', '2', '3', '4']
+        zk.load_partition_assignment = _load_assignment
+        zk.reallocate_partitions = _reallocate_partitions
+        zk.get_reassigning_partitions.return_value = {}
+        checkpoints = mock_plan_checkpoint(zk)
+        action = {'name': 'migrate', 'from': [1], 'to': [4], 'shrink': True}
+
+        change = MigrationChange(zk, [1], [4], True, 2, PlanCheckpoint(zk, action, '3'))
+        assert change.run([])
+        assert change.run([])
+        # Only partitions to move are saved
+        assert 6 == len(checkpoints[-1]['plan'])
+        assert 2 == len([v for v in partitions.values() if 4 in v])
+
+        # Daemon is restarted
+        loaded_topics.clear()
+        change = MigrationChange(zk, [1], [4], True, 2, PlanCheckpoint(zk, action, '3'))
+        assert change.run([])
+        assert 4 == change.get_remaining_actions()
+        assert [['t0', 't1', 't2']] == loaded_topics
+        while change.run([]):
+            pass
+        assert all(v == [4, 2] for k, v in partitions.items() if k[0] != 'other')
+        assert not checkpoints
+
+        # Checkpoint is not used if cluster was changed
+        partitions.update({k: [1, 2] for k in partitions.keys() if k[0] != 'other'})
+        change = MigrationChange(zk, [1], [4], True, 2, PlanCheckpoint(zk, action, '3'))
+        change.run([])
+        partitions[('t0', 0)] = [2, 1]
+        change = MigrationChange(zk, [1], [4], True, 2, PlanCheckpoint(zk, action, '3'))
+        loaded_topics.clear()
+        change.run([])
+        assert [['t0', 't1', 't2'], None] == loaded_topics
+
     def test_replica_generation_no_shrink(self):
         change = MigrationChange(MagicMock(), [1, 2, 3], [4, 5, 6], False)
 
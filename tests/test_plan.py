@@ -0,0 +1,103 @@
+import json
+import unittest
+from unittest.mock import MagicMock
+
+from bubuku.features.migrate import MigrationChange
+from bubuku.features.rebalance.change_planned import PlannedReassignmentChange
+from bubuku.features.rebalance.checkpoint import PlanCheckpoint
+from bubuku.features.rebalance.plan import export_plan, import_plan
+from bubuku.features.rebalance.planning import ClusterSnapshot, compute_plan
+from bubuku.features.remote_exec import RemoteCommandExecutorCheck
+
+
+class TestPlan(unittest.TestCase):
+    def setUp(self):
+        self.partitions = {('t{}'.format(t), p): [1, 2] for t in range(0, 2) for p in range(0, 3)}
+        self.partitions[('other', 0)] = [3, 2]
+        self.plans = {}
+        self.actions = []
+
+        def _load_assignment(topics=None):
+            return [(k[0], k[1], list(v)) for k, v in self.partitions.items() if topics is None or k[0] in topics]
+
+        def _reallocate_partitions(items):
+            for topic, partition, replicas in items:
+                self.partitions[(topic, partition)] = replicas
+            return True
+
+        self.zk = MagicMock()
+        self.zk.is_rebalancing = lambda: False
+        self.zk.get_broker_ids = lambda: ['1', '2', '3', '4']
+        self.zk.get_broker_racks = lambda: {1: None, 2: None, 3: None, 4: None}
+        self.zk.get_disk_stats = lambda: {'1': {'topics': {'t0': {'0': 100, '1': 200}, 't1': {'0': 300}}}}
+        self.zk.load_partition_assignment = _load_assignment
+        self.zk.reallocate_partitions = _reallocate_partitions
+        self.zk.get_reassigning_partitions.return_value = {}
+        self.zk.save_reassignment_plan = lambda plan_id, data: self.plans.update(
+            {plan_id: json.loads(json.dumps(data))})
+        self.zk.load_reassignment_plan = lambda plan_id: self.plans.get(plan_id)
+        self.zk.remove_reassignment_plan = lambda plan_id: self.plans.pop(plan_id, None)
+        self.zk.load_plan_checkpoint.return_value = None
+        self.zk.register_action = lambda data, **kwargs: self.actions.append(data) or True
+
+    def _export_migration(self) -> dict:
+        snapshot = ClusterSnapshot.load(self.zk, with_disk_stats=True)
+        plan = compute_plan(lambda zk: MigrationChange(zk, ['1'], ['4'], True), snapshot)
+        # Exported plan is serialized to file
+        return json.loads(json.dumps(export_plan(snapshot, plan, 'migrate')))
+
+    def test_export_plan(self):
+        data = self._export_migration()
+        assert {'partitions': 6, 'replica_moves': 6, 'leader_changes': 6, 'estimated_kb': 600} == data['summary']
+        assert [1, 2, 3, 4] == data['brokers']
+        assert ('t0', 0, [1, 2], [4, 2]) == import_plan(data)[0]
+        assert 6 == len(import_plan(data))
+
+    def test_submit_and_execute_plan(self):
+        data = self._export_migration()
+        assert 6 == RemoteCommandExecutorCheck.register_reassignment(self.zk, import_plan(data), None, 4)
+        action = self.actions[0]
+        assert 'reassign' == action['name']
+        assert 6 == len(self.plans[action['plan_id']])
+
+        checkpoints = []
+        self.zk.save_plan_checkpoint = lambda data: checkpoints.append(action['plan_id'] in self.plans)
+        change = PlannedReassignmentChange(self.zk, action['plan_id'], action['parallelism'],
+                                           PlanCheckpoint(self.zk, action, '1'))
+        assert change.run([])
+        # Plan is removed after checkpoint is saved
+        assert [True] == checkpoints
+        assert 6 == change.get_remaining_actions()
+        assert not self.plans
+        while change.run([]):
+            pass
+        assert all(v == [4, 2] for k, v in self.partitions.items() if k[0] != 'other')
+        assert [3, 2] == self.partitions[('other', 0)]
+
+    def test_outdated_plan_refused(self):
+        data = self._export_migration()
+        self.partitions[('t1', 2)] = [2, 1]
+        with self.assertRaises(Exception):
+            RemoteCommandExecutorCheck.register_reassignment(self.zk, import_plan(data), None, 1)
+        assert not self.actions
+
+        # Assignment is changed after plan was submitted
+        self.partitions[('t1', 2)] = [1, 2]
+        RemoteCommandExecutorCheck.register_reassignment(self.zk, import_plan(data), None, 1)
+        self.partitions[('t1', 2)] = [2, 1]
+        change = PlannedReassignmentChange(self.zk, self.actions[0]['plan_id'], 1)
+        assert not change.run([])
+        assert all(v[0] != 4 for v in self.partitions.values())
+        assert not self.plans
+
+    def test_plan_with_partitions_in_flight(self):
+        data = self._export_migration()
+        # Kafka keeps old and new replicas in assignment while partition is reassigned
+        self.partitions[('t0', 0)] = [4, 2, 1]
+        self.partitions[('t0', 1)] = [4, 2]
+        self.zk.get_reassigning_partitions.return_value = {('t0', 1): [4, 2]}
+        assert 6 == RemoteCommandExecutorCheck.register_reassignment(self.zk, import_plan(data), None, 1)
+
+        self.zk.get_reassigning_partitions.return_value = {('t0', 1): [3, 2]}
+        with self.assertRaises(Exception):
+            RemoteCommandExecutorCheck.register_reassignment(self.zk, import_plan(data), None, 1)
@@ -1,13 +1,18 @@
 import functools
 import unittest
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from typing import Dict
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
 
 from kazoo.exceptions import NoNodeError
 
 from bubuku.features.rebalance import BaseRebalanceChange
-from bubuku.features.rebalance.change import OptimizedRebalanceChange
+from bubuku.features.rebalance.broker import BrokerDescription
+from bubuku.features.rebalance.change import OptimizedRebalanceChange, DistributionMap
+from bubuku.features.rebalance.checkpoint import PlanCheckpoint
 from bubuku.features.rebalance.change_simple import SimpleRebalanceChange
+from bubuku.features.rebalance.planning import set_planning_executor, get_planning_executor
 from bubuku.features.rebalance.check import RebalanceOnBrokerListCheck
 from bubuku.zookeeper import BukuExhibitor
 
@@ -30,6 +35,18 @@ def _verify_balanced(broker_ids, distribution, delta=1):
     assert (max_total - min_total) <= delta
 
 
+def mock_plan_checkpoint(zk) -> list:
+    """
+    Keeps plan checkpoints of zk mock in memory
+    :return: list of saved checkpoints, the last one is the current
+    """
+    checkpoints = []
+    zk.save_plan_checkpoint = lambda data: checkpoints.append(data)
+    zk.load_plan_checkpoint = lambda: checkpoints[-1] if checkpoints else None
+    zk.remove_plan_checkpoint = lambda: checkpoints.clear()
+    return checkpoints
+
+
 def _verify_rack_aware(initial_distribution, final_distribution, racks):
     for (topic, partition) in initial_distribution.keys():
         final_assignment = final_distribution[(topic, partition)]
@@ -71,6 +88,28 @@ class TestRebalanceCheck(unittest.TestCase):
         assert check.check() is None
 
 
+class TestDistributionMap(unittest.TestCase):
+    def test_move_pairs_order(self):
+        brokers = [BrokerDescription(i) for i in (1, 2, 3)]
+        for partition in range(0, 3):
+            brokers[0].add_leader(('t0', partition))
+        brokers[0].add_leader(('t1', 0))
+        brokers[0].add_leader(('t1', 1))
+        brokers[1].add_leader(('t1', 2))
+        for broker in brokers:
+            broker.set_leader_expectation(2)
+
+        distribution_map = DistributionMap(brokers)
+        moves = []
+        while any(b.have_extra_leaders() for b in brokers):
+            source, target, topic = distribution_map.take_move_pair()
+            target.accept_leader(source, (topic, source.list_partitions(topic, False)[0]))
+            distribution_map.cleanup()
+            moves.append((source.broker_id, target.broker_id, topic))
+
+        assert [(1, 2, 't0'), (1, 3, 't1'), (1, 3, 't0')] == moves
+
+
 class TestBaseRebalance(unittest.TestCase):
     __test__ = False
 
@@ -102,6 +141,7 @@ class TestBaseRebalance(unittest.TestCase):
         buku_proxy.load_partition_assignment = _load_assignment
         buku_proxy.load_partition_states = _load_states
         buku_proxy.is_rebalancing.return_value = False
+        buku_proxy.get_reassigning_partitions.return_value = {}
 
         def _reassign(topic, partition, replicas):
             topic_data[(topic, str(partition))] = [str(x) for x in replicas]
@@ -340,6 +380,41 @@ class TestBaseRebalance(unittest.TestCase):
             pass
         _verify_balanced(['2', '3'], distribution)
 
+    def _check_rebalance_with_broken_pool(self, executor):
+        distribution = {
+            ('t0', '0'): ['2', '1'],
+            ('t0', '1'): ['1', '2'],
+            ('t0', '2'): ['1', '2'],
+            ('t0', '3'): ['1', '2'],
+            ('t1', '0'): ['1', '2'],
+            ('t1', '1'): ['1', '2'],
+        }
+        _, zk = self._create_zk_for_topics(distribution, ['1', '2', '3'], racks={1: None, 2: None, 3: None})
+        set_planning_executor(executor)
+        try:
+            o = self.createChange(zk, ['1', '2', '3'], [], [])
+            while o.run([]):
+                pass
+            # Planning falls back to controller thread
+            assert get_planning_executor() is None
+        finally:
+            set_planning_executor(None)
+        executor.shutdown.assert_called_with(wait=False)
+        _verify_balanced(['1', '2', '3'], distribution)
+
+    def test_rebalance_with_pool_broken_on_submit(self):
+        executor = MagicMock()
+        executor.submit.side_effect = BrokenProcessPool()
+        self._check_rebalance_with_broken_pool(executor)
+
+    def test_rebalance_with_pool_broken_while_planning(self):
+        future = Future()
+        future.set_exception(BrokenProcessPool())
+        executor = MagicMock()
+        executor.submit.return_value = future
+        self._check_rebalance_with_broken_pool(executor)
+        assert executor.submit.called
+
 
 class OptimizedRebalanceTest(TestBaseRebalance):
     __test__ = True
@@ -348,6 +423,29 @@ class OptimizedRebalanceTest(TestBaseRebalance):
     def createChange(self, zk, broker_ids, empty_brokers, exclude_topics, parallelism=1):
         return OptimizedRebalanceChange(zk, broker_ids, empty_brokers, exclude_topics, parallelism)
 
+    def test_rebalance_planned_in_worker_process(self):
+        distribution = {
+            ('t0', '0'): ['2', '1'],
+            ('t0', '1'): ['1', '2'],
+            ('t0', '2'): ['1', '2'],
+            ('t0', '3'): ['1', '2'],
+            ('t1', '0'): ['1', '2'],
+            ('t1', '1'): ['1', '2'],
+        }
+        _, zk = self._create_zk_for_topics(distribution, ['1', '2', '3'], racks={1: None, 2: None, 3: None})
+        executor = ProcessPoolExecutor(max_workers=1)
+        set_planning_executor(executor)
+        try:
+            o = self.createChange(zk, ['1', '2', '3'], [], [])
+            states = []
+            while o.run([]):
+                states.append(o.state)
+        finally:
+            set_planning_executor(None)
+            executor.shutdown()
+        assert 'wait_plan' in states
+        _verify_balanced(['1', '2', '3'], distribution)
+
     def test_rebalance_recovered_with_additional_copy1(self):
         distribution = {
             ('t0', '0'): ['2', '1'],
@@ -360,6 +458,54 @@ class OptimizedRebalanceTest(TestBaseRebalance):
             pass
         _verify_balanced(['1', '2', '3'], distribution)
 
+    def test_rebalance_with_dead_brokers(self):
+        distribution = {('t{}'.format(t), str(p)): [str(1 + (t + p) % 5), str(1 + (t + p + 1) % 5)]
+                        for t in range(0, 5) for p in range(0, 4)}
+        # Broker 5 is dead, so it is not registered and its rack is not known
+        _, zk = self._create_zk_for_topics(distribution, ['1', '2', '3', '4'])
+        o = self.createChange(zk, ['1', '2', '3', '4'], [], [])
+        while o.run([]):
+            pass
+        assert not [replicas for replicas in distribution.values() if '5' in replicas]
+        _verify_balanced(['1', '2', '3', '4'], distribution)
+
+    def test_rebalance_resumed_from_checkpoint(self):
+        distribution = {('t{}'.format(t), str(p)): ['1', '2'] for t in range(0, 4) for p in range(0, 4)}
+        _, zk = self._create_zk_for_topics(distribution, ['1', '2', '3', '4'], racks={i: None for i in range(1, 5)})
+        zk.load_partition_assignment = lambda topics=None: [
+            (k[0], int(k[1]), [int(p) for p in v]) for k, v in distribution.items() if topics is None or k[0] in topics]
+        checkpoints = mock_plan_checkpoint(zk)
+        action = {'name': 'rebalance', 'bin_packing': True}
+
+        o = OptimizedRebalanceChange(zk, ['1', '2', '3', '4'], [], [], 2, PlanCheckpoint(zk, action, '1'))
+        while o.state != OptimizedRebalanceChange._BALANCE:
+            o.run([])
+        total = o.get_remaining_actions()
+        o.run([])
+        assert total == len(checkpoints[-1]['plan'])
+
+        # Daemon is restarted, planning is skipped
+        o = OptimizedRebalanceChange(zk, ['1', '2', '3', '4'], [], [], 2, PlanCheckpoint(zk, action, '1'))
+        o.run([])
+        assert OptimizedRebalanceChange._BALANCE == o.state
+        assert total - 2 == o.get_remaining_actions()
+        while o.run([]):
+            pass
+        _verify_balanced(['1', '2', '3', '4'], distribution)
+        assert not checkpoints
+
+    def test_planning_is_split_into_steps(self):
+        distribution = {('t{}'.format(t), str(p)): ['1', '2'] for t in range(0, 5) for p in range(0, 4)}
+        _, zk = self._create_zk_for_topics(distribution, ['1', '2', '3', '4'], racks={i: None for i in range(1, 5)})
+        o = self.createChange(zk, ['1', '2', '3', '4'], [], [])
+        o._PLANNING_TIME_SLICE_S = 0
+        states = []
+        while o.run([]):
+            states.append(o.state)
+        assert states.count(OptimizedRebalanceChange._COMPUTE_LEADERS) > 1
+        assert states.count(OptimizedRebalanceChange._COMPUTE_REPLICAS) > 1
+        _verify_balanced(['1', '2', '3', '4'], distribution)
+
 
 class SimpleRebalanceTest(TestBaseRebalance):
     __test__ = True
@@ -404,3 +550,15 @@ class SimpleRebalanceTest(TestBaseRebalance):
             pass
 
         _verify_rack_aware(initial_distribution, distribution, racks)
+
+    def test_load_model_without_numpy_gives_same_plan(self):
+        distribution = {('t{}'.format(t), str(p)): [str(1 + (t + p) % 3), str(1 + (t + p + 1) % 3)]
+                        for t in range(0, 6) for p in range(0, 7)}
+        racks = {1: 'r1', 2: 'r1', 3: 'r2', 4: 'r2', 5: 'r3'}
+        broker_ids = ['1', '2', '3', '4', '5']
+        _, zk = self._create_zk_for_topics(distribution, broker_ids, racks)
+
+        plan = self.createChange(zk, broker_ids, ['2'], []).compute_plan()
+        with patch('bubuku.features.rebalance.load_model.numpy', None):
+            fallback_plan = self.createChange(zk, broker_ids, ['2'], []).compute_plan()
+        assert list(plan.items()) == list(fallback_plan.items())
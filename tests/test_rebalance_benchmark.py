@@ -0,0 +1,25 @@
+import unittest
+
+from benchmarks.rebalance import SyntheticCluster, run_benchmark
+
+
+class TestRebalanceBenchmark(unittest.TestCase):
+    def test_synthetic_cluster_layout(self):
+        cluster = SyntheticCluster(brokers=8, racks=2, topics=3, partitions=4, replication_factor=2, new_brokers=2,
+                                   empty_brokers=1, dead_brokers=1)
+        zk = cluster.generate()
+
+        assert ['1', '2', '3', '4', '5', '6', '7'] == zk.get_broker_ids()
+        assert [6, 7] == cluster.get_new_ids()
+        assert [8] == cluster.get_dead_ids()
+        assert 12 == len(zk.load_partition_assignment())
+        for _, _, replicas in zk.load_partition_assignment():
+            assert 2 == len(set(replicas))
+            assert not any(r in (6, 7) for r in replicas)
+
+    def test_changes_empty_brokers(self):
+        cluster = SyntheticCluster(brokers=8, racks=2, topics=5, partitions=4, new_brokers=2, empty_brokers=2)
+        for name in ('optimized', 'simple', 'size', 'migration'):
+            result = run_benchmark(name, cluster, measure_memory=False)
+            assert 0 == result.misplaced_replicas, name
+            assert result.replicas_moved > 0, name
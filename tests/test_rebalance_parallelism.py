@@ -0,0 +1,66 @@
+import unittest
+from unittest.mock import patch, MagicMock
+
+from bubuku.features.migrate import MigrationChange
+from bubuku.features.rebalance.parallelism import AdaptiveParallelism, create_parallelism
+
+
+class TestAdaptiveParallelism(unittest.TestCase):
+    def _run_batch(self, parallelism, duration, size=None):
+        with patch('bubuku.features.rebalance.parallelism.time.time', return_value=1000):
+            parallelism.batch_started(parallelism.get() if size is None else size)
+        with patch('bubuku.features.rebalance.parallelism.time.time', return_value=1000 + duration):
+            parallelism.batch_finished()
+        return parallelism.get()
+
+    def test_fixed_parallelism(self):
+        parallelism = create_parallelism(5)
+        parallelism.batch_started(5)
+        parallelism.batch_finished()
+        assert 5 == parallelism.get()
+        assert parallelism is create_parallelism(parallelism)
+
+    def test_aimd(self):
+        parallelism = AdaptiveParallelism(2, 20, 60)
+        assert 2 == parallelism.get()
+        # Slow start
+        assert 4 == self._run_batch(parallelism, 10)
+        assert 8 == self._run_batch(parallelism, 10)
+        # Multiplicative decrease
+        assert 4 == self._run_batch(parallelism, 100)
+        # Additive increase after first slow batch
+        assert 5 == self._run_batch(parallelism, 10)
+        assert 6 == self._run_batch(parallelism, 10)
+        # Partially filled batch does not grow parallelism
+        assert 6 == self._run_batch(parallelism, 10, size=1)
+        # Bounds are respected
+        for _ in range(0, 5):
+            self._run_batch(parallelism, 1000)
+        assert 2 == parallelism.get()
+        # Finish without started batch is ignored
+        parallelism.batch_finished()
+        assert 2 == parallelism.get()
+
+    def test_upper_bound(self):
+        parallelism = AdaptiveParallelism(1, 5, 60)
+        for _ in range(0, 10):
+            self._run_batch(parallelism, 1)
+        assert 5 == parallelism.get()
+
+    def test_migration_uses_adaptive_batch_size(self):
+        partitions = {('t', p): [1] for p in range(0, 20)}
+        zk = MagicMock()
+        zk.is_rebalancing = lambda: False
+        zk.get_broker_ids = lambda: [1, 2]
+        zk.load_partition_assignment = lambda: [(k[0], k[1], v) for k, v in partitions.items()]
+        batches = []
+
+        def _reallocate_partitions(items):
+            batches.append(len(items))
+            return True
+
+        zk.reallocate_partitions = _reallocate_partitions
+        change = MigrationChange(zk, [1], [2], True, AdaptiveParallelism(1, 100, 60))
+        while change.run([]):
+            pass
+        assert [1, 2, 4, 8, 5] == batches
@@ -0,0 +1,128 @@
+import unittest
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+from unittest.mock import MagicMock
+
+from bubuku.features.rebalance.change_size import SizeRebalanceChange, load_partition_sizes
+from bubuku.features.rebalance.planning import set_planning_executor, get_planning_executor
+
+
+def _create_zk(assignment: dict, sizes: dict, racks: dict):
+    zk = MagicMock()
+    zk.get_broker_ids.return_value = [str(b) for b in sorted(racks.keys())]
+    zk.get_broker_racks.return_value = racks
+    zk.is_rebalancing.return_value = False
+    zk.get_disk_stats.return_value = {
+        '1': {'disk': {}, 'topics': {t: {str(p): size for (t_, p), size in sizes.items() if t_ == t}
+                                     for t, _ in sizes.keys()}}}
+    zk.load_partition_assignment = lambda: [(t, p, list(r)) for (t, p), r in assignment.items()]
+
+    def _reallocate_partitions(items):
+        for topic, partition, replicas in items:
+            assignment[(topic, partition)] = replicas
+        return True
+
+    zk.reallocate_partitions = _reallocate_partitions
+    return zk
+
+
+def _usage(assignment: dict, sizes: dict) -> dict:
+    result = {}
+    for key, replicas in assignment.items():
+        for replica in replicas:
+            result[replica] = result.get(replica, 0) + sizes[key]
+    return result
+
+
+class TestSizeRebalance(unittest.TestCase):
+    def test_partition_sizes_merged(self):
+        stats = {
+            '1': {'disk': {}, 'topics': {'t0': {'0': 10, '1': 20}}},
+            '2': {'disk': {}, 'topics': {'t0': {'0': 15}, 't1': {'0': 1}}},
+        }
+        assert {('t0', 0): 15, ('t0', 1): 20, ('t1', 0): 1} == load_partition_sizes(stats)
+
+    def test_moves_only_needed_data(self):
+        assignment = {('t0', 0): [1], ('t0', 1): [1], ('t1', 0): [2], ('t1', 1): [2]}
+        sizes = {('t0', 0): 50, ('t0', 1): 30, ('t1', 0): 10, ('t1', 1): 10}
+        zk = _create_zk(assignment, sizes, {1: None, 2: None})
+
+        change = SizeRebalanceChange(zk, ['1', '2'], [], [])
+        while change.run([]):
+            pass
+
+        assert 30 == change.estimated_kb
+        assert [2] == assignment[('t0', 1)]
+        assert {1: 50, 2: 50} == _usage(assignment, sizes)
+
+    def test_plan_estimated_on_submitted_snapshot(self):
+        assignment = {('t0', 0): [1], ('t0', 1): [1], ('t1', 0): [2], ('t1', 1): [2]}
+        sizes = {('t0', 0): 50, ('t0', 1): 30, ('t1', 0): 10, ('t1', 1): 10}
+        zk = _create_zk(assignment, sizes, {1: None, 2: None})
+        submitted = []
+
+        def _submit(fn, *args):
+            submitted.append(Future())
+            submitted[-1].set_result(fn(*args))
+            return submitted[-1]
+
+        executor = MagicMock()
+        executor.submit = _submit
+        set_planning_executor(executor)
+        try:
+            change = SizeRebalanceChange(zk, ['1', '2'], [], [])
+            assert change.run([])
+            assert submitted
+            # Statistics that were published after planning must not affect the plan estimation
+            zk.get_disk_stats.return_value = {}
+            assert change.run([])
+        finally:
+            set_planning_executor(None)
+
+        assert 30 == change.estimated_kb
+        assert {('t0', 1): [2]} == change.action_queue
+
+    def test_plan_computed_on_controller_when_pool_is_broken(self):
+        assignment = {('t0', 0): [1], ('t0', 1): [1], ('t1', 0): [2], ('t1', 1): [2]}
+        sizes = {('t0', 0): 50, ('t0', 1): 30, ('t1', 0): 10, ('t1', 1): 10}
+        zk = _create_zk(assignment, sizes, {1: None, 2: None})
+        future = Future()
+        future.set_exception(BrokenProcessPool())
+        executor = MagicMock()
+        executor.submit.return_value = future
+        set_planning_executor(executor)
+        try:
+            change = SizeRebalanceChange(zk, ['1', '2'], [], [])
+            while change.run([]):
+                pass
+            assert get_planning_executor() is None
+        finally:
+            set_planning_executor(None)
+
+        assert 30 == change.estimated_kb
+        assert {1: 50, 2: 50} == _usage(assignment, sizes)
+
+    def test_balanced_cluster_is_not_changed(self):
+        assignment = {('t0', 0): [1, 2], ('t0', 1): [2, 3], ('t0', 2): [3, 1]}
+        sizes = {('t0', 0): 100, ('t0', 1): 102, ('t0', 2): 98}
+        zk = _create_zk(assignment, sizes, {1: None, 2: None, 3: None})
+
+        assert {} == SizeRebalanceChange(zk, ['1', '2', '3'], [], []).compute_plan()
+
+    def test_balance_with_empty_brokers_and_racks(self):
+        assignment = {('t{}'.format(t), p): [1 + (t + p) % 4, 1 + (t + p + 1) % 4] for t in range(0, 4)
+                      for p in range(0, 6)}
+        sizes = {key: 10 * (1 + key[1]) for key in assignment.keys()}
+        racks = {1: 'a', 2: 'b', 3: 'a', 4: 'b', 5: 'a', 6: 'b', 7: 'a'}
+        zk = _create_zk(assignment, sizes, racks)
+
+        change = SizeRebalanceChange(zk, ['1', '2', '3', '4', '5', '6', '7'], ['1'], [])
+        while change.run([]):
+            pass
+
+        usage = _usage(assignment, sizes)
+        assert 1 not in usage
+        average = sum(usage.values()) / 6
+        assert all(v - average <= average * SizeRebalanceChange._BALANCE_THRESHOLD for v in usage.values()), usage
+        for replicas in assignment.values():
+            assert len(set(racks[r] for r in replicas)) == 2
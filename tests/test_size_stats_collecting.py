@@ -1,38 +1,90 @@
+import os
+import tempfile
 import unittest
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
 
-from bubuku.features.data_size_stats import GenerateDataSizeStatistics
+from bubuku.features.data_size_stats import GenerateDataSizeStatistics, LogDirSizeScanner
 from bubuku.utils import CmdHelper
 
 
+def _write_file(path: str, size_kb: int):
+    with open(path, 'wb') as f:
+        f.write(b'x' * size_kb * 1024)
+
+
+def _write_segment(partition_dir: str, offset: int, size_kb: int):
+    os.makedirs(partition_dir, exist_ok=True)
+    _write_file(os.path.join(partition_dir, '{:020d}.log'.format(offset)), size_kb)
+    _write_file(os.path.join(partition_dir, '{:020d}.index'.format(offset)), 1)
+
+
+def _get_size_kb(log_dir: str, partition: str) -> int:
+    path = os.path.join(log_dir, partition)
+    return sum(os.stat(os.path.join(path, f)).st_blocks * 512 for f in os.listdir(path)) // 1024
+
+
 class TestDataSizeStats(unittest.TestCase):
 
     def test_size_stats_collecting(self):
         zk = MagicMock()
 
-        stat_check = GenerateDataSizeStatistics(zk, self.__mock_broker(), self.__mock_cmd_helper(), ["/kafka-logs"])
-        stat_check.check()
+        with tempfile.TemporaryDirectory() as log_dir:
+            for name, size in (('my-topic-0', 10), ('my-topic-2', 200), ('another_topic-0', 3), ('wrong_topic', 77)):
+                _write_segment(os.path.join(log_dir, name), 0, size)
+            _write_file(os.path.join(log_dir, 'recovery-point-offset-checkpoint'), 55)
 
-        expected_json = {
-            "disk": {"free_kb": 606, "used_kb": 404},
-            "topics": {
-                "another_topic": {"0": 3},
-                "my-topic": {"0": 10, "2": 200}
+            stat_check = GenerateDataSizeStatistics(zk, self.__mock_broker(), self.__mock_cmd_helper(), [log_dir])
+            stat_check.check()
+
+            expected_json = {
+                "disk": {"free_kb": 606, "used_kb": 404},
+                "topics": {
+                    "another_topic": {"0": _get_size_kb(log_dir, 'another_topic-0')},
+                    "my-topic": {"0": _get_size_kb(log_dir, 'my-topic-0'), "2": _get_size_kb(log_dir, 'my-topic-2')}
+                }
             }
-        }
-        zk.update_disk_stats.assert_called_with('dummy_id', expected_json)
+            zk.update_disk_stats.assert_called_with('dummy_id', expected_json)
+
+    def test_scanner_checks_only_active_segments(self):
+        with tempfile.TemporaryDirectory() as log_dir:
+            partition_dir = os.path.join(log_dir, 'topic-0')
+            _write_segment(partition_dir, 0, 100)
+            _write_segment(partition_dir, 100, 10)
+            scanner = LogDirSizeScanner()
+            assert [('topic', '0', _get_size_kb(log_dir, 'topic-0'))] == scanner.scan(log_dir)
+
+            _write_file(os.path.join(partition_dir, '{:020d}.log'.format(100)), 50)
+            expected = [('topic', '0', _get_size_kb(log_dir, 'topic-0'))]
+            with patch('bubuku.features.data_size_stats.os.stat', side_effect=os.stat) as stat:
+                assert expected == scanner.scan(log_dir)
+                assert sorted(['{:020d}.log'.format(100), '{:020d}.index'.format(100)]) == sorted(
+                    os.path.basename(c[0][0]) for c in stat.call_args_list)
+
+            # Roll a new segment
+            _write_segment(partition_dir, 200, 1)
+            assert [('topic', '0', _get_size_kb(log_dir, 'topic-0'))] == scanner.scan(log_dir)
+
+            os.remove(os.path.join(partition_dir, '{:020d}.log'.format(0)))
+            assert [('topic', '0', _get_size_kb(log_dir, 'topic-0'))] == scanner.scan(log_dir)
+
+    def test_scanner_detects_cleaned_segments(self):
+        with tempfile.TemporaryDirectory() as log_dir:
+            partition_dir = os.path.join(log_dir, 'topic-0')
+            _write_segment(partition_dir, 0, 100)
+            _write_segment(partition_dir, 100, 10)
+            scanner = LogDirSizeScanner()
+            assert [('topic', '0', _get_size_kb(log_dir, 'topic-0'))] == scanner.scan(log_dir)
+
+            # Log cleaner replaces segment with compacted one under the same name
+            cleaned = os.path.join(partition_dir, '{:020d}.log.swap'.format(0))
+            _write_file(cleaned, 20)
+            os.rename(cleaned, os.path.join(partition_dir, '{:020d}.log'.format(0)))
+            assert [('topic', '0', _get_size_kb(log_dir, 'topic-0'))] == scanner.scan(log_dir)
 
     def __mock_cmd_helper(self) -> CmdHelper:
         class CmdHelperMock(CmdHelper):
             def cmd_run(self, cmd: str):
-                if cmd.startswith("du"):
-                    return "10\t/kafka-logs/my-topic-0\n" \
-                           "200\t/kafka-logs/my-topic-2\n" \
-                           "3\t/kafka-logs/another_topic-0\n" \
-                           "55\t/kafka-logs\n" \
-                           "77\t/kafka-logs/wrong_topic\n" \
-                           "blah"
-                elif cmd.startswith("df"):
+                if cmd.startswith("df"):
                     return "101 202\n" \
                            "303 404\n" \
                            "500"
@@ -46,3 +98,18 @@ class TestDataSizeStats(unittest.TestCase):
         broker.is_running_and_registered.return_value = True
         broker.id_manager.get_broker_id.return_value = "dummy_id"
         return broker
+
+    def test_disk_stats_from_log_dirs(self):
+        with tempfile.TemporaryDirectory() as log_dir:
+            cmd_helper = CmdHelper(disk_stats_ttl_s=60)
+            cmd_helper.cmd_run = MagicMock(side_effect=ValueError('Shell should not be used'))
+            cmd_helper.set_log_dirs([log_dir, os.path.join(log_dir, 'not_created_yet')])
+            stat = os.statvfs(log_dir)
+            used_kb, free_kb = cmd_helper.get_disk_stats()
+            # The same file system is counted once
+            assert used_kb + free_kb <= stat.f_blocks * stat.f_frsize // 1024
+            assert free_kb > 0
+
+            with patch('bubuku.utils.get_statvfs_disk_stats') as statvfs_stats:
+                assert (used_kb, free_kb) == cmd_helper.get_disk_stats()
+                assert not statvfs_stats.called
@@ -1,13 +1,16 @@
+import copy
 import json
 import math
 import re
 import time
 import unittest
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
 
-from kazoo.exceptions import NoNodeError, NodeExistsError
+from kazoo.exceptions import BadVersionError, ConnectionLossException, NoNodeError, NodeExistsError
+from kazoo.protocol.states import EventType, KazooState, WatchedEvent
 
 from bubuku.zookeeper import BukuExhibitor, SlowlyUpdatedCache
+from bubuku.zookeeper.cache import PartitionStateIndex
 
 
 def test_get_broker_ids():
@@ -26,6 +29,40 @@ def test_get_broker_ids():
     assert ['1', '2', '3'] == buku.get_broker_ids()  # ensure that return list is sorted
 
 
+def test_get_broker_metadata():
+    exhibitor_mock = MagicMock()
+    nodes = {
+        '/brokers/ids/1': {'host': 'host1', 'rack': 'r1'},
+        '/brokers/ids/2': {'host': 'host2'},
+        '/bubuku/size_stats/1': {'disk': {'free_kb': 1, 'used_kb': 2}, 'topics': {}},
+    }
+    requested = []
+
+    def _get(path):
+        if path not in nodes:
+            raise NoNodeError()
+        return json.dumps(nodes[path]).encode('utf-8'), object()
+
+    def _get_async(path):
+        requested.append(path)
+        mock = MagicMock()
+        mock.get = lambda block: _get(path)
+        return mock
+
+    exhibitor_mock.get_children = lambda path: ['1', '2', '3'] if path == '/brokers/ids' else []
+    exhibitor_mock.get = MagicMock(side_effect=NotImplementedError)
+    exhibitor_mock.get_async = _get_async
+
+    buku = BukuExhibitor(exhibitor_mock)
+    # Broker 3 is gone while reading
+    assert {1: {'host': 'host1', 'rack': 'r1'}, 2: {'host': 'host2'}} == buku.get_broker_metadata()
+    assert {1: 'r1', 2: None} == buku.get_broker_racks()
+    assert {'1': nodes['/bubuku/size_stats/1']} == buku.get_disk_stats()
+    # All the requests are pipelined
+    assert not exhibitor_mock.get.called
+    assert '/bubuku/size_stats/3.delta' in requested
+
+
 def test_is_broker_registered():
     def _get(path):
         if path == '/brokers/ids/123':
@@ -168,6 +205,36 @@ def test_load_partition_states_async():
     _test_load_partition_states(True)
 
 
+def test_load_partition_states_streaming():
+    exhibitor_mock = MagicMock()
+    issued = []
+
+    def _get(path):
+        if path == '/brokers/topics/t01':
+            return json.dumps({'partitions': {str(x): [1] for x in range(0, 100)}}).encode('utf-8'), object()
+        if path == '/brokers/topics/t01/partitions/50/state':
+            raise NoNodeError()
+        return json.dumps({'leader': 1}).encode('utf-8'), object()
+
+    def _get_async(path):
+        issued.append(path)
+        mock = MagicMock()
+        mock.get = lambda block: _get(path)
+        return mock
+
+    exhibitor_mock.get = _get
+    exhibitor_mock.get_async = _get_async
+    exhibitor_mock.get_children = lambda path: ['t01'] if path == '/brokers/topics' else []
+    buku_ex = BukuExhibitor(exhibitor_mock, async=True)
+
+    with patch('bubuku.zookeeper._PIPELINE_WINDOW', 10):
+        states = buku_ex.load_partition_states()
+        next(states)
+        # Topic request and one window of state requests
+        assert 11 == len(issued)
+        assert 99 == 1 + len(list(states))
+
+
 def test_reallocate_partition():
     call_idx = [0]
 
@@ -308,3 +375,494 @@ class SlowlyUpdatedCacheTest(unittest.TestCase):
 
         assert len(main_call) == 1
         assert main_call[0] + 3 - .15 < update_calls[1] < main_call[0] + 3 + .15
+
+
+class PartitionAssignmentCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.topics = {
+            't01': {'0': [1, 2, 3], '1': [3, 2, 1]},
+            't02': {'0': [4, 5, 6]},
+        }
+        self.watches = {}
+        self.reads = []
+
+        def _get_data(path, watch):
+            self.reads.append(path)
+            self.watches[path] = watch
+            topic = path[len('/brokers/topics/'):]
+            if topic not in self.topics:
+                return None, None
+            return json.dumps({'partitions': self.topics[topic]}).encode('utf-8'), object()
+
+        def _get_async(path, watch):
+            mock = MagicMock()
+            mock.get = lambda block: _get_data(path, watch)
+            return mock
+
+        def _get_children(path, watch):
+            assert path == '/brokers/topics'
+            self.watches[path] = watch
+            return list(self.topics.keys())
+
+        self.exhibitor = MagicMock()
+        self.exhibitor.watch_data = _get_data
+        self.exhibitor.get_async = _get_async
+        self.exhibitor.watch_children = _get_children
+        self.buku = BukuExhibitor(self.exhibitor)
+        self.buku.enable_assignment_cache()
+
+    def _fire(self, path, type_=EventType.CHANGED):
+        self.watches.pop(path)(WatchedEvent(type_, None, path))
+
+    def _load(self):
+        return sorted(self.buku.load_partition_assignment())
+
+    def test_loaded_once(self):
+        expected = [('t01', 0, [1, 2, 3]), ('t01', 1, [3, 2, 1]), ('t02', 0, [4, 5, 6])]
+        assert expected == self._load()
+        generation = self.buku.get_assignment_generation()
+        reads = len(self.reads)
+        assert expected == self._load()
+        assert reads == len(self.reads)
+        assert generation == self.buku.get_assignment_generation()
+        assert [('t02', 0, [4, 5, 6])] == list(self.buku.load_partition_assignment(['t02', 't03']))
+
+    def test_topic_changes_tracked(self):
+        self._load()
+        generation = self.buku.get_assignment_generation()
+
+        self.topics['t02']['0'] = [6, 5, 4]
+        self._fire('/brokers/topics/t02')
+        assert ('t02', 0, [6, 5, 4]) in self._load()
+        assert generation < self.buku.get_assignment_generation()
+
+        generation = self.buku.get_assignment_generation()
+        self.topics['t03'] = {'0': [1]}
+        self._fire('/brokers/topics', EventType.CHILD)
+        assert ('t03', 0, [1]) in self._load()
+        assert generation < self.buku.get_assignment_generation()
+
+        generation = self.buku.get_assignment_generation()
+        del self.topics['t01']
+        self._fire('/brokers/topics/t01', EventType.DELETED)
+        self._fire('/brokers/topics', EventType.CHILD)
+        assert [('t02', 0, [6, 5, 4]), ('t03', 0, [1])] == self._load()
+        assert generation < self.buku.get_assignment_generation()
+
+    def test_same_data_keeps_generation(self):
+        self._load()
+        generation = self.buku.get_assignment_generation()
+        self._fire('/brokers/topics/t01')
+        assert generation == self.buku.get_assignment_generation()
+
+    def test_reloaded_after_session_loss(self):
+        self._load()
+        reads = len(self.reads)
+        for args, _ in self.exhibitor.add_session_listener.call_args_list:
+            args[0](KazooState.LOST)
+        self.topics['t01']['0'] = [2, 1, 3]
+        assert ('t01', 0, [2, 1, 3]) in self._load()
+        assert reads + 2 == len(self.reads)
+
+
+class PartitionStateIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.assignment = [('t01', 0, [1, 2]), ('t01', 1, [2, 1]), ('t02', 0, [3, 1])]
+        self.states = {
+            '/brokers/topics/t01/partitions/0/state': {'leader': 1, 'isr': [1, 2]},
+            '/brokers/topics/t01/partitions/1/state': {'leader': 2, 'isr': [2, 1]},
+            '/brokers/topics/t02/partitions/0/state': {'leader': 1, 'isr': [1]},
+        }
+        self.watches = {}
+
+        def _get_data(path, watch):
+            self.watches[path] = watch
+            if path not in self.states:
+                return None, None
+            return json.dumps(self.states[path]).encode('utf-8'), object()
+
+        def _get_async(path, watch):
+            mock = MagicMock()
+            mock.get = lambda block: _get_data(path, watch)
+            return mock
+
+        exhibitor = MagicMock()
+        exhibitor.watch_data = _get_data
+        exhibitor.get_async = _get_async
+        self.generation = [1]
+        assignment_cache = MagicMock()
+        assignment_cache.get_generation = lambda: self.generation[0]
+        assignment_cache.load_partition_assignment = lambda: list(self.assignment)
+
+        self.index = PartitionStateIndex(exhibitor, assignment_cache)
+
+    def _fire(self, path):
+        self.watches.pop(path)(WatchedEvent(EventType.CHANGED, None, path))
+
+    def test_states_by_leader(self):
+        assert ['1', '2'] == sorted(self.index.get_leaders())
+        assert [('t01', 0, {'leader': 1, 'isr': [1, 2]}), ('t02', 0, {'leader': 1, 'isr': [1]})] == sorted(
+            self.index.list_states(['1']), key=lambda x: (x[0], x[1]))
+        assert [] == self.index.list_states(['3'])
+
+    def test_leader_change_tracked(self):
+        self.index.get_leaders()
+        self.states['/brokers/topics/t02/partitions/0/state'] = {'leader': 3, 'isr': [3]}
+        self._fire('/brokers/topics/t02/partitions/0/state')
+        assert [('t01', 0, {'leader': 1, 'isr': [1, 2]})] == self.index.list_states(['1'])
+        assert [('t02', 0, {'leader': 3, 'isr': [3]})] == self.index.list_states([3])
+
+    def test_partition_list_follows_assignment(self):
+        self.index.get_leaders()
+        self.assignment = [('t01', 0, [1, 2]), ('t03', 0, [2])]
+        self.states['/brokers/topics/t03/partitions/0/state'] = {'leader': 2, 'isr': [2]}
+        self.generation[0] += 1
+        assert ['1', '2'] == sorted(self.index.get_leaders())
+        assert [('t03', 0, {'leader': 2, 'isr': [2]})] == self.index.list_states(['2'])
+        # Events for removed partitions are ignored and watch is not set again
+        self._fire('/brokers/topics/t02/partitions/0/state')
+        assert '/brokers/topics/t02/partitions/0/state' not in self.watches
+
+
+class ReassignmentThrottleTest(unittest.TestCase):
+    def setUp(self):
+        self.nodes = {
+            '/brokers/topics': None,
+            '/brokers/topics/t01': {'partitions': {'0': [1, 2], '1': [2, 3]}},
+            '/config/topics/t01': {'version': 1, 'config': {'retention.ms': '1000'}},
+        }
+        self.notifications = []
+
+        def _get(path, *args):
+            if path not in self.nodes:
+                raise NoNodeError()
+            return json.dumps(self.nodes[path]).encode('utf-8'), object()
+
+        def _set(path, value):
+            self.nodes[path] = json.loads(value.decode('utf-8'))
+
+        def _create(path, value=b'', sequence=False, **kwargs):
+            if sequence:
+                self.notifications.append(json.loads(value.decode('utf-8')))
+                return
+            if path in self.nodes:
+                raise NodeExistsError()
+            self.nodes[path] = json.loads(value.decode('utf-8')) if value else None
+
+        def _delete(path):
+            self.nodes.pop(path, None)
+
+        exhibitor = MagicMock()
+        exhibitor.get = _get
+        exhibitor.set = _set
+        exhibitor.create = _create
+        exhibitor.delete = _delete
+        exhibitor.get_children = lambda path: ['t01'] if path == '/brokers/topics' else []
+        self.buku = BukuExhibitor(exhibitor, async=False)
+        self.buku.enable_reassignment_throttle(1024)
+
+    def test_throttle_set_and_cleared(self):
+        assert self.buku.reallocate_partitions([('t01', 0, [1, 4]), ('t01', 1, [2, 3])])
+        assert self.nodes['/config/topics/t01']['config'] == {
+            'retention.ms': '1000',
+            'leader.replication.throttled.replicas': '0:1,0:2',
+            'follower.replication.throttled.replicas': '0:4'}
+        for broker_id in (1, 2, 4):
+            assert self.nodes['/config/brokers/{}'.format(broker_id)]['config'] == {
+                'leader.replication.throttled.rate': '1024', 'follower.replication.throttled.rate': '1024'}
+        assert '/config/brokers/3' not in self.nodes
+        assert {'version': 2, 'entity_path': 'topics/t01'} in self.notifications
+        assert {'version': 2, 'entity_path': 'brokers/4'} in self.notifications
+
+        assert self.buku.is_rebalancing()
+        assert {('t01', 0): [1, 4], ('t01', 1): [2, 3]} == self.buku.get_reassigning_partitions()
+        self.buku.clear_reassignment_throttle()
+        assert '/bubuku/throttle' in self.nodes
+        del self.nodes['/admin/reassign_partitions']
+        assert not self.buku.is_rebalancing()
+        assert '/bubuku/throttle' in self.nodes
+        # Throttles could be set by another instance
+        self.buku.enable_reassignment_throttle(1024)
+        self.buku.clear_reassignment_throttle()
+        assert self.nodes['/config/topics/t01']['config'] == {'retention.ms': '1000'}
+        for broker_id in (1, 2, 4):
+            assert self.nodes['/config/brokers/{}'.format(broker_id)]['config'] == {}
+        assert '/bubuku/throttle' not in self.nodes
+        assert {'version': 2, 'entity_path': 'brokers/4'} in self.notifications
+
+    def test_throttle_not_changed_while_rebalancing(self):
+        assert self.buku.reallocate_partitions([('t01', 0, [1, 4])])
+        notifications = len(self.notifications)
+        assert not self.buku.reallocate_partitions([('t01', 1, [2, 5])])
+        assert self.nodes['/config/topics/t01']['config']['follower.replication.throttled.replicas'] == '0:4'
+        assert '/config/brokers/5' not in self.nodes
+        assert notifications == len(self.notifications)
+
+
+class SizeStatsTest(unittest.TestCase):
+    def setUp(self):
+        self.nodes = {}
+
+        def _get(path, *args):
+            if path not in self.nodes:
+                raise NoNodeError()
+            return self.nodes[path], object()
+
+        def _set(path, value):
+            self.nodes[path] = value
+
+        def _create(path, value=b'', **kwargs):
+            if path in self.nodes:
+                raise NodeExistsError()
+            self.nodes[path] = value
+
+        def _get_children(path):
+            return [k[len(path) + 1:] for k in self.nodes.keys() if k.startswith(path + '/')]
+
+        exhibitor = MagicMock()
+        exhibitor.get = _get
+        exhibitor.set = _set
+        exhibitor.create = _create
+        exhibitor.delete = lambda path: self.nodes.pop(path, None)
+        exhibitor.get_children = lambda path: ['1', '2', '3'] if path == '/brokers/ids' else _get_children(path)
+        self.buku = BukuExhibitor(exhibitor, async=False)
+        self.stats = {
+            'disk': {'used_kb': 100, 'free_kb': 200},
+            'topics': {'t{}'.format(t): {str(p): t * 100 + p for p in range(0, 50)} for t in range(0, 100)}
+        }
+
+    def test_compact_and_legacy_formats(self):
+        self.buku.update_disk_stats('1', self.stats)
+        self.nodes['/bubuku/size_stats/2'] = json.dumps(self.stats).encode('utf-8')
+        assert len(self.nodes['/bubuku/size_stats/1']) < len(self.nodes['/bubuku/size_stats/2']) / 4
+        assert self.nodes['/bubuku/size_stats/1'].startswith(b'v2 ')
+        assert {'1': self.stats, '2': self.stats} == self.buku.get_disk_stats()
+
+    def test_chunks(self):
+        with patch('bubuku.zookeeper.chunked.CHUNK_SIZE', 1000):
+            self.buku.update_disk_stats('1', self.stats)
+            chunks = [k for k in self.nodes.keys() if k.startswith('/bubuku/size_stats/1.')]
+            assert len(chunks) > 1
+            assert self.stats == self.buku.get_disk_stats()['1']
+
+            small_stats = {'disk': {'used_kb': 1, 'free_kb': 2}, 'topics': {'t': {'0': 1}}}
+            self.buku.update_disk_stats('1', small_stats)
+            assert not [k for k in self.nodes.keys() if k.startswith('/bubuku/size_stats/1.')]
+            assert small_stats == self.buku.get_disk_stats()['1']
+
+    def test_inconsistent_chunks_are_skipped(self):
+        with patch('bubuku.zookeeper.chunked.CHUNK_SIZE', 1000):
+            self.buku.update_disk_stats('1', self.stats)
+        self.nodes['/bubuku/size_stats/1.1'] = b'garbage'
+        assert {} == self.buku.get_disk_stats()
+
+    def test_plan_checkpoint(self):
+        assert self.buku.load_plan_checkpoint() is None
+        plan = {'plan': [['t{}'.format(i), i, [1, 2], [3, 4]] for i in range(0, 1000)]}
+        with patch('bubuku.zookeeper.chunked.CHUNK_SIZE', 1000):
+            self.buku.save_plan_checkpoint(plan)
+            assert len([k for k in self.nodes.keys() if k.startswith('/bubuku/plan_checkpoint.')]) > 1
+            assert plan == self.buku.load_plan_checkpoint()
+            self.buku.save_plan_checkpoint({'plan': []})
+            assert ['/bubuku/plan_checkpoint'] == [k for k in self.nodes.keys() if k.startswith('/bubuku/plan')]
+            assert {'plan': []} == self.buku.load_plan_checkpoint()
+        self.buku.remove_plan_checkpoint()
+        assert self.buku.load_plan_checkpoint() is None
+
+    def test_delta(self):
+        self.buku.update_disk_stats('1', self.stats)
+        snapshot = self.nodes['/bubuku/size_stats/1']
+
+        new_stats = copy.deepcopy(self.stats)
+        new_stats['disk'] = {'used_kb': 150, 'free_kb': 150}
+        new_stats['topics']['t1']['1'] += 10  # Not significant change
+        new_stats['topics']['t2']['2'] += 5000
+        del new_stats['topics']['t3']['3']
+        del new_stats['topics']['t4']
+        new_stats['topics']['new'] = {'0': 1}
+        self.buku.update_disk_stats('1', new_stats)
+
+        assert snapshot == self.nodes['/bubuku/size_stats/1']
+        assert len(self.nodes['/bubuku/size_stats/1.delta']) < len(snapshot) / 10
+        expected = copy.deepcopy(new_stats)
+        expected['topics']['t1']['1'] -= 10
+        assert expected == self.buku.get_disk_stats()['1']
+
+        # Snapshot is rewritten after several deltas, delta is removed
+        for _ in range(0, 6):
+            self.buku.update_disk_stats('1', new_stats)
+        assert snapshot != self.nodes['/bubuku/size_stats/1']
+        assert '/bubuku/size_stats/1.delta' not in self.nodes
+        assert new_stats == self.buku.get_disk_stats()['1']
+
+
+def _create_node(nodes: dict, path: str, value: bytes, sequence: bool) -> str:
+    if sequence:
+        parent = path.rsplit('/', 1)[0]
+        path = '{}{:010d}'.format(path, len([k for k in nodes.keys() if k.startswith(parent + '/')]) + 100)
+    if path in nodes:
+        raise NodeExistsError()
+    nodes[path] = (value, 0)
+    return path
+
+
+class _FakeTransaction(object):
+    def __init__(self, nodes: dict):
+        self.nodes = nodes
+        self.operations = []
+
+    def set_data(self, path, value, version=-1):
+        self.operations.append(('set', path, value, version))
+
+    def create(self, path, value=b'', sequence=False, **kwargs):
+        self.operations.append(('create_sequential' if sequence else 'create', path, value, -1))
+
+    def delete(self, path, version=-1):
+        self.operations.append(('delete', path, None, version))
+
+    def commit(self):
+        for op, path, value, version in self.operations:
+            if op == 'create' and path in self.nodes:
+                return [NodeExistsError()] * len(self.operations)
+            if op in ('set', 'delete') and (path not in self.nodes or version not in (-1, self.nodes[path][1])):
+                return [BadVersionError()] * len(self.operations)
+        results = []
+        for op, path, value, version in self.operations:
+            if op == 'delete':
+                del self.nodes[path]
+                results.append(True)
+            elif op == 'set':
+                self.nodes[path] = (value, self.nodes[path][1] + 1)
+                results.append(MagicMock())
+            else:
+                results.append(_create_node(self.nodes, path, value, op == 'create_sequential'))
+        return results
+
+
+class TransactionsTest(unittest.TestCase):
+    def setUp(self):
+        self.nodes = {'/bubuku/changes': (b'', 0)}
+
+        def _get(path):
+            if path not in self.nodes:
+                raise NoNodeError()
+            stat = MagicMock()
+            stat.version = self.nodes[path][1]
+            return self.nodes[path][0], stat
+
+        def _get_children(path, include_data=False):
+            children = [k[len(path) + 1:] for k in sorted(self.nodes.keys()) if k.startswith(path + '/')]
+            return (children, _get(path)[1]) if include_data else children
+
+        def _create(path, value=b'', makepath=False, sequence=False):
+            return _create_node(self.nodes, path, value, sequence)
+
+        def _watch_children(path, watch):
+            self.watches.append(watch)
+            return _get_children(path)
+
+        exhibitor = MagicMock()
+        exhibitor.get = _get
+        exhibitor.get_children = _get_children
+        exhibitor.create = _create
+        exhibitor.watch_children = _watch_children
+        exhibitor.commit = lambda build: self._commit(build)
+        self.commits = 0
+        self.watches = []
+        self.buku = BukuExhibitor(exhibitor, async=False)
+
+    def _commit(self, build):
+        self.commits += 1
+        transaction = _FakeTransaction(self.nodes)
+        build(transaction)
+        return transaction.commit()
+
+    def test_register_changes(self):
+        changes, version = self.buku.load_running_changes()
+        assert {} == changes
+        assert self.buku.register_changes(['a', 'b'], 'p1', version)
+        assert 1 == self.commits
+        assert {'a': 'p1', 'b': 'p1'} == self.buku.get_running_changes()
+        # Registration based on outdated registry is refused
+        assert not self.buku.register_changes(['c'], 'p2', version)
+        assert {'a': 'p1', 'b': 'p1'} == self.buku.get_running_changes()
+        # Already registered change is refused as well
+        assert not self.buku.register_changes(['a'], 'p2', self.buku.load_running_changes()[1])
+        assert {'a': 'p1', 'b': 'p1'} == self.buku.get_running_changes()
+
+    def test_take_action(self):
+        self.nodes['/bubuku/actions/global/1'] = (json.dumps({'name': 'global'}).encode('utf-8'), 0)
+        self.nodes['/bubuku/actions/2/1'] = (b'garbage', 0)
+        self.nodes['/bubuku/actions/2/2'] = (json.dumps({'name': 'local'}).encode('utf-8'), 0)
+        assert {'name': 'local'} == self.buku.take_action('2')
+        assert {'name': 'global'} == self.buku.take_action('2')
+        assert self.buku.take_action('2') is None
+        assert not self._get_actions('2') and not self._get_actions('global')
+
+    def test_action_taken_by_other_is_skipped(self):
+        self.nodes['/bubuku/actions/global/1'] = (json.dumps({'name': 'first'}).encode('utf-8'), 0)
+        self.nodes['/bubuku/actions/global/2'] = (json.dumps({'name': 'second'}).encode('utf-8'), 0)
+        commit = self.buku.exhibitor.commit
+
+        def _concurrent_commit(build):
+            # Other instance changes the node after it was read
+            if '/bubuku/actions/global/1' in self.nodes:
+                self.nodes['/bubuku/actions/global/1'] = (b'{}', 1)
+            return commit(build)
+
+        self.buku.exhibitor.commit = _concurrent_commit
+        assert {'name': 'second'} == self.buku.take_action('1')
+
+    def test_action_taken_on_connection_loss(self):
+        self.nodes['/bubuku/actions/global/1'] = (json.dumps({'name': 'first'}).encode('utf-8'), 0)
+        self.nodes['/bubuku/actions/global/2'] = (json.dumps({'name': 'second'}).encode('utf-8'), 0)
+        commit = self.buku.exhibitor.commit
+        lost = [True, False, True]
+
+        def _commit_with_connection_loss(build):
+            applied = lost.pop(0)
+            if applied:
+                commit(build)
+            raise ConnectionLossException()
+
+        self.buku.exhibitor.commit = _commit_with_connection_loss
+        # Connection was lost after the action was removed
+        assert {'name': 'first'} == self.buku.take_action('1')
+        # Connection was lost before the action was removed, then after
+        assert {'name': 'second'} == self.buku.take_action('1')
+        assert not self._get_actions('global')
+
+    def _get_actions(self, broker_id: str) -> list:
+        return sorted(k for k in self.nodes.keys() if k.startswith('/bubuku/actions/{}/'.format(broker_id)))
+
+    def test_actions_taken_by_priority(self):
+        self.buku.register_action({'name': 'rebalance'}, priority=2)
+        self.buku.register_action({'name': 'fatboyslim'}, priority=3)
+        self.buku.register_action({'name': 'rebalance', 'other': True}, priority=2)
+        self.buku.register_action({'name': 'restart'}, priority=0)
+        # Legacy action, registered before upgrade
+        self.nodes['/bubuku/actions/global/0f31c9e4-0b8a-4b52-a6d0-96b0e6d3c0aa'] = (b'{"name": "legacy"}', 0)
+
+        assert ['legacy', 'restart', 'rebalance', 'rebalance', 'fatboyslim'] == [
+            self.buku.take_action(None)['name'] for _ in range(0, 5)]
+        assert self.buku.take_action(None) is None
+
+    def test_actions_deduplicated(self):
+        assert self.buku.register_action({'name': 'restart'}, '1', priority=0, deduplicate=True)
+        assert not self.buku.register_action({'name': 'restart'}, '1', priority=0, deduplicate=True)
+        assert 1 == len(self._get_actions('1'))
+        # Deduplication is optional
+        assert self.buku.register_action({'name': 'restart'}, '1', priority=0)
+        assert 2 == len(self._get_actions('1'))
+        # Identical action for other queue is registered
+        assert self.buku.register_action({'name': 'restart'}, '2', priority=0, deduplicate=True)
+
+    def test_action_list_cached(self):
+        assert self.buku.take_action(None) is None
+        assert self.buku.take_action(None) is None
+        assert 1 == len(self.watches)
+
+        self.buku.register_action({'name': 'restart'}, priority=0)
+        self.watches[-1](MagicMock())
+        assert {'name': 'restart'} == self.buku.take_action(None)
+        assert 2 == len(self.watches)